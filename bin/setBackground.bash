@@ -14,6 +14,8 @@
 # makeSpanningBackground processes.  The second, '--limitcpu', takes one
 # argument, which should be an integer percentage value.  It limits the CPU
 # usage to that percentage, provided that the cpulimit program is installed.
+# The number of threads used at once is also limited, with the user-settable
+# variable numWorkerThreads below.
 # Any arguments after these two optional ones are passed unchanged to the
 # makeSpanningBackground program.
 #
@@ -24,6 +26,16 @@
 #
 # The script can still be called at any other time, as setBackground, for
 # one-time uses such as when you are tired of the current background images.
+# For that, such as from a hotkey, it is much faster to call it as
+#
+#    /home/myusername/bin/setBackground --resident
+#
+# so that the command is run by a resident copy of the program, which keeps
+# its caches warm and has the next image ready.  The resident program is
+# started by the first such command, and the '--killall' option also stops it
+# (by running 'makeSpanningBackground.py --stopresident').  The niceness level
+# and the '--limitcpu' limit are applied to the resident program, which is
+# what does the rendering, rather than to the command handed over to it.
 
 ##############################################
 ###### User-settable variables ###############
@@ -38,6 +50,7 @@ extraOptionsToAlwaysUse="" # any extra option arguments you want to always use
 
 imageQuality=5 # 0 is fastest but lowest quality, 5 is the highest quality
 nicenessLevel=10 # 0 is ordinary priority, 19 is nicest
+numWorkerThreads=2 # threads to decode and scale with, fewer uses less CPU; "" for one per CPU
 pathForLogcurrentFile="~/Pictures/currentImagesLog.txt" # where to write log file
 nameOfProgramInProcessList="makeSpanningBackground.py" # the name so kill can find it
 
@@ -45,11 +58,16 @@ nameOfProgramInProcessList="makeSpanningBackground.py" # the name so kill can fi
 ###### No user-settable variables below ######
 ##############################################
 
+# Expand any tilde usernames in the path to the makeSpanningBackground program.
+# (The makeSpanningBackground program can handle any others internally.)
+eval progName="$pathToMakeSpanningBackground"
+
 # Process the command-line arguments.
 while true
 do
    if [ "$1" == "--killall" ]; then
-      killall -q $nameOfProgramInProcessList; shift
+      killall -q $nameOfProgramInProcessList
+      $progName --stopresident; shift
    elif [ "$1" == "--limitcpu" ]; then
       limitPercent=$2; shift; shift
    else break
@@ -65,24 +83,44 @@ do
    quotedBackgroundFileAndDirList="$quotedBackgroundFileAndDirList '$name'"
 done
 
-# Expand any tilde usernames in the path to the makeSpanningBackground program.
-# (The makeSpanningBackground program can handle any others internally.)
-eval progName="$pathToMakeSpanningBackground"
+# Limit the number of worker threads, if set.
+workersOption=""
+if [ "$numWorkerThreads" != "" ]; then
+   workersOption="--workers $numWorkerThreads"
+fi
+
+# Check whether the command is handed over to the resident program.
+residentCommand=""
+for arg in "$@"
+do
+   if [ "$arg" == "--resident" ]; then residentCommand="yes"; fi
+done
 
 # Run the command.  Note that how it is run will affect how it appears in the
 # process list, which is important for the --killall option.
 nice -$nicenessLevel $progName \
-       $extraOptionsToAlwaysUse \
+       $extraOptionsToAlwaysUse $workersOption \
        -L "$pathForLogcurrentFile" \
        -o "$outputFilePath" \
        -c 0 0 0 -z $imageQuality \
        $quotedBackgroundFileAndDirList "$@" &
+pidToLimit=$!
 
-#renice -$nicenessLevel -p $! 
+if [ "$residentCommand" != "" ]; then
+   # The command only returns once the resident program has applied the
+   # background, and it starts the resident program if none is running.  The
+   # resident program does the rendering, so limit it rather than the command.
+   wait $pidToLimit
+   pidToLimit=$(pgrep -o -u "$(id -u)" -f -- "$nameOfProgramInProcessList --residentserver")
+   if [ "$pidToLimit" == "" ]; then exit; fi
+   renice $nicenessLevel -p $pidToLimit >/dev/null 2>&1
+   # Only start cpulimit for it once, not again for each command.
+   if pgrep -f -- "cpulimit .*-p $pidToLimit " >/dev/null; then limitPercent=""; fi
+fi
 
 if [ "$limitPercent" != "" ]; then
    # Limit CPU usage.  This slows things but can help to maintain
    # responsiveness and keep the fan quiet.
-   cpulimit -b -z -p $! --limit=$limitPercent 2>&1 >/dev/null
+   cpulimit -b -z -p $pidToLimit --limit=$limitPercent 2>&1 >/dev/null
 fi
 
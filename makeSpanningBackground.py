@@ -58,6 +58,157 @@ source directory for the text of the license.
 # 5) Allow URLs to image files as args (PIL can handle urllib-opened links).
 
 from __future__ import division, print_function
+import os
+import sys
+import time
+import json
+import socket
+
+#
+# With the '--resident' option, first try to hand the command over to a
+# resident copy of the program, and with the '--service' option send it to
+# the render service.  This is done before the slow imports below.
+#
+
+def resident_socket_path():
+    """Return the pathname of the per-user socket of the resident program."""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, "makeSpanningBackground.sock")
+    return "/tmp/makeSpanningBackground-{0}.sock".format(os.getuid())
+
+
+def send_command_request(socket_path, argv, tenant=None):
+    """Send the command-line arguments argv, with the current directory and
+    environment, to the resident program or render service listening on the
+    socket socket_path and wait for it to run the command.  The render
+    service queues the command for the tenant named tenant.  Returns the
+    reply, a dict with the exit status and the output of the command, or None
+    if no program of this user is listening on the socket."""
+    try:
+        if os.stat(socket_path).st_uid != os.getuid():
+            return None
+    except OSError:
+        return None
+    client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            client_socket.connect(socket_path)
+        except (socket.error, OSError):
+            return None
+        request = {"argv": argv, "cwd": os.getcwd(), "env": dict(os.environ)}
+        if tenant is not None:
+            request["tenant"] = tenant
+        try:
+            client_socket.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            reply = b""
+            while True:
+                data = client_socket.recv(65536)
+                if not data:
+                    break
+                reply += data
+            return json.loads(reply.decode("utf-8"))
+        except (socket.error, OSError, ValueError) as e:
+            return {"status": 1, "stdout": "", "stderr": "\nError in"
+                    " makeSpanningBackground: Lost the connection to the program"
+                    "\non the socket\n   " + socket_path + "\nThe reported error"
+                    " was:\n " + str(e) + "\n"}
+    finally:
+        client_socket.close()
+
+
+resident_start_timeout = 10.0 # seconds to wait for a new resident program
+
+
+def run_as_thin_client(argv):
+    """Hand the command with the command-line arguments argv over to the
+    resident program, starting one first if none is running, and exit with
+    its exit status.  Returns if that is not possible, and then the command
+    is run by this program as usual."""
+    if not hasattr(socket, "AF_UNIX"):
+        return
+    socket_path = resident_socket_path()
+    reply = send_command_request(socket_path, argv)
+    if reply is None:
+        import subprocess
+        devnull = open(os.devnull, "r+b")
+        try:
+            server = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                       "--residentserver"], stdin=devnull,
+                                      stdout=devnull, stderr=devnull,
+                                      close_fds=True, preexec_fn=os.setsid)
+        except OSError:
+            return
+        finally:
+            devnull.close()
+        # Wait for the imports in the new program, but not for long, and stop
+        # waiting if it exits (it fails, or another one was started first).
+        give_up_time = time.time() + resident_start_timeout
+        while reply is None and time.time() < give_up_time:
+            exited = server.poll() is not None
+            time.sleep(0.05)
+            reply = send_command_request(socket_path, argv)
+            if exited:
+                break
+        if reply is None:
+            return
+    sys.stdout.write(reply["stdout"])
+    sys.stderr.write(reply["stderr"])
+    sys.exit(reply["status"])
+
+
+def stop_resident_program():
+    """Tell the resident program of this user to stop, if one is running, and
+    exit."""
+    if hasattr(socket, "AF_UNIX"):
+        send_command_request(resident_socket_path(), ["--stopresident"])
+    sys.exit(0)
+
+
+def option_value(argv, option):
+    """Return the value given for the long option option in the command-line
+    arguments argv, or None if it is not given."""
+    for count, arg in enumerate(argv):
+        if arg == option and count + 1 < len(argv):
+            return argv[count+1]
+        if arg.startswith(option + "="):
+            return arg[len(option)+1:]
+    return None
+
+
+def run_as_service_client(argv):
+    """Send the command with the command-line arguments argv to the render
+    service on the socket set with the '--service' option, and exit with its
+    exit status once the image is made.  Returns if the option has no value,
+    so that the usual error is given for it."""
+    socket_path = option_value(argv, "--service")
+    if socket_path is None:
+        return
+    socket_path = os.path.abspath(os.path.expanduser(socket_path))
+    tenant = option_value(argv, "--tenant")
+    if tenant is None:
+        import getpass
+        tenant = getpass.getuser()
+    reply = None
+    if hasattr(socket, "AF_UNIX"):
+        reply = send_command_request(socket_path, argv, tenant)
+    if reply is None:
+        print("\nError in makeSpanningBackground: No render service of this user"
+              "\nis listening on the socket\n   " + socket_path + "\n",
+              file=sys.stderr)
+        sys.exit(1)
+    sys.stdout.write(reply["stdout"])
+    sys.stderr.write(reply["stderr"])
+    sys.exit(reply["status"])
+
+
+if __name__ == "__main__" and sys.argv[1:] == ["--stopresident"]:
+    stop_resident_program()
+if __name__ == "__main__" and "--resident" in sys.argv[1:]:
+    run_as_thin_client(sys.argv[1:])
+if __name__ == "__main__" and "--service" in sys.argv[1:]:
+    run_as_service_client(sys.argv[1:])
+
 try:
     import numpy as np
     import scipy as sp
@@ -69,11 +220,25 @@ except ImportError:
     raise
 import scipy.ndimage # pyflakes gives error, but this is needed
 import subprocess
-import os
 import os.path
-import sys
 import random
-import time
+import math
+import errno
+import hashlib
+import zlib
+import struct
+import shutil
+import select
+import multiprocessing
+import threading
+import collections
+import heapq
+import bisect
+from multiprocessing.pool import ThreadPool
+try:
+    import fcntl # not on Windows, where a shared index file is not locked
+except ImportError:
+    fcntl = None
 try:
     from PIL import Image
 except ImportError:
@@ -97,7 +262,19 @@ if system_os == "Windows":
     windows_release = platform.release()
     yx_primary_window_origin = () # global tuple, set by get_display_info_windows()
 elif system_os == "Linux":
-    linux_version = platform.linux_distribution()
+    try:
+        linux_version = platform.linux_distribution()
+    except AttributeError: # removed in Python 3.8
+        linux_version = platform.platform()
+
+command_env = None # environment for the programs run, set for each resident command
+
+
+def command_environment():
+    """Return the environment to run other programs (such as xrandr) in.  This
+    is the environment of the client whose command the resident program is
+    running, and otherwise the environment of this program."""
+    return os.environ if command_env is None else command_env
 
 #
 # Set up some basic image-processing stuff.
@@ -249,9 +426,11 @@ class SelfFlushingOutstream(object):
 
 
 def parse_command_line_arguments(argparse_parser, help_string_replacement_pairs=(),
-                              init_indent=5, subs_indent=5, line_width=76):
+                              init_indent=5, subs_indent=5, line_width=76,
+                              argv=None):
     """Main routine to call to execute the command-line parsing.  Returns an
-    object from argparse's parse_args() routine."""
+    object from argparse's parse_args() routine.  The arguments in the list
+    argv are parsed, or those of the program if it is None."""
     # Redirect stdout and stderr to prettify help or usage output from argparse.
     old_stdout = sys.stdout # save stdout
     old_stderr = sys.stderr # save stderr
@@ -263,7 +442,7 @@ def parse_command_line_arguments(argparse_parser, help_string_replacement_pairs=
         line_width) # redirect stderr to add postprocessor
 
     # Run the actual argument-parsing operation via argparse.
-    args = argparse_parser.parse_args()
+    args = argparse_parser.parse_args(argv)
 
     # The argparse class has finished its argument-processing, so now no more
     # usage or help messages will be printed.  So restore stdout and stderr
@@ -368,7 +547,9 @@ parser.add_argument("-1", "--oneimage", action="store_true", help="""
 
    Use a single background image, scaled to stretch over all the displays.
    This is currently based on the screen resolutions, not the physical sizes of
-   the monitors (dpi).^^n""")
+   the monitors (dpi).  Only the parts of the image which fall on a display
+   are computed; any gaps between the displays are set to the '--colorfill'
+   color (black by default).^^n""")
 
 parser.add_argument("-f", "--fitimage", nargs=3, type=int,
                     metavar=("R_VAL", "G_VAL", "B_VAL"), help="""
@@ -387,9 +568,110 @@ parser.add_argument("-t", "--timedelay", nargs=1, type=float, metavar="MINUTES",
    it will collect the current display information, re-select images for each
    display, create a combined image, and set it as the background (assuming
    that behavior is not modified by any other options).  The floating point
-   argument gives the number of minutes to sleep between iterations.  The image
+   argument gives the number of minutes between the starts of the iterations,
+   so the time taken to make an image does not add to it.  The image
    list will only be reloaded when it becomes empty, so every image will be
-   used exactly once before any images are reloaded.^^n""")
+   used exactly once before any images are reloaded.  While looping, the image
+   directories are watched (with inotify on Linux, otherwise by checking the
+   directories on each iteration) and image files which are added, changed,
+   or deleted are added to or removed from the current list right away.  On
+   Linux the displays are also watched with RandR events from the X server,
+   when that is possible, and then a new image is made as soon as the display
+   layout changes, without waiting for the rest of the sleep time.^^n""")
+
+parser.add_argument("--control", nargs=1, metavar="SOCKET_PATH", help="""
+
+   Only used with '--timedelay', and not on Windows.  Listen for commands on a
+   Unix-domain socket with this pathname, so that the running program can be
+   controlled without restarting it (and losing its warm caches).  Each
+   command is one line, and one line is sent back which starts with 'ok' or
+   'error'.  The commands are 'next' (make a new image now), 'pause' and
+   'resume' (stop and restart the timer), 'reload' (reload the list of image
+   files before the next image), 'interval MINUTES' (change the time between
+   images), 'status', and 'quit'.  For example,
+   'echo next | socat - UNIX-CONNECT:SOCKET_PATH'.^^n""")
+
+parser.add_argument("--resident", action="store_true", help="""
+
+   Hand the command over to a resident copy of this program which is kept
+   running for the user, and exit when it has applied the background (with
+   its exit status and output).  The first such command starts the resident
+   program.  After that the commands skip the startup time of the program,
+   and the resident program keeps its imports, worker threads, image list,
+   and caches warm between them, and renders the next image for the last
+   command ahead of time.  This is meant for commands which are run often,
+   such as a hotkey for the next background.  The relative pathnames in the
+   command are taken relative to the current directory of the command.  It
+   is not used with '--timedelay' (use '--control' instead), and it is
+   ignored where there are no Unix-domain sockets.  The resident program is
+   stopped with 'makeSpanningBackground.py --stopresident' (with no other
+   arguments).^^n""")
+
+parser.add_argument("--service", nargs=1, metavar="SOCKET_PATH", help="""
+
+   Send the command to the render service listening on the Unix-domain socket
+   with this pathname, and exit when it has written the output file (with its
+   exit status and output).  The service is started separately with
+   'makeSpanningBackground.py --serve SOCKET_PATH' (see 'makeSpanningBackground.py
+   --serve --help'), and it makes the images for many commands with different
+   display layouts at once, sharing its caches between them.  This is meant for
+   making the backgrounds of many seats (such as thin clients) from one image
+   library, in place of running a separate program for each one.  The
+   '--reslist' option must be set, to give the display layout, and the image is
+   not set as the background of this display (as with '--dontapply').  The
+   relative pathnames in the command are taken relative to the current
+   directory of the command.  It cannot be used with '--timedelay'.^^n""")
+
+parser.add_argument("--tenant", nargs=1, metavar="NAME", help="""
+
+   Only used with '--service'.  The name of the tenant (such as the seat) that
+   the command is for.  The render service takes the waiting commands from the
+   tenants in turn, so a tenant with many commands cannot hold up the others.
+   All the commands of a tenant are run by the same worker process, which
+   keeps a separate image list for each tenant, so that sampling is without
+   replacement for each one (for the most recently seen tenants, up to 64 for
+   each process).  The default is the user name.^^n""")
+
+parser.add_argument("--prefetch", action="store_true", help="""
+
+   Only used with '--timedelay'.  While sleeping between iterations, select
+   and render the next combined image in the background at a lowered
+   priority, so that when the time comes it only needs to be moved into
+   place.  The image is written to a temporary file next to the output file.
+   If the display layout changes in the meantime the prefetched image is
+   thrown away and a new one is made.^^n""")
+
+parser.add_argument("--layouts", nargs=1, type=int, metavar="NUM_LAYOUTS",
+                    help="""
+
+   Only used with '--timedelay', and implies '--prefetch'.  Remember this many
+   of the most recently seen display layouts (such as a laptop on its own and
+   in its docking station) and keep a ready-made combined image for each of
+   them, rendered in the background while sleeping.  When the displays change
+   to one of those layouts the image for it is just moved into place, and a
+   new one is made for the next time.  An unknown layout is rendered as
+   usual.^^n""")
+
+parser.add_argument("--streamed", action="store_true", help="""
+
+   Compose and write the combined image in bands of rows, straight from the
+   scaled images for the displays, so that the whole combined image is never
+   held in memory.  This reduces the peak memory use for very large display
+   walls.  It is only used with '.png' output files (which are then written by
+   this program rather than by PIL), and not with '--rotate'.  A '.bmp' output
+   file is always composed directly in the file, without this option.^^n""")
+
+parser.add_argument("--rotate", nargs=1, type=int, metavar="NUM_DISPLAYS",
+                    help="""
+
+   Only used with '--timedelay'.  On each iteration after the first, only this
+   many of the displays get a new image, taking the displays in turn, and the
+   rest of the combined image is kept in memory.  With a '.bmp' output file
+   only the changed displays are rewritten, in a spare file (ending in
+   '.spare.bmp') kept next to it, which then replaces it.  This cuts the work
+   per iteration in proportion to the number of displays.  A complete new image is still made whenever the display
+   layout changes, and always with '--oneimage'.  The '--prefetch' and
+   '--layouts' options are ignored with this option.^^n""")
 
 parser.add_argument("-p", "--percenterror", nargs=1, type=float,
                     metavar="PCT_FLOAT", help="""
@@ -409,6 +691,26 @@ parser.add_argument("-z", "--zoomspline", nargs=1, type=int,
    higher orders have better quality.  (Also, for higher-quality images: output
    files in '.bmp' format are larger but tend to look better.)^^n""")
 
+parser.add_argument("--resampler", nargs=1, choices=["spline", "pillow", "box"],
+                    metavar="spline|pillow|box", help="""
+
+   Select the method used to resize (zoom) images.  The default 'spline' uses
+   the ndimage spline zoom, with the spline order set by '--zoomspline'.  The
+   'pillow' method uses the resize filters of PIL (Pillow), which are usually
+   faster and antialias well when shrinking images; the '--zoomspline' value
+   then selects the filter, from 0 (nearest neighbor) through 1 (bilinear), 2
+   (Hamming), and 3 (bicubic) to 4 or 5 (Lanczos).  The 'box' method first
+   shrinks large images by averaging blocks of pixels over any integer factor
+   and then does the remaining zoom with the spline method; it is fast and
+   avoids aliasing when images are much larger than the displays.^^n""")
+
+parser.add_argument("--workers", nargs=1, type=int, metavar="NUM_THREADS", help="""
+
+   The maximum number of worker threads used to decode and scale the images
+   for the different displays at the same time.  The default is the number
+   of CPUs.  Set it to 1 to do all the work in a single thread, such as when
+   limiting the CPU use of the program with 'nice' or 'cpulimit'.^^n""")
+
 parser.add_argument("-s", "--sequential", action="store_true", help="""
 
    Process images sequentially as listed in the positional arguments, with the
@@ -477,7 +779,39 @@ parser.add_argument("-L", "--logcurrent", nargs=1, metavar="FNAME", help="""
 
    Write the names of the current images to a file.  The single argument is the
    name of the file to write the filenames to.  Useful when you want to know
-   the filenames of the images being displayed.""")
+   the filenames of the images being displayed.^^n""")
+
+parser.add_argument("--cachedir", nargs=1, metavar="DIRNAME", help="""
+
+   A directory in which to keep persistent cache files between runs of the
+   program.  It will be created if it does not exist.  Currently this holds an
+   index of the image directories and of the sizes of the image files, so that
+   reloading the image list only rescans directories which have changed and
+   only reads the headers of new or modified image files.  This speeds up
+   reloads of large image libraries, especially on network storage.  With the
+   '--tilecache' option it also holds the cached scaled images.^^n""")
+
+parser.add_argument("--makepyramids", action="store_true", help="""
+
+   Instead of making a background image, pre-generate downsampled copies of
+   all the images (at 1/2, 1/4, and 1/8 of the full size) in the 'pyramids'
+   subdirectory of the '--cachedir' directory, which must also be set, and
+   then exit.  This can be run offline, such as from cron.  When making a
+   background with '--cachedir' set, the smallest copy which is still at least
+   the scaled size is then used in place of the full image.  This greatly
+   speeds up the scaling of very large images, at the cost of disk space
+   (about a third of the uncompressed size of each image).  Only files which
+   are new or changed are processed on later runs.  The '--outfile' option is
+   still required, but nothing is written to that file.^^n""")
+
+parser.add_argument("--tilecache", nargs=1, type=float, metavar="MEGABYTES",
+                    help="""
+
+   Keep up to this many megabytes of scaled images (one per image and display
+   size) in the 'tiles' subdirectory of the '--cachedir' directory, which must
+   also be set.  When an image comes around again on a display with the same
+   size, with the same options, it is then neither decoded nor scaled.  The
+   least recently used images are deleted when the cache is full.^^n""")
 
 #
 # Define some prettifying modifications to the usual help output of argparse.
@@ -497,6 +831,60 @@ help_string_replacement_pairs = (
     (prog_name + ": error:", "Error in "+prog_name+":")
 )
 
+#
+# The arguments of the render service, which is started with '--serve' as the
+# first argument.
+#
+
+serve_parser = argparse.ArgumentParser(
+    prog=prog_name + " --serve",
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    description="""
+Description:
+
+^^f
+   Run a render service, which makes the combined background images for the
+   commands sent to it with the '--service' option until it is killed.  Each
+   command gives its own display layout (with '--reslist'), image files and
+   directories, options, and output file.  The commands are run on a pool of
+   worker processes, with the waiting commands taken from the tenants (see the
+   '--tenant' option) in turn.  The processes keep their imports, image lists,
+   and caches warm between commands, and the cache directory is shared by all
+   of them, so an image scaled for one seat is reused for every other seat
+   with the same display size, and the image directories are indexed only
+   once.  The render service requires Python 3.7 or higher.
+^^f
+""")
+
+serve_parser.add_argument("socket_path", metavar="SOCKET_PATH", help="""
+
+   The pathname of the Unix-domain socket to listen on.  Only the user running
+   the service can connect to it.^^n""")
+
+serve_parser.add_argument("--processes", nargs=1, type=int,
+                          metavar="NUM_PROCESSES", help="""
+
+   The number of worker processes, which is also the most commands run at
+   once.  Each tenant is assigned to one of the processes when it is first
+   seen, so the commands of a single tenant are run one at a time.  The
+   default is the number of CPUs.  Each command uses one worker thread unless
+   it sets the '--workers' option.^^n""")
+
+serve_parser.add_argument("--cachedir", nargs=1, metavar="DIRNAME", help="""
+
+   The '--cachedir' option to use for the commands which do not set their own.
+   Setting it is recommended, so that the caches are shared.^^n""")
+
+serve_parser.add_argument("--tilecache", nargs=1, type=float,
+                          metavar="MEGABYTES", help="""
+
+   The '--tilecache' option to use for the commands which do not set their
+   own.^^n""")
+
+serve_parser.add_argument("-v", "--verbose", action="store_true", help="""
+
+   Print information about the commands as they are queued and finished.^^n""")
+
 
 #
 # Functions which do the real work.
@@ -554,7 +942,8 @@ def get_display_info_linux():
     # that section.
 
     try:
-        output = subprocess.check_output("xrandr").decode("utf-8")
+        output = subprocess.check_output("xrandr", env=command_environment())
+        output = output.decode("utf-8")
     except OSError as e:
         print("\nError running the 'xrandr' program.  Be sure it is installed."
               "\nIf failures continue, try the '--reslist' option to explicitly"
@@ -677,9 +1066,417 @@ def get_display_info_windows():
     return tuple(display_res_list)
 
 
+class DisplayMonitor(object):
+    """Keep the current display layout (the tuple returned by
+    get_display_info) and notice when it changes.  This class polls, so the
+    display information is collected again every time the layout is asked
+    for and changes are only seen then.  The RandrDisplayMonitor subclass
+    instead gets change events from the X server, so the layout is only
+    collected again after an event, and its file descriptor can be selected
+    on to be told of changes right away."""
+
+    def __init__(self):
+        self.layout = None # the cached layout
+
+    def fileno(self):
+        """Return a file descriptor which becomes readable on layout-change
+        events, or None if changes are only found by polling."""
+        return None
+
+    def read_events(self):
+        """Consume any pending events and return True if the layout may have
+        changed since it was last read."""
+        return True
+
+    def read_layout(self):
+        """Collect the current display layout."""
+        return get_display_info()
+
+    def current_layout(self):
+        """Return the current display layout, collecting it again only if it
+        may have changed."""
+        if self.layout is None or self.read_events():
+            self.layout = self.read_layout()
+        return self.layout
+
+    def update(self):
+        """Consume any pending events and collect the layout again if it may
+        have changed.  Returns True if the layout changed."""
+        if not self.read_events():
+            return False
+        old_layout = self.layout
+        self.layout = self.read_layout()
+        return self.layout != old_layout
+
+    def close(self):
+        pass
+
+
+class RandrDisplayMonitor(DisplayMonitor):
+    """A DisplayMonitor which selects the RandR screen-change events on the
+    root window of the X server, using libX11 and libXrandr through ctypes.
+    The layout is still collected by parsing the output of xrandr, but only
+    when an event arrives."""
+
+    RRScreenChangeNotify = 0 # event numbers, relative to the RandR event base
+    RRNotify = 1
+    RRScreenChangeNotifyMask = 1 << 0
+    RRCrtcChangeNotifyMask = 1 << 1
+    RROutputChangeNotifyMask = 1 << 2
+
+    def __init__(self):
+        """Raises OSError if the libraries or the RandR extension are not
+        available, or the X display cannot be opened."""
+        import ctypes
+        import ctypes.util
+        self.ctypes = ctypes
+        xlib_name = ctypes.util.find_library("X11")
+        xrandr_name = ctypes.util.find_library("Xrandr")
+        if not xlib_name or not xrandr_name:
+            raise OSError(errno.ENOENT, "The libX11 or libXrandr library was not found")
+        self.xlib = ctypes.CDLL(xlib_name)
+        self.xrandr = ctypes.CDLL(xrandr_name)
+        self.xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        self.xlib.XOpenDisplay.restype = ctypes.c_void_p
+        for func_name in ["XCloseDisplay", "XConnectionNumber", "XPending", "XFlush"]:
+            getattr(self.xlib, func_name).argtypes = [ctypes.c_void_p]
+        self.xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        self.xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+        self.xlib.XNextEvent.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        self.xrandr.XRRQueryExtension.argtypes = [ctypes.c_void_p,
+                ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int)]
+        self.xrandr.XRRSelectInput.argtypes = [ctypes.c_void_p, ctypes.c_ulong,
+                                               ctypes.c_int]
+        self.xrandr.XRRUpdateConfiguration.argtypes = [ctypes.c_void_p]
+
+        display_name = command_environment().get("DISPLAY")
+        self.display = self.xlib.XOpenDisplay(
+                display_name.encode("utf-8") if display_name else None)
+        if not self.display:
+            raise OSError(errno.ENXIO, "Could not open the X display")
+        event_base = ctypes.c_int()
+        error_base = ctypes.c_int()
+        if not self.xrandr.XRRQueryExtension(self.display, ctypes.byref(event_base),
+                                             ctypes.byref(error_base)):
+            self.close()
+            raise OSError(errno.ENOSYS, "The X server has no RandR extension")
+        self.event_base = event_base.value
+        self.xrandr.XRRSelectInput(self.display,
+                                   self.xlib.XDefaultRootWindow(self.display),
+                                   self.RRScreenChangeNotifyMask |
+                                   self.RRCrtcChangeNotifyMask |
+                                   self.RROutputChangeNotifyMask)
+        self.xlib.XFlush(self.display)
+        # An XEvent is a union padded to 24 longs.
+        self.event = ctypes.create_string_buffer(24 * ctypes.sizeof(ctypes.c_long))
+        DisplayMonitor.__init__(self)
+
+    def fileno(self):
+        return self.xlib.XConnectionNumber(self.display)
+
+    def read_events(self):
+        changed = False
+        while self.xlib.XPending(self.display):
+            self.xlib.XNextEvent(self.display, self.event)
+            event_type = self.ctypes.c_int.from_buffer(self.event).value
+            if event_type == self.event_base + self.RRScreenChangeNotify:
+                self.xrandr.XRRUpdateConfiguration(self.event)
+                changed = True
+            elif event_type == self.event_base + self.RRNotify:
+                changed = True
+        return changed
+
+    def read_layout(self):
+        return get_display_info_linux()
+
+    def close(self):
+        if self.display:
+            self.xlib.XCloseDisplay(self.display)
+            self.display = None
+
+
+class FakeDisplayMonitor(DisplayMonitor):
+    """A DisplayMonitor whose layout changes are posted by calling
+    post_layout, for testing the handling of layout changes without an X
+    server.  The changes are signaled through a pipe, so they can be selected
+    on just like real events."""
+
+    def __init__(self, layout):
+        self.posted_layout = tuple(tuple(d) for d in layout)
+        self.read_fd, self.write_fd = os.pipe()
+        DisplayMonitor.__init__(self)
+
+    def post_layout(self, layout):
+        """Change the layout to layout (a sequence of (y, x, yOffset, xOffset)
+        display tuples) and signal the change event."""
+        self.posted_layout = tuple(tuple(d) for d in layout)
+        os.write(self.write_fd, b"x")
+
+    def fileno(self):
+        return self.read_fd
+
+    def read_events(self):
+        changed = False
+        while select.select([self.read_fd], [], [], 0)[0]:
+            os.read(self.read_fd, 4096)
+            changed = True
+        return changed
+
+    def read_layout(self):
+        return self.posted_layout
+
+    def close(self):
+        if self.read_fd >= 0:
+            os.close(self.read_fd)
+            os.close(self.write_fd)
+            self.read_fd = self.write_fd = -1
+
+
+def make_display_monitor():
+    """Return a RandrDisplayMonitor if possible, otherwise a polling
+    DisplayMonitor.  The layout set with '--reslist' never changes, so it is
+    never watched."""
+    if system_os == "Linux" and not args.reslist:
+        try:
+            return RandrDisplayMonitor()
+        except (OSError, AttributeError) as e: # AttributeError if a function is missing
+            if args.verbose:
+                print("Could not watch the displays for RandR events, running"
+                      " xrandr on each iteration instead.\nThe reported error"
+                      " was:", e)
+    return DisplayMonitor()
+
+
+class ImageIndex(object):
+    """An index of the image directories and of the metadata of the image files
+    in them.  For each directory the modification time, the time it was
+    listed, and the sorted lists of filenames and subdirectory names are
+    saved, so an unchanged directory does not need to be listed again.  For each image file the size, modification
+    time, image dimensions, and whether or not it could be read as an image
+    are saved, so the file header only needs to be read again if the file
+    changes.  If index_path is set the index is loaded from that file and can
+    be saved back to it (as JSON), so that it persists between runs.  The
+    file can be shared by several programs at once (such as the worker
+    processes of the render service), so only the entries changed by this
+    program are written over the ones saved by the others."""
+
+    index_version = 3 # change when the saved format changes
+    # The coarsest resolution of the modification times of the filesystems
+    # (two seconds, on FAT), in seconds.
+    mtime_resolution = 2.0
+
+    def __init__(self, index_path=None):
+        """The index is kept only in memory if index_path is None."""
+        self.index_path = index_path
+        self.dirs = {} # dirpath -> [mtime, image filenames, dirnames, listing time]
+        self.files = {} # path -> [size, mtime, y, x, readable]
+        self.changed_dirs = set() # the dirpaths changed since the last save
+        self.changed_files = set() # the file paths changed since the last save
+        if index_path and os.path.exists(index_path):
+            self.dirs, self.files = self.load()
+
+    def load(self, warn=True):
+        """Load the index from the file self.index_path and return its dicts
+        of directories and of files.  A missing or corrupted index file is not
+        an error; the index just starts out empty (with a warning if warn is
+        true)."""
+        try:
+            with open(self.index_path, "r") as index_file:
+                saved_index = json.load(index_file)
+            if saved_index.get("version") != self.index_version:
+                raise ValueError("The index file has an old format.")
+            if not (isinstance(saved_index["dirs"], dict)
+                    and isinstance(saved_index["files"], dict)):
+                raise ValueError("The index file is corrupted.")
+            return saved_index["dirs"], saved_index["files"]
+        except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            if warn and os.path.exists(self.index_path):
+                print("\nWarning from makeSpanningBackground: Could not read the image"
+                      "\nindex file\n   " + self.index_path + "\nStarting a new"
+                      " index.  The reported error was:\n", e, file=sys.stderr)
+            return {}, {}
+
+    def save(self):
+        """Save the index to the file self.index_path, if there is one and the
+        index has changed.  While the file is locked, the index saved in it
+        (by another program sharing it, since this one loaded it) is read
+        again and merged in, with the entries changed by this program taking
+        precedence, so that the entries of the other programs are not lost.
+        The file is written under a temporary name and then renamed, so an
+        interrupted save cannot corrupt the old index."""
+        if not self.index_path or not (self.changed_dirs or self.changed_files):
+            return
+        # The scanning threads can change the index meanwhile, so only the
+        # changes seen now are marked as saved.
+        changed_dirs, changed_files = set(self.changed_dirs), set(self.changed_files)
+        lock_file = None
+        try:
+            lock_file = open(self.index_path + ".lock", "a")
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            saved_dirs, saved_files = self.load(warn=False)
+            for dirpath, entry in saved_dirs.items():
+                if dirpath not in changed_dirs:
+                    self.dirs[dirpath] = entry
+            for path, entry in saved_files.items():
+                if path not in changed_files:
+                    self.files[path] = entry
+            tmp_path = temp_file_name(self.index_path)
+            with open(tmp_path, "w") as index_file:
+                json.dump({"version": self.index_version, "dirs": dict(self.dirs),
+                           "files": dict(self.files)}, index_file)
+            replace_file(tmp_path, self.index_path)
+            self.changed_dirs -= changed_dirs
+            self.changed_files -= changed_files
+        except (IOError, OSError) as e:
+            print("\nWarning from makeSpanningBackground: Could not save the image"
+                  "\nindex file\n   " + self.index_path +
+                  "\nThe reported error was:\n", e, file=sys.stderr)
+        finally:
+            if lock_file:
+                lock_file.close() # this releases the lock
+
+    def list_directory(self, dirpath):
+        """Return a 3-tuple of the alphabetically sorted image filenames in
+        directory dirpath, the sorted subdirectory names, and a boolean which
+        is True if the directory changed since it was last listed.  Only a stat
+        is done when the directory is unchanged.  A directory which was listed
+        within the resolution of the modification times after it was last
+        modified is listed again, since it could have changed again after the
+        listing without a change of its modification time.  Names without an image suffix
+        are dropped before any paths are built.  Like os.walk, symlinks to
+        directories count as directories and unreadable directories are
+        treated as empty.  This is called from the scanning threads."""
+        try:
+            dir_mtime = os.stat(dirpath).st_mtime
+        except OSError:
+            return [], [], True
+        cached = self.dirs.get(dirpath)
+        if (cached and cached[0] == dir_mtime
+                and cached[3] - dir_mtime > self.mtime_resolution):
+            return cached[1], cached[2], False
+        listing_time = time.time() # before the listing, so any later change is seen
+        filenames = []
+        dirnames = []
+        try:
+            if hasattr(os, "scandir"): # Python 3.5 and higher
+                for entry in os.scandir(dirpath):
+                    if entry.is_dir():
+                        dirnames.append(entry.name)
+                    elif name_has_image_suffix(entry.name):
+                        filenames.append(entry.name)
+            else:
+                for name in os.listdir(dirpath):
+                    if os.path.isdir(os.path.join(dirpath, name)):
+                        dirnames.append(name)
+                    elif name_has_image_suffix(name):
+                        filenames.append(name)
+        except OSError:
+            return [], [], True
+        filenames.sort()
+        dirnames.sort()
+        changed = not (cached and cached[0] == dir_mtime and cached[1] == filenames
+                       and cached[2] == dirnames)
+        self.dirs[dirpath] = [dir_mtime, filenames, dirnames, listing_time]
+        self.changed_dirs.add(dirpath)
+        return filenames, dirnames, changed
+
+    def image_size(self, path):
+        """Return the (y, x) size of the image file path, reading the file
+        header only if the file is new or has been modified.  Raises IOError if
+        the file cannot be read as an image."""
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            raise IOError(str(e))
+        entry = self.files.get(path)
+        if not (entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime):
+            try:
+                y, x = probe_image_size(path)
+                entry = [stat.st_size, stat.st_mtime, y, x, True]
+            except IOError:
+                entry = [stat.st_size, stat.st_mtime, 0, 0, False]
+            self.files[path] = entry
+            self.changed_files.add(path)
+        if not entry[4]:
+            raise IOError("File is not a readable image.")
+        return (entry[2], entry[3])
+
+    def mark_unreadable(self, path):
+        """Record that the file path could not be decoded as an image."""
+        entry = self.files.get(path)
+        if entry:
+            if entry[4]:
+                entry[4] = False
+                self.changed_files.add(path)
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        self.files[path] = [stat.st_size, stat.st_mtime, 0, 0, False]
+        self.changed_files.add(path)
+
+    def is_unreadable(self, path):
+        """Return True if the file path is known not to be a readable image,
+        and has not changed since.  Only files marked as unreadable are
+        stat-ed."""
+        entry = self.files.get(path)
+        if not entry or entry[4]:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return True
+        return entry[0] == stat.st_size and entry[1] == stat.st_mtime
+
+
+image_index = ImageIndex() # global index, replaced by a persistent one if --cachedir
+
+
+scan_threads = 8 # number of threads for listing directories in parallel
+scan_pool = None # the thread pool, created when first needed
+
+
+def walk_image_dir(top_dirpath):
+    """Return a list of the full paths of all the image files in directory
+    top_dirpath, in alphabetical order.  If '--recursive' is set the files in
+    subdirectories follow (in alphabetical order) in the same order as a
+    top-down os.walk.  Each level of the tree is listed with all of its sibling
+    directories listed in parallel threads (the listing is I/O bound, so this
+    helps most on network storage), and the files are then collected in
+    order from the listings."""
+    global scan_pool
+    listings = {} # dirpath -> (filenames, dirnames)
+    level = [top_dirpath]
+    while level:
+        if len(level) > 1:
+            if scan_pool is None:
+                scan_pool = ThreadPool(scan_threads)
+            level_listings = scan_pool.map(image_index.list_directory, level)
+        else:
+            level_listings = [image_index.list_directory(level[0])]
+        next_level = []
+        for dirpath, (filenames, dirnames, changed) in zip(level, level_listings):
+            listings[dirpath] = (filenames, dirnames)
+            if args.recursive:
+                next_level += [os.path.join(dirpath, d) for d in dirnames]
+        level = [d for d in next_level if d not in listings]
+
+    def collect_files(dirpath):
+        filenames, dirnames = listings[dirpath]
+        files_in_dir = [os.path.join(dirpath, f) for f in filenames]
+        if args.recursive:
+            for dirname in dirnames:
+                files_in_dir += collect_files(os.path.join(dirpath, dirname))
+        return files_in_dir
+    return collect_files(top_dirpath)
+
+
 def reload_background_files():
     """Return the list of paths corresponding to args.image_files_and_dirs
-    relative to the current state of the filesystem."""
+    relative to the current state of the filesystem, leaving out the files
+    known to be unreadable."""
     all_background_files = []
     for image_path in args.image_files_and_dirs:
         image_path = process_path(image_path) # tilde expand the path
@@ -690,111 +1487,1028 @@ def reload_background_files():
 
         # Handle directories of images.
         if os.path.isdir(image_path):
-            for dirpath, dirnames, filenames in \
-                    os.walk(image_path, followlinks=True):
-                dirnames.sort() # alphabetical recurse
-                filenames.sort() # alphabetical file ordering
-                files_in_dir = [os.path.join(dirpath, f) for f in filenames]
-                all_background_files += files_in_dir
-                if not args.recursive:
-                    break
+            all_background_files += walk_image_dir(image_path)
 
         # Handle individual image files (note symlinks are treated as files).
         elif os.path.isfile(image_path):
-            all_background_files.append(image_path)
+            if name_has_image_suffix(image_path):
+                all_background_files.append(image_path)
 
         # Ignore if neither file nor directory unless has image suffix.
         else:
             if name_has_image_suffix(image_path):
                 path_error_exit(image_path, "Not a file or a directory.")
 
-    # Remove non-image files from list and expand to full pathnames.
-    all_background_files = [process_path(f) for f in all_background_files
-                            if name_has_image_suffix(f)]
-    return all_background_files
+    # All the paths are already full pathnames with image suffixes, since they
+    # were built from the processed argument paths.  Files already found to
+    # be unreadable are left out, so a library with no readable images runs
+    # out of images rather than being reloaded forever.
+    return [f for f in all_background_files if not image_index.is_unreadable(f)]
+
+
+class ShuffleBag(object):
+    """A bag of items for sampling without replacement.  Items are kept in an
+    array, and in the default random mode a drawn item is swapped with the last
+    one and then popped, so draws and removals take constant time.  In
+    sequential mode the array order is kept, removed items are only marked as
+    removed, and a cursor is kept at the first remaining item, so draws from
+    the front also take (amortized) constant time.  Duplicate items are
+    allowed, and removing an item removes only one instance of it."""
+
+    def __init__(self, items=(), sequential=False):
+        """Create a bag containing the items in the sequence items, in sequential
+        mode if sequential is true."""
+        self.sequential = sequential
+        self.items = []
+        self.removed = [] # flags for the sequential mode, parallel to items
+        self.cursor = 0 # sequential mode index of the first remaining item
+        self.num_items = 0
+        self.indices = {} # item -> set of its indices in self.items
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return self.num_items
+
+    def __contains__(self, item):
+        return item in self.indices
+
+    def __iter__(self):
+        """Iterate over the remaining items (in order, in sequential mode)."""
+        if not self.sequential:
+            return iter(self.items[:])
+        return (self.items[i] for i in range(self.cursor, len(self.items))
+                if not self.removed[i])
+
+    def __getitem__(self, index):
+        """Return the remaining item at index, in random mode only."""
+        return self.items[index]
+
+    def add(self, item):
+        """Add an item to the bag (at the end, in sequential mode)."""
+        self.indices.setdefault(item, set()).add(len(self.items))
+        self.items.append(item)
+        if self.sequential:
+            self.removed.append(False)
+        self.num_items += 1
+
+    def draw(self):
+        """Remove and return a random item, or the first item in sequential
+        mode.  The bag must not be empty."""
+        if self.sequential:
+            index = self.cursor
+        else:
+            index = random.randint(0, self.num_items - 1)
+        item = self.items[index]
+        self.remove_index(index)
+        return item
+
+    def remove(self, item):
+        """Remove one instance of item from the bag, if it is in the bag."""
+        if item in self.indices:
+            self.remove_index(min(self.indices[item]))
+
+    def put_back(self, item):
+        """Put back an instance of item which was drawn from the bag.  In
+        sequential mode it goes back to its place in the order (so it is
+        drawn again next), if that is found before the cursor, and otherwise
+        it is added at the end."""
+        if self.sequential:
+            for index in range(self.cursor - 1, -1, -1):
+                if self.removed[index] and self.items[index] == item:
+                    self.removed[index] = False
+                    self.indices.setdefault(item, set()).add(index)
+                    self.num_items += 1
+                    self.cursor = index
+                    return
+        self.add(item)
+
+    def remove_index(self, index):
+        """Remove the item at index in the item array."""
+        item = self.items[index]
+        item_indices = self.indices[item]
+        item_indices.discard(index)
+        if not item_indices:
+            del self.indices[item]
+        self.num_items -= 1
+        if self.sequential:
+            self.removed[index] = True
+            while self.cursor < len(self.items) and self.removed[self.cursor]:
+                self.cursor += 1
+        else:
+            last_item = self.items.pop()
+            if index < len(self.items): # move the last item into the hole
+                self.items[index] = last_item
+                last_item_indices = self.indices[last_item]
+                last_item_indices.discard(len(self.items))
+                last_item_indices.add(index)
 
 
-all_background_files = [] # global list of all the background files specified
+background_bag = ShuffleBag() # global bag of all the background files specified
+
+
+def probe_image_size(filename):
+    """Return the (y, x) size of the image in the file filename.  Only the
+    file header is read; PIL does not decode the pixel data until it is
+    actually accessed.  Raises IOError if the file cannot be opened as an
+    image."""
+    fp = open(filename, "rb")
+    try:
+        im = Image.open(fp)
+        return (im.size[1], im.size[0])
+    finally:
+        fp.close()
+
+
+def probe_image_sizes(filenames):
+    """Return a list of the (y, x) sizes of the image files in the list
+    filenames, looked up in the global image index, with None for each file
+    which cannot be read as an image.  Like the directory listings in
+    walk_image_dir, the file headers are read in parallel threads."""
+    global scan_pool
+    def image_size(filename):
+        try:
+            return image_index.image_size(filename)
+        except IOError:
+            return None
+    if len(filenames) > 1:
+        if scan_pool is None:
+            scan_pool = ThreadPool(scan_threads)
+        return scan_pool.map(image_size, filenames)
+    return [image_size(f) for f in filenames]
+
+
+pillow_has_reduce = hasattr(Image.Image, "reduce") # reduce is in Pillow 7.0 and higher
+
+
+def read_image_file(filename, target_res=None):
+    """Decode the image in the file filename and return it as an RGB ndimage.
+    If target_res is set the image will later be scaled for a display with
+    that resolution, so the image is decoded at a reduced size when that size
+    is still at least as large as the scaled size (calculated as in
+    calculate_scaling).  JPEG files are decoded directly at the reduced size,
+    using the DCT scaling of draft mode, and any other large reduction is done
+    by an integer-factor reduce (box filter) before the array is created.  If
+    a pre-generated pyramid level of the image (see '--makepyramids') is
+    large enough it is read instead.  Raises IOError if the file cannot be
+    read as an image."""
+    # bg_image = sp.ndimage.imread(filename) # works
+    # bg_image = sp.misc.imread(filename) # works, too
+    #
+    # The below code is essentially taken directly from the definition
+    # of sp.ndimage.imread, except that we check the mode and convert
+    # to RGB if the mode is something else.  (Copying images in
+    # different modes to a common image file can cause problems.)
+    fp = open(filename, "rb")
+    try:
+        im = Image.open(fp)
+        if target_res:
+            yx_full = (im.size[1], im.size[0])
+            yx_min = calculate_scaling(yx_full, target_res, [target_res])[1]
+            # A very wide or tall image can be fitted to less than a pixel.
+            yx_min = (max(yx_min[0], 1), max(yx_min[1], 1))
+            if image_pyramids:
+                bg_image = image_pyramids.read_level(filename, yx_min)
+                if bg_image is not None:
+                    if args.verbose:
+                        print("Image of size", yx_full, "was read from the pyramid"
+                              " level of size", bg_image.shape[:2])
+                    return bg_image
+            if yx_min[0] < yx_full[0] and yx_min[1] < yx_full[1]:
+                im.draft("RGB", (yx_min[1], yx_min[0])) # no-op except for JPEG
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        if target_res and pillow_has_reduce:
+            reduce_factor = min(im.size[1] // yx_min[0], im.size[0] // yx_min[1])
+            if reduce_factor >= 2:
+                im = im.reduce(reduce_factor)
+        if target_res and args.verbose and (im.size[1], im.size[0]) != yx_full:
+            print("Image of size", yx_full, "was decoded at the reduced size",
+                  (im.size[1], im.size[0]))
+        bg_image = memmap_image_file(filename, im)
+        if bg_image is None:
+            bg_image = np.asarray(im) # read-only, which is all that is needed
+    except (ValueError, ZeroDivisionError) as e: # unexpected sizes or modes in PIL
+        raise IOError(str(e))
+    finally:
+        fp.close()
+    # if args.verbose:
+    #   print("debug image type, shape, dtype, mode: ",
+    #         type(bg_image), bg_image.shape, bg_image.dtype, bg_image.mode)
+    return bg_image
+
+
+def memmap_image_file(filename, im):
+    """Return a read-only ndimage which is a memory map of the pixels in the
+    file filename, if the PIL image im opened from it is stored as a single
+    block of uncompressed 24-bit RGB or BGR rows (such as BMP and binary PPM
+    files), and otherwise return None.  The pixels are then never decoded or
+    copied; the rows are only paged in as they are read by the scaling."""
+    tiles = getattr(im, "tile", None) # converted images have no tiles
+    if im.mode != "RGB" or not tiles or len(tiles) != 1:
+        return None
+    codec_name, extents, offset, codec_args = tiles[0][:4]
+    if codec_name != "raw" or tuple(extents) != (0, 0) + tuple(im.size):
+        return None
+    if not isinstance(codec_args, tuple):
+        codec_args = (codec_args,)
+    raw_mode, row_stride, orientation = (codec_args + (0, 1))[:3]
+    if raw_mode not in ("RGB", "BGR") or orientation not in (1, -1):
+        return None
+    x_size, y_size = im.size
+    row_stride = row_stride or x_size * 3
+    if row_stride < x_size * 3 or offset + y_size * row_stride > os.path.getsize(filename):
+        return None
+    rows = np.memmap(filename, np.uint8, "r", offset, (y_size, row_stride))
+    bg_image = rows[::orientation, :x_size*3].reshape(y_size, x_size, 3)
+    if raw_mode == "BGR":
+        bg_image = bg_image[:, :, ::-1]
+    return bg_image
+
+
+class ImagePyramids(object):
+    """Pre-downsampled copies of the images in the library, at 1/2, 1/4, and
+    1/8 of the full size, saved in a cache directory as .npy files.  These are
+    made offline (with '--makepyramids'), and when an image is later rendered
+    the smallest level which is still at least as large as the scaled size is
+    read instead of decoding and shrinking the full image.  The levels of an
+    image are keyed by a hash of its path, modification time, and size, so
+    the levels of a changed image are simply not found."""
+
+    level_factors = (2, 4, 8)
+    min_level_size = 64 # no levels are made with a side smaller than this
+
+    def __init__(self, pyramid_dir):
+        self.pyramid_dir = pyramid_dir
+        if not os.path.isdir(pyramid_dir):
+            os.makedirs(pyramid_dir)
+
+    def level_paths(self, filename):
+        """Return a list of (factor, pathname) pairs for the levels of the image
+        in the file filename.  Raises IOError if the file cannot be accessed."""
+        try:
+            stat = os.stat(filename)
+        except OSError as e:
+            raise IOError(str(e))
+        key = hashlib.sha1(json.dumps([filename, stat.st_mtime, stat.st_size])
+                           .encode("utf-8")).hexdigest()
+        return [(factor, os.path.join(self.pyramid_dir, key + "_" + str(factor) + ".npy"))
+                for factor in self.level_factors]
+
+    def existing_levels(self, filename):
+        """Return a list of the factors of the pyramid levels which have been
+        made for the image in the file filename.  Raises IOError if the file
+        cannot be accessed."""
+        return [factor for factor, path in self.level_paths(filename)
+                if os.path.exists(path)]
+
+    def read_level(self, filename, yx_min):
+        """Return the smallest pyramid level of the image in the file filename
+        which is at least yx_min in size, or None if there is no such level."""
+        for factor, path in reversed(self.level_paths(filename)):
+            if not os.path.exists(path):
+                continue
+            try:
+                level = np.load(path, mmap_mode="r") # only reads the header
+            except (IOError, OSError, ValueError):
+                continue
+            if level.shape[0] >= yx_min[0] and level.shape[1] >= yx_min[1]:
+                return np.array(level)
+        return None
+
+    def make_levels(self, filename):
+        """Make any missing pyramid levels for the image in the file filename.
+        Returns the number of levels written.  Raises IOError if the file
+        cannot be read as an image."""
+        level_paths = self.level_paths(filename)
+        if all(os.path.exists(path) for factor, path in level_paths):
+            return 0
+        image = read_image_file(filename)
+        num_written = 0
+        prev_factor = 1
+        for factor, path in level_paths:
+            shrink = factor // prev_factor
+            if min(image.shape[0], image.shape[1]) // shrink < self.min_level_size:
+                break
+            image = box_shrink(image, (shrink, shrink))
+            prev_factor = factor
+            if os.path.exists(path):
+                continue
+            tmp_path = temp_file_name(path)
+            try:
+                with open(tmp_path, "wb") as tmp_file:
+                    np.save(tmp_file, image)
+                replace_file(tmp_path, path)
+            except (IOError, OSError) as e:
+                print("\nWarning from makeSpanningBackground: Could not write the"
+                      "\npyramid level\n   " + path + "\nThe reported error was:\n",
+                      e, file=sys.stderr)
+                break
+            num_written += 1
+        return num_written
+
+
+image_pyramids = None # global ImagePyramids, used if the '--cachedir' option is set
+
+
+def make_all_pyramids():
+    """Make the pyramid levels for all the images in args.image_files_and_dirs,
+    on the worker threads, for the '--makepyramids' option."""
+    image_files = sorted(set(reload_background_files()))
+    if args.verbose:
+        print("Making the pyramid levels for", len(image_files), "image files.")
+    def make_levels(filename):
+        try:
+            num_written = image_pyramids.make_levels(filename)
+        except IOError:
+            print("\nWarning from makeSpanningBackground: The file\n   " +
+                  filename + "\ncannot be read as an image.  Ignoring it.",
+                  file=sys.stderr)
+            return 0
+        if args.verbose and num_written:
+            print("Wrote", num_written, "pyramid levels for\n   ", filename)
+        return num_written
+    total_written = sum(map_on_workers(make_levels, image_files))
+    if args.verbose:
+        print("\nWrote", total_written, "pyramid levels in total.")
+
+
+def acceptable_aspect_ranges(disp_res, disp_res_list, max_err_fraction):
+    """Return a list of (low, high) ranges of image aspect ratios (x size over
+    y size) for which the error fraction computed by calculate_scaling is at
+    most max_err_fraction, for the display with resolution disp_res.  This is
+    the same calculation done analytically, ignoring the rounding to integer
+    sizes, so values near the ends of the ranges still need to be checked
+    exactly.  The high end of a range can be infinite."""
+    e = max_err_fraction
+    disp_y, disp_x = disp_res[0], disp_res[1]
+    disp_aspect = disp_x / disp_y
+    if not args.oneimage:
+        # The error is 1 - min(a,d)/max(a,d) for image aspect a and display
+        # aspect d, in both the fill and the fit modes.
+        if e >= 1:
+            return [(0.0, float("inf"))]
+        return [(disp_aspect * (1-e), disp_aspect / (1-e))]
+
+    # In oneimage mode the error is the relative difference between the area
+    # of the scaled image and the total screen area.  The scaled area is
+    # disp_y**2 * a when the y size is fit exactly, and disp_x**2 / a when the
+    # x size is fit exactly.  Which one applies depends on the mode and on
+    # which side of the display aspect ratio the image aspect ratio falls.
+    total_screen_area = sum([d[0]*d[1] for d in disp_res_list])
+    low_area = total_screen_area * max(0.0, 1-e)
+    high_area = total_screen_area * (1+e)
+    y_fit_range = (low_area / disp_y**2, high_area / disp_y**2)
+    x_fit_range = (disp_x**2 / high_area,
+                   disp_x**2 / low_area if low_area > 0 else float("inf"))
+    if args.fitimage:
+        branches = [(x_fit_range, disp_aspect, float("inf")),
+                    (y_fit_range, 0.0, disp_aspect)]
+    else:
+        branches = [(y_fit_range, disp_aspect, float("inf")),
+                    (x_fit_range, 0.0, disp_aspect)]
+    ranges = []
+    for (low, high), branch_low, branch_high in branches:
+        low, high = max(low, branch_low), min(high, branch_high)
+        if low <= high:
+            ranges.append((low, high))
+    return ranges
+
+
+class AspectBuckets(object):
+    """The images available for selection, bucketed by the logarithm of their
+    aspect ratios.  This is used with '--percenterror' so that only images
+    which can fit the display are ever considered, rather than drawing random
+    images and rejecting the ones that do not fit.  Each image is identified
+    by its position in the original file list, so the order used by
+    '--sequential' is preserved.  Files listed more than once are bucketed
+    once for each listing, and a selected image is removed (sampling without
+    replacement).  Each bucket is a ShuffleBag of positions, which keeps its
+    own count, so a selection takes time proportional to the number of
+    buckets in the acceptable ranges rather than to the number of images.
+    The size of an image is only looked up (which reads the file header
+    unless it is in a persistent index) when the image is first drawn, so a
+    large library is never probed all at once.  Until then its position is
+    kept in a bag of the unbucketed images, which is drawn from along with
+    the candidate buckets, and when one is drawn a small batch of them is
+    probed in parallel threads and bucketed."""
+
+    bucket_width = 0.005 # width of a bucket in log(aspect ratio)
+    probe_batch_size = 8 # number of unbucketed images probed at a time
+
+    def __init__(self, background_files, sequential=False):
+        """Add the files in the list background_files, to be bucketed when they
+        are first drawn, using the global image index for their sizes.
+        Unreadable files are left out when they are found, with a warning.
+        The buckets are in sequential mode if sequential is true."""
+        self.sequential = sequential
+        self.filenames = [] # position -> filename
+        self.sizes = [] # position -> (y, x) size, or None if not bucketed yet
+        self.buckets = {} # bucket key -> ShuffleBag of positions
+        self.unbucketed = ShuffleBag(sequential=sequential) # positions not bucketed yet
+        self.positions = {} # filename -> set of its positions still available
+        self.drawn = {} # filename -> list of its selected positions, the last last
+        self.num_images = 0
+        for filename in background_files:
+            self.add_file(filename)
+
+    def __len__(self):
+        return self.num_images
+
+    def __contains__(self, filename):
+        return filename in self.positions
+
+    def add_file(self, filename):
+        """Add the file filename at a new position after all the others, to be
+        bucketed when it is first drawn."""
+        position = len(self.filenames)
+        self.filenames.append(filename)
+        self.sizes.append(None)
+        self.unbucketed.add(position)
+        self.positions.setdefault(filename, set()).add(position)
+        self.num_images += 1
+
+    def bucket_batch(self, position=None):
+        """Look up the sizes of the unbucketed image at position (or of the
+        next one drawn, if position is None) and of the next few unbucketed
+        images drawn after it (the following ones, in sequential mode), in
+        parallel threads, and bucket them.  Unreadable files are left out,
+        with a warning.  Returns the list of the positions which were
+        bucketed, in the order they were drawn."""
+        if position is None:
+            position = self.unbucketed.draw()
+        else:
+            self.unbucketed.remove(position)
+        batch = [position]
+        while self.unbucketed and len(batch) < self.probe_batch_size:
+            batch.append(self.unbucketed.draw())
+        bucketed = []
+        for position, yx_size in zip(batch, probe_image_sizes(
+                                     [self.filenames[p] for p in batch])):
+            if yx_size is None:
+                warn_unreadable_file(self.filenames[position])
+                self.forget(position)
+                continue
+            self.sizes[position] = yx_size
+            self.bucket(position).add(position)
+            bucketed.append(position)
+        return bucketed
+
+    def bucket(self, position):
+        """Return the bucket for the bucketed image at position, creating it if
+        it does not exist."""
+        yx_size = self.sizes[position]
+        key = self.bucket_key(yx_size[1] / yx_size[0])
+        if key not in self.buckets:
+            self.buckets[key] = ShuffleBag(sequential=self.sequential)
+        return self.buckets[key]
+
+    def remove_file(self, filename):
+        """Remove all the instances of the file filename, and forget any
+        selected ones."""
+        self.drawn.pop(filename, None)
+        for position in list(self.positions.get(filename, ())):
+            self.remove(position)
+
+    def bucket_key(self, aspect):
+        """Return the key of the bucket which holds aspect ratio aspect."""
+        return int(math.floor(math.log(aspect) / self.bucket_width))
+
+    def candidate_lists(self, aspect_ranges):
+        """Return a list of the buckets which hold the aspect ratios in the
+        ranges aspect_ranges.  The buckets are looked up directly by their
+        keys, or, when a range spans more keys than there are buckets, found
+        by going through the buckets.  The buckets at the ends of a range can
+        also hold images which are slightly out of it; those are rejected
+        when they are drawn."""
+        candidates = []
+        if not self.buckets:
+            return candidates
+        for low, high in aspect_ranges:
+            low_key = self.bucket_key(low) if low > 0 else min(self.buckets)
+            high_key = self.bucket_key(high) if high < float("inf") else max(self.buckets)
+            if high_key - low_key + 1 > len(self.buckets):
+                keys = [k for k in self.buckets if low_key <= k <= high_key]
+            else:
+                keys = [k for k in range(low_key, high_key+1) if k in self.buckets]
+            candidates.extend(self.buckets[key] for key in keys)
+        return candidates
+
+    def select(self, disp_res, disp_res_list, max_err_fraction):
+        """Select an image which fits the display with resolution disp_res with
+        an error fraction of at most max_err_fraction, and remove it.  Returns
+        a 3-tuple of the filename, the (y, x) size and the error fraction, or
+        None if no image fits."""
+        if not self.num_images:
+            return None
+
+        def err_fraction(position):
+            return calculate_scaling(self.sizes[position], disp_res, disp_res_list)[3]
+
+        def is_acceptable(position):
+            return err_fraction(position) <= max_err_fraction
+
+        aspect_ranges = acceptable_aspect_ranges(disp_res, disp_res_list,
+                                                 max_err_fraction)
+        # Extend the ranges by a bucket width for rounding in calculate_scaling.
+        pad = math.exp(self.bucket_width)
+        aspect_ranges = [(low / pad, high * pad) for low, high in aspect_ranges]
+
+        # The images in the buckets at the ends of the ranges are only checked
+        # when they are drawn, as are the middle ones, which can fail only due
+        # to rounding, so just skip any which fail.  The bags can be indexed in
+        # random mode and are iterated in ascending order in sequential mode.
+        if self.sequential:
+            position = self.select_first(self.candidate_lists(aspect_ranges),
+                                         is_acceptable)
+        else:
+            while True:
+                # An unbucketed image which is drawn is bucketed, along with a
+                # batch of others, and then the draw is made again.
+                position = self.select_random(
+                    self.candidate_lists(aspect_ranges) + [self.unbucketed],
+                    is_acceptable)
+                if position is None or self.sizes[position] is not None:
+                    break
+                self.bucket_batch(position)
+        if position is None:
+            return None
+        self.remove(position)
+        self.drawn.setdefault(self.filenames[position], []).append(position)
+        return (self.filenames[position], self.sizes[position], err_fraction(position))
+
+    def put_back(self, filename):
+        """Put back the last selected instance of the file filename, at its
+        position, so it can be selected again."""
+        drawn_positions = self.drawn.get(filename)
+        if not drawn_positions:
+            return
+        position = drawn_positions.pop()
+        if not drawn_positions:
+            del self.drawn[filename]
+        self.bucket(position).put_back(position)
+        self.positions.setdefault(filename, set()).add(position)
+        self.num_images += 1
+
+    def select_first(self, candidates, is_acceptable):
+        """Return the smallest position in the ascending bags candidates, or
+        else among the unbucketed images, for which is_acceptable is true, or
+        None if there is none.  The bags are merged lazily, with a cursor at
+        the head of each one, so only the positions before the selected one
+        are looked at.  In sequential mode the unbucketed images are bucketed
+        in order, so all of the bucketed positions come before the unbucketed
+        ones, and those only need to be bucketed when none of the bucketed
+        images is acceptable."""
+        for position in heapq.merge(*candidates):
+            if is_acceptable(position):
+                return position
+        while self.unbucketed:
+            for position in self.bucket_batch():
+                if is_acceptable(position):
+                    return position
+        return None
+
+    def select_random(self, candidates, is_acceptable):
+        """Return a random position from the lists candidates for which
+        is_acceptable is true, or None if there is none.  The positions of
+        unbucketed images are always returned, since their sizes are not yet
+        known.  The lengths of the lists are summed once, and the list holding
+        each drawn index is found with a binary search."""
+        ends = [] # the cumulative lengths of the lists
+        num_candidates = 0
+        for candidate in candidates:
+            num_candidates += len(candidate)
+            ends.append(num_candidates)
+        rejected = set()
+        while len(rejected) < num_candidates:
+            index = random.randint(0, num_candidates - 1)
+            list_index = bisect.bisect_right(ends, index)
+            candidate = candidates[list_index]
+            position = candidate[index - ends[list_index] + len(candidate)]
+            if position in rejected:
+                continue
+            if self.sizes[position] is None or is_acceptable(position):
+                return position
+            rejected.add(position)
+        return None
+
+    def remove(self, position):
+        """Remove the image at position from its bucket, or from the
+        unbucketed images."""
+        if self.sizes[position] is None:
+            self.unbucketed.remove(position)
+        else:
+            key = self.bucket_key(self.sizes[position][1] / self.sizes[position][0])
+            self.buckets[key].remove(position) # constant time
+            if not self.buckets[key]:
+                del self.buckets[key]
+        self.forget(position)
+
+    def forget(self, position):
+        """Forget the image at position, which is in no bucket."""
+        filename_positions = self.positions[self.filenames[position]]
+        filename_positions.discard(position)
+        if not filename_positions:
+            del self.positions[self.filenames[position]]
+        self.num_images -= 1
+
+
+aspect_buckets = AspectBuckets([]) # global buckets, used with '--percenterror'
+library_lock = threading.RLock() # held while the bag or buckets are changed
+
+
+warned_unreadable_files = set() # files already reported as unreadable
+
+
+def warn_unreadable_file(filename):
+    """Warn that the file filename cannot be read as an image, unless that
+    was already reported."""
+    if filename in warned_unreadable_files:
+        return
+    warned_unreadable_files.add(filename)
+    print("\nWarning from makeSpanningBackground: The file\n   " +
+          filename + "\ncannot be read as an image.  Ignoring it.",
+          file=sys.stderr)
+
+
+def get_next_fitting_image(disp_res, disp_res_list):
+    """Get the next background image when the '--percenterror' option is set.
+    This is like get_next_background_image, except that the images are
+    selected from the global aspect-ratio buckets, directly from those which
+    fit the display well enough."""
+    global aspect_buckets
+    max_err_fraction = args.percenterror[0] / 100
+    local_reset_done = False
+    while True:
+        selected = aspect_buckets.select(disp_res, disp_res_list, max_err_fraction)
+        if not selected:
+            if local_reset_done: # no files are suitable
+                return None
+            # reload the file list to search for a suitable image file
+            local_reset_done = True
+            aspect_buckets = AspectBuckets(reload_background_files(),
+                                           sequential=args.sequential)
+            if args.verbose:
+                print("Loading or reloading the list of image files."
+                      "\nFound", len(aspect_buckets), "image filenames.\n")
+            continue
+        selected_filename, yx_size, err_fraction = selected
+        if args.verbose:
+            print("Error percentage is " + str(round(err_fraction*100, 1))
+                  + "; accepting image\n   ", selected_filename, "\n")
+        return selected_filename
 
 
 def get_next_background_image(disp_res, disp_res_list):
     """Get the next background image from the user-specified list.  The selected
-    file is removed from the global list once it is selected, but only the
+    file is removed from the global bag once it is selected, but only the
     selected instance is removed (files can be listed multiple times as
-    arguments).  Returns a 2-tuple containing the filename of the file and the
-    image itself.  Always reloads the global list of filenames when the list
-    becomes empty.  Returns the empty tuple only when the global list has no
+    arguments).  Returns the filename of the file; the image itself is decoded
+    later, in create_giant_image.  Always reloads the global bag of filenames
+    when the bag becomes empty.  Returns None only when the global bag has no
     suitable filenames (such as when '--percenterror' is too low for the
     available images).  The display resolution argument disp_res is used to
     calculate the percent error in scaling when the '--percenterror' option is
     selected, and the list disp_res_list is used to calculate the error when the
     '--oneimage' option is selected."""
-    # Create a local list of indices to choose from, so we can remove bad
-    # candidate-images locally before finally modifying the global list.
-    global all_background_files # global list of background filenames
-    background_indices = list(range(len(all_background_files)))
-    local_reset_done = False
+    with library_lock: # the library watcher may change the bag meanwhile
+        return draw_background_image(disp_res, disp_res_list)
 
-    # Select a file from the list of files and try to open it; repeat if needed.
-    while True:
-        if not background_indices:
-            if local_reset_done: # return empty list, no files are suitable
-                return ()
-            else: # reload the file list to search for a suitable image file
-                local_reset_done = True
-                all_background_files = reload_background_files()
-                background_indices = list(range(len(all_background_files)))
-                if args.verbose:
-                    print("Loading or reloading the list of image files."
-                          "\nFound", len(all_background_files), "image filenames.\n")
-        if args.sequential:
-            file_index = background_indices.pop(0)
-        else:
-            file_index = background_indices.pop(
-                random.randint(0, len(background_indices) - 1))
-        selected_filename = all_background_files[file_index]
+
+def draw_background_image(disp_res, disp_res_list):
+    """Do the work of get_next_background_image, with the library lock held."""
+    if args.percenterror:
+        return get_next_fitting_image(disp_res, disp_res_list)
+
+    global background_bag
+
+    # Draw a file from the bag, reloading the bag if it is empty.  Any file
+    # which turns out not to be readable is dropped in create_giant_image.
+    if not background_bag:
+        background_bag = ShuffleBag(reload_background_files(),
+                                    sequential=args.sequential)
+        if args.verbose:
+            print("Loading or reloading the list of image files."
+                  "\nFound", len(background_bag), "image filenames.\n")
+        if not background_bag: # no files are suitable
+            return None
+    return background_bag.draw()
+
+
+def add_library_file(filename):
+    """Add the file filename to whichever of the global bag or the global
+    aspect buckets is in use, unless it is already there."""
+    if args.percenterror:
+        if filename not in aspect_buckets:
+            aspect_buckets.add_file(filename)
+    elif filename not in background_bag:
+        background_bag.add(filename)
+
+
+def reload_library():
+    """Reload the list of image files into a new global bag or new global
+    aspect buckets (whichever is in use), so that the library starts over."""
+    global background_bag, aspect_buckets
+    if args.percenterror:
+        aspect_buckets = AspectBuckets(reload_background_files(),
+                                       sequential=args.sequential)
+    else:
+        background_bag = ShuffleBag(reload_background_files(),
+                                    sequential=args.sequential)
+
+
+def current_library():
+    """Return whichever of the global bag or the global aspect buckets is in
+    use."""
+    return aspect_buckets if args.percenterror else background_bag
+
+
+def put_back_library_files(filenames, library):
+    """Put the files in the list filenames, which were drawn from library (as
+    returned by current_library), back into it, so that they are not skipped
+    for the rest of its cycle.  Nothing is done if library is no longer in
+    use, since a reloaded library already holds all of the files again.
+    Files which have been deleted in the meantime are left out."""
+    with library_lock:
+        if library is not current_library():
+            return
+        for filename in filenames:
+            if os.path.exists(filename):
+                library.put_back(filename)
+
+
+def remove_library_file(filename):
+    """Remove all instances of the file filename from whichever of the global
+    bag or the global aspect buckets is in use."""
+    if args.percenterror:
+        aspect_buckets.remove_file(filename)
+    else:
+        while filename in background_bag:
+            background_bag.remove(filename)
+
+
+def dir_mtime(dirpath):
+    """Return the modification time of the directory dirpath, or None if it
+    cannot be read."""
+    try:
+        return os.stat(dirpath).st_mtime
+    except OSError:
+        return None
+
+
+class LibraryWatcher(object):
+    """Watch the directories in args.image_files_and_dirs (and, with
+    '--recursive', their subdirectories) and apply any added, changed, or
+    removed image files to the global bag incrementally.  This class polls,
+    using the global image index, so on each update only a stat is done for
+    each unchanged directory.  The InotifyLibraryWatcher subclass instead gets
+    change notifications from the Linux kernel.  Files are added to the bag
+    only once, even if their directory is listed more than once.  The watcher
+    keeps the modification time of each directory when it last listed it, so
+    a change is found even if the directory was listed again in between for
+    some other reason (such as reloading the bag)."""
+
+    def __init__(self):
+        self.dir_files = {} # dirpath -> set of image filenames, for all watched dirs
+        # dirpath -> (mtime when listed, or None if unreadable, listing time)
+        self.dir_mtimes = {}
+        for image_path in args.image_files_and_dirs:
+            image_path = process_path(image_path)
+            if os.path.isdir(image_path):
+                self.watch_tree(image_path)
+
+    def watch_tree(self, dirpath):
+        """Start watching the directory dirpath (and its subdirectories, if
+        '--recursive' is set).  Returns a list of the image files found."""
+        if dirpath in self.dir_files:
+            return []
+        self.watch_dir(dirpath)
+        self.dir_mtimes[dirpath] = (dir_mtime(dirpath), time.time()) # before listing it
+        filenames, dirnames, changed = image_index.list_directory(dirpath)
+        self.dir_files[dirpath] = set(filenames)
+        found_files = [os.path.join(dirpath, f) for f in filenames]
+        if args.recursive:
+            for dirname in dirnames:
+                found_files += self.watch_tree(os.path.join(dirpath, dirname))
+        return found_files
+
+    def watch_dir(self, dirpath):
+        """Hook for subclasses to register a single directory."""
+        pass
+
+    def unwatch_dir(self, dirpath):
+        """Hook for subclasses to unregister a single directory."""
+        pass
+
+    def unwatch_tree(self, dirpath):
+        """Stop watching directory dirpath and any watched directories below it,
+        and remove all of their files from the bag."""
+        prefix = os.path.join(dirpath, "")
+        for watched in [d for d in self.dir_files if d == dirpath or d.startswith(prefix)]:
+            self.unwatch_dir(watched)
+            del self.dir_mtimes[watched]
+            for filename in self.dir_files.pop(watched):
+                self.file_removed(os.path.join(watched, filename))
+
+    def file_added(self, path):
+        if args.verbose:
+            print("Adding new or changed image file to the list:\n   ", path)
+        add_library_file(path)
+
+    def file_removed(self, path):
+        if args.verbose:
+            print("Removing deleted image file from the list:\n   ", path)
+        remove_library_file(path)
+
+    def update(self):
+        """Apply any changes in the watched directories to the global bag.
+        This can be called from any thread, since it holds the library lock."""
+        with library_lock:
+            self.apply_changes()
+
+    def apply_changes(self):
+        """Do the work of update; subclasses override this."""
+        for dirpath in list(self.dir_files):
+            if dirpath not in self.dir_files: # removed in this loop
+                continue
+            mtime = dir_mtime(dirpath)
+            listed_mtime, listing_time = self.dir_mtimes[dirpath]
+            # A directory listed within the resolution of the modification
+            # times after it was modified is listed again, as in ImageIndex.
+            if mtime == listed_mtime and (mtime is None or listing_time - mtime
+                                          > ImageIndex.mtime_resolution):
+                continue
+            self.dir_mtimes[dirpath] = (mtime, time.time())
+            filenames, dirnames, changed = image_index.list_directory(dirpath)
+            old_filenames = self.dir_files[dirpath]
+            new_filenames = set(filenames)
+            self.dir_files[dirpath] = new_filenames
+            for filename in sorted(new_filenames - old_filenames):
+                self.file_added(os.path.join(dirpath, filename))
+            for filename in sorted(old_filenames - new_filenames):
+                self.file_removed(os.path.join(dirpath, filename))
+            if args.recursive:
+                subdirs = set(os.path.join(dirpath, d) for d in dirnames)
+                for subdir in sorted(subdirs):
+                    for path in self.watch_tree(subdir):
+                        self.file_added(path)
+                for watched in list(self.dir_files):
+                    if os.path.dirname(watched) == dirpath and watched not in subdirs:
+                        self.unwatch_tree(watched)
+
+    def fileno(self):
+        """Return a file descriptor which becomes readable on changes, or None
+        if changes are only found by polling."""
+        return None
+
+    def close(self):
+        pass
+
+
+class InotifyLibraryWatcher(LibraryWatcher):
+    """A LibraryWatcher which uses the Linux inotify interface, through ctypes,
+    so that changes are applied without listing or stat-ing any directories.
+    If the kernel event queue overflows the watched directories are all
+    checked once by polling."""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    watch_mask = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+                  IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+    def __init__(self):
+        """Raises OSError if inotify is not available or the watch limit (in
+        /proc/sys/fs/inotify/max_user_watches) is too low for the library."""
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                                use_errno=True)
+        self.inotify_fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.inotify_fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.wd_to_dir = {}
+        self.dir_to_wd = {}
         try:
-            # bg_image = sp.ndimage.imread(selected_filename) # works
-            # bg_image = sp.misc.imread(selected_filename) # works, too
-            #
-            # The below code is essentially taken directly from the definition
-            # of sp.ndimage.imread, except that we check the mode and convert
-            # to RGB if the mode is something else.  (Copying images in
-            # different modes to a common image file can cause problems.)
-            fp = open(selected_filename, "rb")
-            im = Image.open(fp)
-            if im.mode != "RGB":
-                im = im.convert("RGB")
-            bg_image = np.array(im)
-            fp.close()
-            # if args.verbose:
-            #   print("debug image type, shape, dtype, mode: ",
-            #         type(bg_image), bg_image.shape, bg_image.dtype, bg_image.mode)
-        except IOError:
-            print("\nWarning from makeSpanningBackground: The file\n   " +
-                  selected_filename + "\ncannot be read as an image.  Ignoring it.",
-                  file=sys.stderr)
-            continue
-        # Now check for good enough fit (if that option was selected).
-        if args.percenterror:
-            err_fraction = calculate_scaling(bg_image, disp_res, disp_res_list)[3]
-            if err_fraction > args.percenterror[0] / 100:
+            LibraryWatcher.__init__(self)
+        except OSError:
+            self.close()
+            raise
+
+    def watch_dir(self, dirpath):
+        import ctypes
+        path_bytes = dirpath if isinstance(dirpath, bytes) else dirpath.encode(
+                                                    sys.getfilesystemencoding())
+        wd = self.libc.inotify_add_watch(self.inotify_fd, path_bytes, self.watch_mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise OSError(err, "Too many directories for the inotify watch limit")
+            return # directory went away or is unreadable; nothing to watch
+        self.wd_to_dir[wd] = dirpath
+        self.dir_to_wd[dirpath] = wd
+
+    def unwatch_dir(self, dirpath):
+        # The kernel then sends an IN_IGNORED event for the watch, which is
+        # when it is dropped from wd_to_dir.  This fails harmlessly if the
+        # directory is already gone, since the kernel has removed the watch.
+        wd = self.dir_to_wd.pop(dirpath, None)
+        if wd is not None:
+            self.libc.inotify_rm_watch(self.inotify_fd, wd)
+
+    def read_events(self):
+        """Return a list of the pending (wd, mask, name) events."""
+        events = []
+        while True:
+            try:
+                buf = os.read(self.inotify_fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not buf:
+                break
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, name_len = struct.unpack_from("iIII", buf, offset)
+                offset += 16
+                name = buf[offset:offset+name_len].rstrip(b"\0")
+                offset += name_len
+                if not isinstance(name, str): # Python 3
+                    name = name.decode(sys.getfilesystemencoding(), "surrogateescape")
+                events.append((wd, mask, name))
+        return events
+
+    def apply_changes(self):
+        for wd, mask, name in self.read_events():
+            if mask & self.IN_Q_OVERFLOW:
                 if args.verbose:
-                    print("Error percentage is " + str(round(err_fraction*100, 1))
-                          + "; rejecting image\n   ", selected_filename)
+                    print("The inotify event queue overflowed; checking all the"
+                          " image directories.")
+                LibraryWatcher.apply_changes(self)
                 continue
-            else:
-                if args.verbose:
-                    print("Error percentage is " + str(round(err_fraction*100, 1))
-                          + "; accepting image\n   ", selected_filename)
+            if mask & self.IN_IGNORED: # the watch was removed
+                dirpath = self.wd_to_dir.pop(wd, None)
+                if self.dir_to_wd.get(dirpath) == wd:
+                    del self.dir_to_wd[dirpath]
+                continue
+            dirpath = self.wd_to_dir.get(wd)
+            if dirpath is None or dirpath not in self.dir_files:
+                continue
+            if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                self.unwatch_tree(dirpath)
+                continue
+            path = os.path.join(dirpath, name)
+            if mask & self.IN_ISDIR:
+                if not args.recursive:
+                    continue
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    for found_path in self.watch_tree(path):
+                        self.file_added(found_path)
+                elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                    self.unwatch_tree(path)
+                continue
+            if not name_has_image_suffix(name):
+                continue
+            # Files are added when they are closed after writing, since they
+            # are incomplete when created.
+            if mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                self.dir_files[dirpath].add(name)
+                self.file_added(path)
+            elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                self.dir_files[dirpath].discard(name)
+                self.file_removed(path)
+
+    def fileno(self):
+        return self.inotify_fd
+
+    def close(self):
+        if self.inotify_fd >= 0:
+            os.close(self.inotify_fd)
+            self.inotify_fd = -1
+
+
+def make_library_watcher():
+    """Return an InotifyLibraryWatcher if possible, otherwise a polling
+    LibraryWatcher."""
+    if system_os == "Linux":
+        try:
+            return InotifyLibraryWatcher()
+        except (OSError, AttributeError) as e: # AttributeError if no inotify in libc
             if args.verbose:
-                print()
-
-        # Got a good file, delete it from the full list and exit the loop.
-        del all_background_files[file_index]
-        break
-
-    return (selected_filename, bg_image)
+                print("Could not use inotify to watch the image directories,"
+                      " polling instead.\nThe reported error was:", e)
+    return LibraryWatcher()
 
 
 def copy_subimage(yx_extents, from_image, yx_from_start, to_image, yx_to_start):
@@ -837,80 +2551,258 @@ def copy_subimage(yx_extents, from_image, yx_from_start, to_image, yx_to_start):
     return
 
 
-def correct_windows_origin(image):
-    """Map an image to conform to Windows conventions (negative positions and
-    tiled mode).  Uses the global variable yx_primary_window_origin to access the
-    translated origin (to be converted back to (0,0), with proper wraparound for
-    any negative pieces)."""
-
-    # imLowY = 0
-    im_high_y = image.shape[0]
-    # imLowX = 0
-    im_high_x = image.shape[1]
-    y0 = yx_primary_window_origin[0]
-    x0 = yx_primary_window_origin[1]
-
-    # create new giant image
-    new_image = np.empty_like(image) # empty, same size as image
-
-    # Note that the translated origin (y0,x0) breaks image into four pieces.
-    # We will copy each piece as a chunk, for efficiency.  We could use
-    # scipy.ndimage.interpolation.shift, with mode="wrap", except that we
-    # don't need interpolation.  Since the routine may not take that into
-    # account, this way is probably more efficient.
-
-    # top left piece of image
-    new_image[im_high_y-y0:im_high_y, im_high_x-x0:im_high_x] = \
-        image[0:y0, 0:x0]
-    # bottom right piece of image
-    new_image[0:im_high_y-y0, 0:im_high_x-x0] = \
-        image[y0:im_high_y, x0:im_high_x]
-    # bottom left piece of image
-    new_image[0:im_high_y - y0, im_high_x-x0:im_high_x] = \
-        image[y0:im_high_y, 0:x0]
-    # top right piece of image
-    new_image[im_high_y-y0:im_high_y, 0:im_high_x-x0] = \
-        image[0:y0, x0:im_high_x]
-
-    return new_image
-
-
-def scale_image(image, yx_new, zoom_spline):
+def exact_zoom_offset(start, zoom):
+    """Return an offset for sp.ndimage.affine_transform which, when divided by
+    zoom (as affine_transform does for a diagonal matrix), gives exactly the
+    integer start.  The output pixel positions then have exactly the same
+    floating point values as in a zoom of the whole image."""
+    offset = start * zoom
+    for i in range(64): # the product is normally exact after at most a few ulps
+        shift = offset / zoom
+        if shift == start:
+            break
+        offset = np.nextafter(offset, np.inf if shift < start else -np.inf)
+    return offset
+
+
+def scale_image(image, yx_new, zoom_spline, yx_from_start=(0, 0), yx_extents=None):
     """Perform an exact scaling of image, to the int-valued (y,x) sizes in
     yx_new.  Note that the aspect ratio is not considered here; it should be
-    (approximately) preserved in calculating yx_new if that is desired."""
+    (approximately) preserved in calculating yx_new if that is desired.  If
+    yx_extents is set then only the subimage of that size starting at
+    yx_from_start in the scaled image is computed and returned (clipped to the
+    scaled image), so no time is spent on pixels that are cropped away.  The
+    scaling is done by the resampler selected with '--resampler'."""
+    if yx_extents is None:
+        yx_extents = yx_new
+    return scale_image_windows(image, yx_new, zoom_spline,
+                               [(yx_from_start, yx_extents)])[0]
+
+
+def scale_image_windows(image, yx_new, zoom_spline, windows, outputs=None):
+    """Like scale_image, but computes several windows of the scaled image.
+    The argument windows is a list of (yx_from_start, yx_extents) pairs, and
+    the list of the corresponding subimages is returned.  Any work which
+    depends only on the image (such as the spline prefilter) is done once
+    for all the windows.  If outputs is set it is a list of destination
+    arrays, one per window (or None for a window), such as slices of the
+    giant image; each window is then clipped to the size of its destination
+    and scaled directly into it, and the returned subimage is a view of the
+    destination."""
     yx_curr = (image.shape[0], image.shape[1])
+    if outputs is None:
+        outputs = [None] * len(windows)
+    clipped_windows = []
+    clipped_outputs = []
+    for (yx_from_start, yx_extents), output in zip(windows, outputs):
+        yx_from_start = [min(max(0, yx_from_start[dim]), yx_new[dim])
+                         for dim in [0, 1]]
+        yx_extents = [min(yx_extents[dim], yx_new[dim] - yx_from_start[dim])
+                      for dim in [0, 1]]
+        if output is not None:
+            yx_extents = [min(yx_extents[dim], output.shape[dim]) for dim in [0, 1]]
+            output = output[:yx_extents[0], :yx_extents[1]]
+        clipped_windows.append((yx_from_start, yx_extents))
+        clipped_outputs.append(output)
     if yx_new == yx_curr:
         if args.verbose:
             print("Image is at the correct scale already, skipping the rescale.")
-        scaled_image = image
+        return crop_windows(image, clipped_windows, clipped_outputs)
+    if args.verbose:
+        for yx_from_start, yx_extents in clipped_windows:
+            if tuple(yx_extents) != tuple(yx_new):
+                print("Only computing the window of size", tuple(yx_extents),
+                      "at", tuple(yx_from_start), "in the scaled image.")
+    resampler = resamplers[resampler_name]
+    return resampler(image, yx_new, zoom_spline, clipped_windows, clipped_outputs)
+
+
+def crop_windows(image, windows, outputs):
+    """Return the list of the windows, given as (yx_from_start, yx_extents)
+    pairs, of image.  Each window with a destination array in the list
+    outputs is copied into it, and the others are returned as views of
+    image."""
+    cropped_images = []
+    for (yx_from_start, yx_extents), output in zip(windows, outputs):
+        cropped_image = image[yx_from_start[0]:yx_from_start[0]+yx_extents[0],
+                              yx_from_start[1]:yx_from_start[1]+yx_extents[1]]
+        if output is not None:
+            output[...] = cropped_image
+            cropped_image = output
+        cropped_images.append(cropped_image)
+    return cropped_images
+
+
+def resample_spline(image, yx_new, zoom_spline, windows, outputs):
+    """The 'spline' resampler.  Return the list of the windows, given as
+    (yx_from_start, yx_extents) pairs, of image scaled to the size yx_new,
+    using an ndimage spline of order zoom_spline.  Each window with a
+    destination array in the list outputs is computed directly in it.  The
+    result is identical to scaling the full image with
+    sp.ndimage.interpolation.zoom and then cropping it."""
+    yx_curr = (image.shape[0], image.shape[1])
+    # This computes the same pixel positions as
+    #    sp.ndimage.interpolation.zoom(image, (zoom_y, zoom_x, 1),
+    #                                  order=zoom_spline)
+    # where zoom_y = (yx_new[0]+1E-5)/yx_curr[0] and similarly for x, but
+    # it uses affine_transform with an offset to compute only the pixels
+    # in the window.  (The additive constant was needed because zoom
+    # truncates down to the nearest image size, e.g., truncating down to
+    # 767 instead of producing exactly the selected 768.)  Like zoom, the
+    # first and last pixels of the scaled image are aligned with the first
+    # and last pixels of the original image.
+    zoom = [(yx_curr[dim]-1) / (yx_new[dim]-1) if yx_new[dim] > 1 else 1.0
+            for dim in [0, 1]]
+    if args.verbose:
+        print("Scaling image with spline order", zoom_spline, "and "
+              "(zoom_y,zoom_x) =", (round(1/zoom[0], 4), round(1/zoom[1], 4)))
+
+    # The spline prefilter is done here, like in zoom, so it is always
+    # done on the whole image.
+    if zoom_spline > 1:
+        coeffs = spline_filter_bands(image, zoom_spline)
     else:
-        # Note zoom seems to truncate down to the nearest image size.  A small
-        # additive constant is used to avoid problems due to floating point
-        # precision and truncation (e.g., truncating down to 767 instead of
-        # producing exactly the selected 768) in ndimage.interpolation.zoom.
-        zoom_y = (yx_new[0]+1E-5)/yx_curr[0]
-        zoom_x = (yx_new[1]+1E-5)/yx_curr[1]
+        coeffs = image
+
+    # Each window is computed in bands of rows, on the worker threads when
+    # there are several (as for a single large image in '--oneimage' mode).
+    # Every band reads from the full array of coefficients, so the halo
+    # which each band needs is always there, and since each band's offset
+    # gives the exact same pixel positions the result is identical to
+    # computing the window in one call.
+    scaled_images = []
+    bands = []
+    for (yx_from_start, yx_extents), scaled_image in zip(windows, outputs):
+        if scaled_image is None:
+            scaled_image = np.empty((yx_extents[0], yx_extents[1], image.shape[2]),
+                                    np.uint8)
+        scaled_images.append(scaled_image)
+        bands += [(scaled_image, yx_from_start, band)
+                  for band in band_slices(yx_extents[0])]
+    def resample_band(band_info):
+        scaled_image, yx_from_start, band = band_info
+        offset = [exact_zoom_offset(yx_from_start[0] + band.start, zoom[0]),
+                  exact_zoom_offset(yx_from_start[1], zoom[1])]
+        sp.ndimage.affine_transform(
+            coeffs, np.array([zoom[0], zoom[1], 1.0]), offset=offset + [0.0],
+            output_shape=scaled_image[band].shape, output=scaled_image[band],
+            order=zoom_spline, prefilter=False)
+    map_on_workers(resample_band, bands)
+    return scaled_images
+
+
+def spline_filter_bands(image, zoom_spline):
+    """Return the float64 spline coefficients of image for a spline of order
+    zoom_spline, exactly as computed by sp.ndimage.spline_filter with
+    mode="constant".  That function applies a 1D filter along each axis in
+    turn, and each 1D filter is independent across the other axes, so the
+    image is split into bands across the filtered axis and the bands are
+    filtered on the worker threads."""
+    coeffs = np.empty(image.shape, np.float64)
+    source = image
+    for axis in range(image.ndim):
+        split_axis = 1 if axis == 0 else 0
+        def filter_band(band):
+            index = [slice(None)] * image.ndim
+            index[split_axis] = band
+            index = tuple(index)
+            try:
+                sp.ndimage.spline_filter1d(source[index], zoom_spline, axis,
+                                           output=coeffs[index], mode="constant")
+            except TypeError: # older SciPy versions have no mode argument
+                sp.ndimage.spline_filter1d(source[index], zoom_spline, axis,
+                                           output=coeffs[index])
+        map_on_workers(filter_band, band_slices(image.shape[split_axis]))
+        source = coeffs
+    return coeffs
+
+
+# The PIL resize filters selected by the '--zoomspline' values 0 to 5.
+pillow_resize_filters = [Image.NEAREST, Image.BILINEAR,
+                         getattr(Image, "HAMMING", Image.BILINEAR), Image.BICUBIC,
+                         Image.LANCZOS, Image.LANCZOS]
+
+
+def resample_pillow(image, yx_new, zoom_spline, windows, outputs):
+    """The 'pillow' resampler.  Return the list of the windows, given as
+    (yx_from_start, yx_extents) pairs, of image scaled to the size yx_new,
+    using the PIL resize filter selected by zoom_spline.  Only the source
+    region under each window is resampled.  PIL releases the GIL while
+    resizing.  Each window with a destination array in the list outputs is
+    copied into it."""
+    resize_filter = pillow_resize_filters[zoom_spline]
+    if args.verbose:
+        print("Scaling image with PIL resize filter", resize_filter,
+              "to size", tuple(yx_new))
+    # PIL maps pixel centers, so the source region of a window is just the
+    # window scaled back by the ratio of the sizes.
+    scale_y = image.shape[0] / yx_new[0]
+    scale_x = image.shape[1] / yx_new[1]
+    full_im = Image.fromarray(image)
+    scaled_images = []
+    for (yx_from_start, yx_extents), output in zip(windows, outputs):
+        box = (yx_from_start[1] * scale_x, yx_from_start[0] * scale_y,
+               (yx_from_start[1] + yx_extents[1]) * scale_x,
+               (yx_from_start[0] + yx_extents[0]) * scale_y)
+        try:
+            im = full_im.resize((yx_extents[1], yx_extents[0]), resize_filter,
+                                box=box)
+        except TypeError: # no box argument before Pillow 3.4
+            im = full_im.resize((yx_new[1], yx_new[0]), resize_filter)
+            im = im.crop((yx_from_start[1], yx_from_start[0],
+                          yx_from_start[1] + yx_extents[1],
+                          yx_from_start[0] + yx_extents[0]))
+        scaled_image = np.asarray(im)
+        if output is not None:
+            output[...] = scaled_image
+            scaled_image = output
+        scaled_images.append(scaled_image)
+    return scaled_images
+
+
+def resample_box(image, yx_new, zoom_spline, windows, outputs):
+    """The 'box' resampler.  When image is at least twice as large as yx_new
+    in a dimension, first shrink it by the largest integer factor which keeps
+    it at least as large as yx_new, averaging the blocks of pixels (in integer
+    arithmetic).  Then do the remaining zoom with the spline resampler."""
+    factors = [max(1, image.shape[dim] // yx_new[dim]) for dim in [0, 1]]
+    if factors != [1, 1]:
         if args.verbose:
-            print("Scaling image with spline order", zoom_spline, "and "
-                  "(zoom_y,zoom_x) =", (round(zoom_y, 4), round(zoom_x, 4)))
-
-        scaled_image = sp.ndimage.interpolation.zoom(
-            image, (zoom_y, zoom_x, 1), order=zoom_spline)
-
-        if args.verbose and (scaled_image.shape[0], scaled_image.shape[1]) != yx_new:
-            print("Warning: Imperfect scaling in zoom operation.")
-    return scaled_image
-
-
-def calculate_scaling(image, disp_res, disp_res_list):
-    """Calculate the scaling of the image to fit a display with resolution
-    disp_res.  Returns a 4-tuple containing the current size, the new, scaled
-    size (which may be larger than the resolution and need cropping), any
-    offsets due to the '--fitimage' option, and the fractional error."""
-    yx_curr = (image.shape[0], image.shape[1])
-    zoom_y = disp_res[0] / image.shape[0] # zoom to make y fit exactly
-    zoom_x = disp_res[1] / image.shape[1] # zoom to make x fit exactly
+            print("Averaging blocks of", tuple(factors), "pixels before zooming.")
+        image = box_shrink(image, factors)
+        if (image.shape[0], image.shape[1]) == tuple(yx_new):
+            return crop_windows(image, windows, outputs)
+    return resample_spline(image, yx_new, zoom_spline, windows, outputs)
+
+
+def box_shrink(image, factors):
+    """Shrink image by the integer (y, x) factors in factors, averaging the
+    blocks of pixels (in integer arithmetic).  Any partial blocks at the
+    bottom and right edges are dropped."""
+    blocks_y = image.shape[0] // factors[0]
+    blocks_x = image.shape[1] // factors[1]
+    blocks = image[:blocks_y*factors[0], :blocks_x*factors[1]].reshape(
+        blocks_y, factors[0], blocks_x, factors[1], image.shape[2])
+    block_sums = blocks.sum(axis=(1, 3), dtype=np.uint32)
+    block_size = factors[0] * factors[1]
+    return ((block_sums + block_size // 2) // block_size).astype(np.uint8)
+
+
+resamplers = {"spline": resample_spline, "pillow": resample_pillow,
+              "box": resample_box}
+resampler_name = "spline" # global, reset from the '--resampler' option
+
+
+def calculate_scaling(yx_curr, disp_res, disp_res_list):
+    """Calculate the scaling of an image with (y, x) size yx_curr to fit a
+    display with resolution disp_res.  An image shape can be passed as yx_curr,
+    since only the first two values are used.  Returns a 4-tuple containing the
+    current size, the new, scaled size (which may be larger than the resolution
+    and need cropping), any offsets due to the '--fitimage' option, and the
+    fractional error."""
+    yx_curr = (yx_curr[0], yx_curr[1])
+    zoom_y = disp_res[0] / yx_curr[0] # zoom to make y fit exactly
+    zoom_x = disp_res[1] / yx_curr[1] # zoom to make x fit exactly
     yx_exact_y = (disp_res[0], int(round(yx_curr[1]*zoom_y)))
     yx_exact_x = (int(round(yx_curr[0]*zoom_x)), disp_res[1])
     yx_new = yx_exact_y
@@ -935,113 +2827,1183 @@ def calculate_scaling(image, disp_res, disp_res_list):
     return (yx_curr, yx_new, fitimage_offsets, err_fraction)
 
 
-def create_giant_image(image_list, disp_res_list_arg):
-    """Create and return the final giant image to set as the combined background
-    image.  Each image in image_list is mapped to the corresponding display in
-    disp_res_list_arg.  Zoom is done such that each image exactly fits the display on
-    at least one dimension; any error in the other dimension is cut off
-    equally on both ends."""
-    # 1) Find a bounding box of all displays and create a giant image that size.
-    # 2) Resize each image to be exactly the size of its corresponding display
-    #    (in the one dimension for the selected mode).
-    # 3) Copy each resized image to the place in the giant image specified by
-    #    its offset information (with extents set to crop any extra from step 2).
-    # 4) Convert to Windows tiled mode, if necessary.
-    # 5) Return the giant image.
-
-    disp_res_list = disp_res_list_arg[:] # a local copy, modified for oneimage option
-
-    # Find the bounding box around all the displays.
+def get_bounding_box(disp_res_list):
+    """Return the (y, x) size of the bounding box of all the displays in
+    disp_res_list, which has its top left at (0, 0)."""
     # minY = 0
     max_y = max([i[0] + i[2] for i in disp_res_list])
     # minX = 0
     max_x = max([i[1] + i[3] for i in disp_res_list])
+    return (max_y, max_x)
 
-    # Create the empty giant image.
-    if args.verbose:
-        print("Creating a large image of size", (max_y, max_x),
-              "\nwhich is a bounding box on all the displays.")
-    giant_image = np.empty((max_y, max_x, 3), "uint8") # empty display-sized RGB image
 
-    # If oneimage option, reset the display list to represent one large display.
-    if args.oneimage:
-        disp_res_list = [(max_y, max_x, 0, 0)]
+def displays_overlap(disp_res_list):
+    """Return True if any two of the display rectangles in disp_res_list
+    overlap (such as for cloned displays)."""
+    for i, d1 in enumerate(disp_res_list):
+        for d2 in disp_res_list[i+1:]:
+            if (d1[2] < d2[2] + d2[0] and d2[2] < d1[2] + d1[0] and
+                    d1[3] < d2[3] + d2[1] and d2[3] < d1[3] + d1[1]):
+                return True
+    return False
 
-    # Scale all the images to exactly match their corresponding display's
-    # resolution (when zoomed/fit according to the selected method).
-    scaled_image_list = []
-    fitimage_offset_list = [] # extra offsets due to --fitimage, we'll append to it
-    for image, disp_res, count in zip(image_list, disp_res_list, range(len(image_list))):
-        if args.verbose:
-            print()
 
-        # Calculate the scaling.
-        yx_curr, yx_new, fitimage_offsets, err = \
-            calculate_scaling(image, disp_res, disp_res_list)
-        fitimage_offset_list.append(fitimage_offsets)
+num_workers = 1 # global number of worker threads, reset from the '--workers' option
+worker_pool = None # the worker thread pool, created when first needed
+
+
+worker_state = threading.local() # records whether a thread is a worker thread
 
-        # Perform the scaling.
-        if args.verbose:
-            print("Image", count, "has initial shape", image.shape)
-        scaled_image = scale_image(image, yx_new, zoom_spline)
 
-        scaled_image_list.append(scaled_image)
+def in_worker_thread():
+    """Return True if called from inside a function run by map_on_workers."""
+    return getattr(worker_state, "in_worker", False)
 
+
+def map_on_workers(function, items):
+    """Return the list of the values of function applied to each element of
+    items, run concurrently on the worker threads when there is more than one
+    of each.  NumPy, ndimage, and PIL release the GIL for the heavy work of
+    decoding and scaling, so the threads really do run in parallel.  Calls
+    made from a worker thread are run serially in that thread, since waiting
+    on the pool from inside the pool could deadlock it."""
+    global worker_pool
+    items = list(items)
+    if num_workers < 2 or len(items) < 2 or in_worker_thread():
+        return [function(item) for item in items]
+    if worker_pool is None:
+        worker_pool = ThreadPool(num_workers)
+    def run_in_worker(item):
+        worker_state.in_worker = True
+        try:
+            return function(item)
+        finally:
+            worker_state.in_worker = False
+    return worker_pool.map(run_in_worker, items)
+
+
+def close_thread_pools():
+    """Close the worker and the directory scanning thread pools, if they were
+    created, and wait for their threads to exit.  This is done whenever the
+    program goes idle (such as between the iterations in '--timedelay' mode)
+    and before it exits.  The pools are created again when they are needed,
+    with the current number of threads."""
+    global scan_pool, worker_pool
+    for pool in [scan_pool, worker_pool]:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    scan_pool = worker_pool = None
+
+
+def band_slices(length, min_band=64):
+    """Split range(length) into contiguous slices, one for each worker thread
+    which is free to take one, but each at least min_band long.  Returns a
+    list with the single full slice when the work is not to be split."""
+    num_bands = 1
+    if not in_worker_thread():
+        num_bands = max(1, min(num_workers, length // min_band))
+    bounds = [(length * i) // num_bands for i in range(num_bands + 1)]
+    return [slice(bounds[i], bounds[i+1]) for i in range(num_bands)]
+
+
+class TileCache(object):
+    """An on-disk cache of the scaled images (tiles) for the displays, so that
+    an image which comes around again on the same display is neither decoded
+    nor scaled.  Each entry holds the list of tiles computed from one image
+    file, with their offsets, in NumPy's uncompressed .npz format.  The key is
+    a hash of the image file's path, modification time, and size along with
+    everything else which affects the scaled pixels, including how the image
+    is decoded (from which pyramid levels, and with or without reduce).  When
+    the total size of the entries goes over max_bytes the least-recently-used
+    entries are deleted.  The cache can be used from the worker threads, and
+    the cache directory can be shared by several programs at once (entries
+    written by the others are found on disk, and the directory is scanned
+    again before any entries are deleted)."""
+
+    stale_tmp_seconds = 600 # older temporary files were left by an interrupted write
+
+    cache_version = 2 # change when the saved format or the key changes
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Entry filename -> size in bytes, with the least recently used first.
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with self.lock:
+            self.rescan()
+        self.evict()
+
+    def rescan(self):
+        """Set the entries from the files in the cache directory, which other
+        programs sharing it may have added or deleted.  Their modification
+        times give the LRU order, since an entry's file is touched when it
+        is used.  Entries with the same time (file times can be coarse) are
+        kept in their old order.  Must be called with the lock held."""
+        old_order = dict((filename, i) for i, filename in enumerate(self.entries))
+        found = []
+        for filename in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                if filename.endswith(".tmp"):
+                    # Another program may still be writing a recent one.
+                    if os.stat(path).st_mtime < time.time() - self.stale_tmp_seconds:
+                        os.remove(path)
+                    continue
+                if filename.endswith(".npz"):
+                    stat = os.stat(path)
+                    found.append((stat.st_mtime, old_order.get(filename, -1),
+                                  filename, stat.st_size))
+            except OSError:
+                pass
+        found.sort()
+        self.entries = collections.OrderedDict(
+            (filename, size) for mtime, position, filename, size in found)
+        self.total_bytes = sum(self.entries.values())
+
+    def make_key(self, image_name, disp_res_list):
+        """Return the key of the tiles made from the file image_name for the
+        displays in disp_res_list.  Raises IOError if the file cannot be
+        accessed."""
+        try:
+            stat = os.stat(image_name)
+        except OSError as e:
+            raise IOError(str(e))
+        # A level made later by '--makepyramids' is read instead of the file,
+        # so the levels which exist are part of the key.
+        pyramid_levels = None
+        if image_pyramids:
+            pyramid_levels = image_pyramids.existing_levels(image_name)
+        key = [self.cache_version, image_name, stat.st_mtime, stat.st_size,
+               [list(d) for d in disp_res_list], zoom_spline,
+               bool(args.fitimage), bool(args.oneimage), resampler_name,
+               pyramid_levels, pillow_has_reduce]
+        return hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest() + ".npz"
+
+    def get(self, key):
+        """Return the list of (tile, yx_offset) pairs saved under key, or None
+        if there is no such entry."""
+        path = os.path.join(self.cache_dir, key)
+        found_on_disk = False
+        with self.lock:
+            if key not in self.entries:
+                try: # maybe written by another program sharing the directory
+                    size = os.stat(path).st_size
+                except OSError:
+                    return None
+                self.entries[key] = size
+                self.total_bytes += size
+                found_on_disk = True
+        if found_on_disk:
+            self.evict()
+        try:
+            with np.load(path) as saved:
+                tiles = [(saved["tile%d" % i], tuple(saved["offset%d" % i]))
+                         for i in range(int(saved["count"]))]
+            os.utime(path, None) # the mtime gives the LRU order across runs
+        except (IOError, OSError, ValueError, KeyError) as e:
+            if args.verbose:
+                print("Could not read the tile cache entry", key, "\n", e)
+            self.remove(key)
+            return None
+        with self.lock:
+            if key in self.entries: # move it to the most recently used end
+                self.entries[key] = self.entries.pop(key)
+        return tiles
+
+    def put(self, key, tiles):
+        """Save the list of (tile, yx_offset) pairs tiles under key."""
+        path = os.path.join(self.cache_dir, key)
+        tmp_path = temp_file_name(path)
+        arrays = {"count": np.array(len(tiles))}
+        for i, (tile, yx_offset) in enumerate(tiles):
+            arrays["tile%d" % i] = tile
+            arrays["offset%d" % i] = np.array(yx_offset)
+        try:
+            with open(tmp_path, "wb") as tmp_file:
+                np.savez(tmp_file, **arrays)
+            replace_file(tmp_path, path)
+            size = os.path.getsize(path)
+        except (IOError, OSError) as e:
+            print("\nWarning from makeSpanningBackground: Could not write to the"
+                  "\ntile cache directory\n   " + self.cache_dir +
+                  "\nThe reported error was:\n", e, file=sys.stderr)
+            return
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)
+            self.entries[key] = size
+            self.total_bytes += size
+        self.evict()
+
+    def remove(self, key):
+        """Delete the entry key, if it exists."""
+        with self.lock:
+            self.total_bytes -= self.entries.pop(key, 0)
+        try:
+            os.remove(os.path.join(self.cache_dir, key))
+        except OSError:
+            pass
+
+    def evict(self):
+        """Delete the least-recently-used entries until the cache fits in its
+        byte budget.  The directory is scanned again first, so the entries
+        which other programs have added or deleted are counted correctly."""
+        with self.lock:
+            if self.total_bytes <= self.max_bytes:
+                return
+            self.rescan()
+        while True:
+            with self.lock:
+                if self.total_bytes <= self.max_bytes or not self.entries:
+                    return
+                oldest, size = self.entries.popitem(last=False)
+                self.total_bytes -= size
+            if args.verbose:
+                print("Evicting the entry", oldest, "from the tile cache.")
+            try:
+                os.remove(os.path.join(self.cache_dir, oldest))
+            except OSError:
+                pass
+
+
+tile_cache = None # global TileCache, created if the '--tilecache' option is set
+
+
+def cached_tiles(image_name, disp_res_list, make_tiles):
+    """Return the list of (tile, yx_offset) pairs for the image file
+    image_name on the displays in disp_res_list, from the tile cache if it
+    has them and otherwise by calling make_tiles (and then saving them in the
+    cache)."""
+    if not tile_cache:
+        return make_tiles()
+    key = tile_cache.make_key(image_name, disp_res_list)
+    tiles = tile_cache.get(key)
+    if tiles is not None:
         if args.verbose:
-            print("Image", count, "now has shape", scaled_image.shape)
+            print("\nUsing the scaled image from the tile cache for\n   ", image_name)
+        return tiles
+    tiles = make_tiles()
+    tile_cache.put(key, tiles)
+    return tiles
+
+
+def scale_display_image(image_name, disp_res, disp_res_list, count,
+                        giant_image=None):
+    """Decode the image in the file image_name and scale it for the display
+    with resolution disp_res.  Zoom is done such that the image exactly fits
+    the display on at least one dimension; any error in the other dimension is
+    cut off equally on both ends.  Returns a list holding one (tile,
+    yx_offset) pair, where yx_offset is the position of the scaled image
+    relative to the display.  If giant_image is set the image is scaled
+    directly into its place in giant_image (without the Windows correction),
+    and the tile is a view of giant_image.  Raises IOError if the file cannot
+    be read."""
+    image = read_image_file(image_name, disp_res)
+
+    # Calculate the scaling.
+    yx_curr, yx_new, fitimage_offsets, err = \
+        calculate_scaling(image.shape, disp_res, disp_res_list)
+
+    if not args.fitimage:
+        # scaled image won't necessarily all fit, compensate for the overlap
+        # (assume scaled size minus disp might be slightly neg from rounding)
+        y_start = (yx_new[0] - disp_res[0]) / 2
+        x_start = (yx_new[1] - disp_res[1]) / 2
+        y_start = int(round(max(0.0, y_start)))
+        x_start = int(round(max(0.0, x_start)))
+        yx_from_start = (y_start, x_start)
+    elif args.fitimage:
+        # scaled image will fully fit in the display, scaled below to do so
+        yx_from_start = (0, 0)
+    yx_extents = (disp_res[0], disp_res[1]) # set extents to display size
+
+    # Perform the scaling.  Only the part of the scaled image which will be
+    # copied is actually computed.
+    if args.verbose:
+        print("\nImage", count, "has initial shape", image.shape)
+    if giant_image is None:
+        scaled_image = scale_image(image, yx_new, zoom_spline,
+                                   yx_from_start, yx_extents)
+    else:
+        y_to_start = disp_res[2] + fitimage_offsets[0]
+        x_to_start = disp_res[3] + fitimage_offsets[1]
+        output = giant_image[y_to_start:y_to_start+yx_extents[0],
+                             x_to_start:x_to_start+yx_extents[1]]
+        scaled_image = scale_image_windows(image, yx_new, zoom_spline,
+                                           [(yx_from_start, yx_extents)],
+                                           [output])[0]
+    if args.verbose:
+        print("Image", count, "now has shape", scaled_image.shape,
+              "after scaling to", yx_new, "and cropping at", yx_from_start)
+    return [(scaled_image, tuple(fitimage_offsets))]
+
+
+def scale_spanning_image(image_name, disp_res_list, giant_image=None):
+    """Decode the image in the file image_name and scale it to span the
+    bounding box on all the displays in disp_res_list, for the '--oneimage'
+    option.  Only the parts of the scaled image which fall on a display are
+    actually computed.  Returns a list of (tile, yx_offset) pairs, where each
+    yx_offset is the position of the tile in the bounding box.  If giant_image
+    is set the tiles are scaled directly into their places in giant_image, as
+    in scale_display_image.  Raises IOError if the file cannot be read."""
+    max_y, max_x = get_bounding_box(disp_res_list)
+    bbox_res = (max_y, max_x, 0, 0)
+    image = read_image_file(image_name, bbox_res)
+
+    # Calculate the scaling, as if for one large display.
+    yx_curr, yx_new, fitimage_offsets, err = \
+        calculate_scaling(image.shape, bbox_res, disp_res_list)
+    if not args.fitimage:
+        y_start = int(round(max(0.0, (yx_new[0] - max_y) / 2)))
+        x_start = int(round(max(0.0, (yx_new[1] - max_x) / 2)))
+        yx_from_start = (y_start, x_start)
+    elif args.fitimage:
+        yx_from_start = (0, 0)
+    # The part of the bounding box covered by the scaled image.
+    yx_covered_start = fitimage_offsets
+    yx_covered_end = [fitimage_offsets[dim] + min(bbox_res[dim],
+                                                  yx_new[dim] - yx_from_start[dim])
+                      for dim in [0, 1]]
+
+    # Find the window of the scaled image which falls on each display.
+    windows = []
+    yx_to_starts = []
+    for disp_res in disp_res_list:
+        yx_to_start = [max(disp_res[2+dim], yx_covered_start[dim]) for dim in [0, 1]]
+        yx_to_end = [min(disp_res[2+dim] + disp_res[dim], yx_covered_end[dim])
+                     for dim in [0, 1]]
+        yx_extents = [yx_to_end[dim] - yx_to_start[dim] for dim in [0, 1]]
+        if yx_extents[0] <= 0 or yx_extents[1] <= 0:
+            continue # the image does not reach this display
+        windows.append(([yx_to_start[dim] - fitimage_offsets[dim] + yx_from_start[dim]
+                         for dim in [0, 1]], yx_extents))
+        yx_to_starts.append(tuple(yx_to_start))
 
-    # Set all pixels to the background fill color, if that option is selected.
-    # All the pixels in the initial giant_image are assigned RGB values in a
-    # loop; not the most efficient way, but it is simple and it works.
+    if args.verbose:
+        print("\nThe image has initial shape", image.shape, "and is scaled to",
+              yx_new, "\nwith", len(windows), "windows computed for the displays.")
+    outputs = None
+    if giant_image is not None:
+        outputs = [giant_image[yx_to_start[0]:yx_to_start[0]+yx_extents[0],
+                               yx_to_start[1]:yx_to_start[1]+yx_extents[1]]
+                   for yx_to_start, (yx_from_start, yx_extents)
+                   in zip(yx_to_starts, windows)]
+    scaled_images = scale_image_windows(image, yx_new, zoom_spline, windows,
+                                        outputs)
+    return list(zip(scaled_images, yx_to_starts))
+
+
+def image_tiles(image_name, disp_res_list, count, giant_image=None):
+    """Return a list of (tile, yx_to_start) pairs for the image in the file
+    image_name on display number count of the displays in disp_res_list (or
+    spanning all of them, with the oneimage option), from the tile cache or
+    else by decoding and scaling it.  Each yx_to_start is the position of the
+    tile in the giant image.  If giant_image is set, and there is no tile
+    cache, then the image is instead scaled directly into giant_image (so it
+    must not need the Windows correction) and the empty list is returned.
+    Raises IOError if the file cannot be read."""
+    if giant_image is not None and tile_cache is None:
+        if args.oneimage:
+            scale_spanning_image(image_name, disp_res_list, giant_image)
+        else:
+            scale_display_image(image_name, disp_res_list[count], disp_res_list,
+                                count, giant_image)
+        return []
+    if args.oneimage:
+        def make_tiles():
+            return scale_spanning_image(image_name, disp_res_list)
+        return cached_tiles(image_name, disp_res_list, make_tiles)
+    disp_res = disp_res_list[count]
+    def make_tiles():
+        return scale_display_image(image_name, disp_res, disp_res_list, count)
+    tiles = cached_tiles(image_name, [disp_res[:2]], make_tiles)
+    # If the scaled image is smaller than the display (--fitimage mode) then
+    # it is offset to center it.
+    return [(tile, (disp_res[2] + yx_offset[0], disp_res[3] + yx_offset[1]))
+            for tile, yx_offset in tiles]
+
+
+def for_each_image(function, image_names, disp_res_list, counts, in_order=False):
+    """Return the list of the values of function(count) for each display
+    number count in counts, run concurrently on the worker threads unless
+    in_order is True.  The function should raise IOError if the image file
+    image_names[count] cannot be read; that file is then replaced in the list
+    image_names with a newly selected one and the function is called again."""
+    def call(count):
+        try:
+            return True, function(count)
+        except IOError:
+            return False, None
+    if in_order:
+        results = [call(count) for count in counts]
+    else:
+        results = map_on_workers(call, counts)
+
+    # Replace any images which could not be read, one at a time.
+    values = []
+    for count, (succeeded, value) in zip(counts, results):
+        while not succeeded:
+            image_index.mark_unreadable(image_names[count])
+            warn_unreadable_file(image_names[count])
+            image_names[count] = get_next_background_image(
+                disp_res_list[count], disp_res_list)
+            if not image_names[count]:
+                print("\nError in makeSpanningBackground: No suitable image files"
+                      "\nfound for display", str(count)+".\n", file=sys.stderr)
+                sys.exit(1)
+            succeeded, value = call(count)
+        values.append(value)
+    return values
+
+
+def background_fill_color(gaps=False):
+    """Return the RGB fill color of any part of a display not covered by its
+    image, as a list of uint8 values, or None if there is no fill color.  If
+    gaps is true return the fill color of the whole giant image instead,
+    which is the color of the gaps between the displays."""
     rgb_fill = []
     if args.colorfill:
         rgb_fill = args.colorfill
-    if args.fitimage:
+    if args.fitimage and not (gaps and args.oneimage):
         rgb_fill = args.fitimage
-    if rgb_fill:
-        rgb_bytes = [np.uint8(i) for i in rgb_fill] # explicitly cast to uint8
-        giant_image[:, :] = rgb_bytes # note numpy fill method is for scalar vals
-        # giant_image[:][:] = rgb_bytes  # this works, too
-
-    # Copy the central portion of each scaled image to the correct place in the
-    # giant image (one dimension may be cut-off automatically by copy routine).
-    for scaled_image, disp_res, fitOffsets, count in zip(
-                        scaled_image_list, disp_res_list, fitimage_offset_list,
-                        range(len(disp_res_list))):
-        if not args.fitimage:
-            # scaled image won't necessarily all fit, compensate for the overlap
-            # (assume scaled size minus disp might be slightly neg, imperfect zoom)
-            y_start = (scaled_image.shape[0] - disp_res[0]) / 2
-            x_start = (scaled_image.shape[1] - disp_res[1]) / 2
-            y_start = int(round(max(0.0, y_start)))
-            x_start = int(round(max(0.0, x_start)))
-            yx_from_start = (y_start, x_start)
-        elif args.fitimage:
-            # scaled image will fully fit in the display, scaled above to do so
-            yx_from_start = (0, 0)
-        yx_extents = (disp_res[0], disp_res[1]) # set extents to display size
-        yx_to_start = (disp_res[2] + fitOffsets[0], disp_res[3] + fitOffsets[1])
+    if gaps and args.oneimage and not rgb_fill:
+        rgb_fill = [0, 0, 0] # the gaps between displays are not rendered
+    if not rgb_fill:
+        return None
+    return [np.uint8(i) for i in rgb_fill] # explicitly cast to uint8
+
+
+def create_giant_image(image_names, disp_res_list_arg, giant_image=None,
+                       counts=None, yx_origin=None):
+    """Create the final giant image to set as the combined background image.
+    Each image file in image_names is decoded, scaled, and mapped to the
+    corresponding display in disp_res_list_arg, with the displays handled
+    concurrently on the worker threads.  Any image file which cannot be
+    decoded is replaced with a newly selected one.  If giant_image is passed
+    in (an array of the bounding-box size, such as a memory map of the output
+    file) then the image is drawn in it.  If counts is also set (with
+    giant_image from an earlier call with the same displays) then only the
+    displays with the indices in the list counts are redrawn, and the rest of
+    giant_image is left as it was.  If yx_origin is set the image is converted
+    to Windows tiled mode with that origin (as returned by windows_origin).
+    Returns a 2-tuple of the giant image and the list of the image filenames
+    actually used."""
+    # 1) Find a bounding box of all displays and create a giant image that size.
+    # 2) Resize each image to be exactly the size of its corresponding display
+    #    (in the one dimension for the selected mode).
+    # 3) Copy each resized image to the place in the giant image specified by
+    #    its offset information (with extents set to crop any extra from step 2).
+    # 4) Convert to Windows tiled mode, if necessary, by copying the images
+    #    in step 3 straight to their wrapped positions.
+    # 5) Return the giant image.
+    disp_res_list = disp_res_list_arg[:] # a local copy
+    image_names = list(image_names)
+
+    if giant_image is None:
+        # Find the bounding box around all the displays.
+        max_y, max_x = get_bounding_box(disp_res_list)
+
+        # Create the empty giant image.
         if args.verbose:
-            print("\nCopying image", count, "from pixel", yx_from_start,
-                  "with extents", yx_extents,
-                  "\nto the large final image, starting at pixel", yx_to_start)
-        # Do the actual copy operation.  Note that if scaled_image is larger than
-        # extents (zoomed up) copy_subimage will implicitly crop, and if extents
-        # are larger than the size of scaled_image (--fitimage mode) then the
-        # extents will be automatically reduced in copy_subimage.
-        copy_subimage(yx_extents, scaled_image, yx_from_start, giant_image, yx_to_start)
+            print("Creating a large image of size", (max_y, max_x),
+                  "\nwhich is a bounding box on all the displays.")
+        giant_image = np.empty((max_y, max_x, 3), "uint8") # empty display-sized RGB image
+
+    if counts is None:
+        # Set all pixels to the background fill color, if that option is selected.
+        rgb_bytes = background_fill_color(gaps=True)
+        if rgb_bytes:
+            giant_image[:, :] = rgb_bytes # note numpy fill method is for scalar vals
+            # giant_image[:][:] = rgb_bytes  # this works, too
+        if args.oneimage and args.fitimage:
+            # Only the displays get the fitimage color, the gaps keep the colorfill.
+            rgb_bytes = background_fill_color()
+            for disp_res in disp_res_list:
+                fill_giant_image_rect(giant_image, (disp_res[2], disp_res[3],
+                                      disp_res[0], disp_res[1]), rgb_bytes,
+                                      yx_origin)
+    else:
+        # Clear the displays which are redrawn to the fill color.
+        rgb_bytes = background_fill_color()
+        if rgb_bytes:
+            for count in counts:
+                disp_res = disp_res_list[count]
+                fill_giant_image_rect(giant_image, (disp_res[2], disp_res[3],
+                                      disp_res[0], disp_res[1]), rgb_bytes,
+                                      yx_origin)
+
+    if args.verbose and yx_origin is not None:
+        print("Correcting the origin of the image (on Windows OS).")
+
+    # Render the images for all the displays, concurrently if possible, scaling
+    # them straight into the giant image when no copy is needed.  With
+    # overlapping displays the later ones must be copied last, so they are
+    # rendered in order on this thread.  With the oneimage option the single
+    # image is rendered onto all the displays at once.
+    direct_image = giant_image if yx_origin is None else None
+    def render(count):
+        for scaled_image, yx_to_start in image_tiles(image_names[count],
+                                                     disp_res_list, count,
+                                                     direct_image):
+            if args.verbose:
+                print("Copying image", count, "with extents", scaled_image.shape[:2],
+                      "\nto the large final image, starting at pixel", yx_to_start)
+            copy_to_giant_image(scaled_image, giant_image, yx_to_start, yx_origin)
+    if counts is None:
+        counts = list(range(len(image_names) if args.oneimage else len(disp_res_list)))
+    for_each_image(render, image_names, disp_res_list, counts,
+                   in_order=args.oneimage or displays_overlap(disp_res_list))
+
+    # plt.imshow(giant_image)
+    # plt.show() # for debugging
+    return giant_image, image_names
+
 
+def windows_origin():
+    """Return the (y, x) origin of the Windows correction if the final image
+    is to be converted to Windows tiled mode (step 4 of create_giant_image),
+    or None if it is not.  The origin is from the '--windows' option if it is
+    set, and otherwise it is the global yx_primary_window_origin set by
+    get_display_info_windows, so this is called along with collecting the
+    display information."""
     if (system_os == "Windows" or args.windows) and not args.x11:
         if args.windows:
-            global yx_primary_window_origin
-            yx_primary_window_origin = (args.windows[1], args.windows[0])
+            return (args.windows[1], args.windows[0])
+        return yx_primary_window_origin
+    return None
+
+
+def windows_origin_pieces(rect, yx_shape, yx_origin):
+    """Return a list of the pieces which the rectangle rect, given as (y, x,
+    y_size, x_size) in a giant image of (y, x) shape yx_shape, is split into
+    by the Windows correction.  Each piece is given as (y_offset, x_offset,
+    y, x, y_size, x_size), where the offsets are the position of the piece in
+    the rectangle and (y, x) is its position in the final image.  Windows
+    puts (0,0) at the top left of the primary display, with wraparound in
+    tiled mode, so the correction maps each position p to (p - yx_origin)
+    modulo the size.  The rectangle is split at the wraparound into at most
+    four pieces.  If yx_origin is None there is no correction, and the
+    rectangle is the only piece."""
+    if yx_origin is None:
+        return [(0, 0) + tuple(rect)]
+    spans = []
+    for dim in [0, 1]:
+        start = (rect[dim] - yx_origin[dim]) % yx_shape[dim]
+        size = rect[2+dim]
+        first_size = min(size, yx_shape[dim] - start)
+        dim_spans = [(0, start, first_size)]
+        if first_size < size:
+            dim_spans.append((first_size, 0, size - first_size))
+        spans.append(dim_spans)
+    return [(y_offset, x_offset, y, x, y_size, x_size)
+            for y_offset, y, y_size in spans[0] for x_offset, x, x_size in spans[1]]
+
+
+def windows_origin_rects(rect, yx_shape, yx_origin):
+    """Return a list of the rectangles in the final image which the rectangle
+    rect, given as (y, x, y_size, x_size) in a giant image of (y, x) shape
+    yx_shape, maps to under the Windows correction with the origin yx_origin
+    (at most four, since it may be split at the wraparound)."""
+    return [piece[2:] for piece in windows_origin_pieces(rect, yx_shape, yx_origin)]
+
+
+def copy_to_giant_image(from_image, giant_image, yx_to_start, yx_origin=None):
+    """Copy all of from_image to giant_image at the position yx_to_start, with
+    the Windows correction for the origin yx_origin applied if it is set (so
+    the copy may be split into pieces).  Any part outside of giant_image is
+    silently ignored."""
+    yx_extents = [max(0, min(from_image.shape[dim], giant_image.shape[dim] -
+                             yx_to_start[dim])) for dim in [0, 1]]
+    rect = (yx_to_start[0], yx_to_start[1], yx_extents[0], yx_extents[1])
+    for y_offset, x_offset, y, x, y_size, x_size in windows_origin_pieces(
+                                                rect, giant_image.shape, yx_origin):
+        copy_subimage((y_size, x_size), from_image, (y_offset, x_offset),
+                      giant_image, (y, x))
+
+
+def fill_giant_image_rect(giant_image, rect, rgb_bytes, yx_origin=None):
+    """Set the rectangle rect, given as (y, x, y_size, x_size), of giant_image
+    to the color rgb_bytes, with the Windows correction for the origin
+    yx_origin applied if it is set."""
+    for y, x, y_size, x_size in windows_origin_rects(rect, giant_image.shape,
+                                                     yx_origin):
+        giant_image[y:y+y_size, x:x+x_size] = rgb_bytes
+
+
+class RotatingCanvas(object):
+    """Keep the giant image between iterations in '--timedelay' mode, for the
+    '--rotate' option, so that only a few of the displays get a new image on
+    each iteration and the rest of the image is kept as it was.  The displays
+    are picked in turn.  A complete new image is made on the first iteration,
+    whenever the display layout changes, and always with the '--oneimage'
+    option or with overlapping displays."""
+
+    def __init__(self, num_per_iteration):
+        self.num_per_iteration = num_per_iteration
+        self.giant_image = None
+        self.disp_res_list = None
+        self.image_names = None
+        self.yx_origin = None
+        self.next_display = 0 # index of the next display to get a new image
+
+    def render(self, display_res_list, yx_origin=None):
+        """Return a 3-tuple of the final giant image for the displays in
+        display_res_list, with the Windows correction for the origin
+        yx_origin if it is set, the list of the image filenames on the
+        displays, and a list of the (y, x, y_size, x_size) rectangles of the
+        final image which changed (or None if all of it did)."""
+        display_res_list = list(display_res_list)
+        if (self.giant_image is None or display_res_list != self.disp_res_list
+                or yx_origin != self.yx_origin
+                or args.oneimage or displays_overlap(display_res_list)):
+            giant_image, image_names = render_background(display_res_list, yx_origin)
+            self.giant_image = giant_image
+            self.disp_res_list = display_res_list
+            self.yx_origin = yx_origin
+            self.image_names = image_names
+            self.next_display = 0
+            return giant_image, list(image_names), None
+
+        num_displays = len(display_res_list)
+        counts = [(self.next_display + i) % num_displays
+                  for i in range(min(self.num_per_iteration, num_displays))]
+        self.next_display = (self.next_display + len(counts)) % num_displays
+        image_names = list(self.image_names)
+        for count in counts:
+            image_name = get_next_background_image(display_res_list[count],
+                                                   display_res_list)
+            if not image_name:
+                print("\nError in makeSpanningBackground: No suitable image files"
+                      "\nfound for display", str(count)+".\n", file=sys.stderr)
+                sys.exit(1)
+            if args.verbose:
+                print("Image selected for display", count, "is\n   ", image_name, "\n")
+            image_names[count] = image_name
+        self.giant_image, self.image_names = create_giant_image(
+            image_names, display_res_list, self.giant_image, counts, yx_origin)
+
+        changed_rects = []
+        for count in counts:
+            disp_res = display_res_list[count]
+            changed_rects += windows_origin_rects(
+                (disp_res[2], disp_res[3], disp_res[0], disp_res[1]),
+                self.giant_image.shape, yx_origin)
+        return self.giant_image, list(self.image_names), changed_rects
+
+
+def read_bmp_header(file_name):
+    """Return the first 54 bytes of the file file_name (the headers of a BMP
+    file), or None if it cannot be read."""
+    try:
+        with open(file_name, "rb") as bmp_file:
+            return bmp_file.read(54)
+    except (IOError, OSError):
+        return None
+
+
+def patch_bmp_file(file_name, image, rects, spare_file_name=None, spare_rects=None):
+    """Rewrite only the rectangles in the list rects, each given as (y, x,
+    y_size, x_size), of the uncompressed 24-bit BMP file file_name with the
+    pixels of image, which must have the same size.  The rectangles are
+    rewritten in another file which then replaces it, as in
+    write_memmap_bmp_image, so the current background is never seen half
+    drawn.  That file is a copy of file_name, unless spare_rects is set: the
+    file spare_file_name, which the program owns, then holds an earlier
+    version of file_name which differs from it only in the rectangles in the
+    list spare_rects, and it is patched in place with both lists of
+    rectangles, so the unchanged pixels are neither encoded nor written.  If
+    spare_file_name is set the replaced version of file_name is kept as that
+    file (by a hard link, where the OS allows it), for the next call with
+    rects as its spare_rects.  Returns True on success and False (without
+    changing anything) if the file is not in that format.  Raises IOError if
+    the file cannot be written."""
+    header = read_bmp_header(file_name)
+    if not header or len(header) < 54 or header[:2] != b"BM":
+        return False
+    pixel_offset = struct.unpack_from("<I", header, 10)[0]
+    width, height, planes, bits, compression = struct.unpack_from(
+                                                   "<iiHHI", header, 18)
+    if (bits != 24 or compression != 0 or width != image.shape[1]
+            or abs(height) != image.shape[0]):
+        return False
+    row_stride = (width * 3 + 3) & ~3 # rows are padded to four bytes
+    kept_file_name = None
+    if spare_rects is not None and read_bmp_header(spare_file_name) == header:
+        tmp_file_name = spare_file_name
+        patched_rects = list(spare_rects) + list(rects)
+    else:
+        tmp_file_name = temp_file_name(file_name)
+        patched_rects = rects
+    try:
+        if tmp_file_name != spare_file_name:
+            shutil.copyfile(file_name, tmp_file_name)
+        with open(tmp_file_name, "r+b") as bmp_file:
+            for y, x, y_size, x_size in patched_rects:
+                for row in range(y, y + y_size):
+                    file_row = image.shape[0] - 1 - row if height > 0 else row # bottom-up
+                    bmp_file.seek(pixel_offset + file_row * row_stride + x * 3)
+                    bmp_file.write(image[row, x:x+x_size, ::-1].tobytes()) # BGR order
+        if spare_file_name and hasattr(os, "link"):
+            kept_file_name = temp_file_name(spare_file_name)
+            try:
+                os.link(file_name, kept_file_name)
+            except OSError: # not on this filesystem; the next call copies the file
+                kept_file_name = None
+        replace_file(tmp_file_name, file_name)
+    except BaseException:
+        for unused_file_name in [tmp_file_name, kept_file_name]:
+            try:
+                if unused_file_name:
+                    os.remove(unused_file_name)
+            except OSError:
+                pass
+        raise
+    if kept_file_name:
+        try:
+            replace_file(kept_file_name, spare_file_name)
+        except OSError: # the file is replaced anyway, just not kept
+            try:
+                os.remove(kept_file_name)
+            except OSError:
+                pass
+    return True
+
+
+def render_background(display_res_list, yx_origin=None):
+    """Select an image for each display in display_res_list (or one image for
+    all of them, with the oneimage option) and create the large, combined
+    image, with the Windows correction for the origin yx_origin if it is set.
+    Returns a 2-tuple of the giant image and the list of the image filenames
+    used."""
+    bg_image_names = select_background_images(display_res_list)
+    return create_giant_image(bg_image_names, display_res_list,
+                              yx_origin=yx_origin)
+
+
+def select_background_images(display_res_list):
+    """Return a list of the image filenames selected for the displays in
+    display_res_list (a single one with the oneimage option)."""
+    bg_image_names = []
+    for count, disp_res in enumerate(display_res_list):
+        image_name = get_next_background_image(disp_res, display_res_list)
+        if not image_name:
+            print("\nError in makeSpanningBackground: No suitable image files"
+                  "\nfound for display", str(count)+".\n", file=sys.stderr)
+            sys.exit(1)
         if args.verbose:
-            print("Correcting the origin of the image (on Windows OS).")
-        giant_image = correct_windows_origin(giant_image)
+            print("Image selected for display", count, "is\n   ", image_name, "\n")
+        bg_image_names.append(image_name)
+        if args.oneimage:
+            break
+    return bg_image_names
+
+
+def write_background(file_name, display_res_list, yx_origin=None):
+    """Select the images for the displays in display_res_list and write the
+    combined image to the file file_name, with the Windows correction for the
+    origin yx_origin if it is set.  A BMP file is composed directly in a
+    memory map of the file.  With the '--streamed' option and an output
+    format with a row writer the image is composed and written in bands of
+    rows.  Otherwise the whole image is made and then saved.  Returns
+    the list of the image filenames used.  Raises IOError if the file cannot
+    be written."""
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == ".bmp":
+        bg_image_names = select_background_images(display_res_list)
+        return write_memmap_bmp_image(file_name, bg_image_names, display_res_list,
+                                      yx_origin)
+    if args.streamed and extension in row_writers:
+        bg_image_names = select_background_images(display_res_list)
+        return write_streamed_image(file_name, row_writers[extension],
+                                    bg_image_names, display_res_list,
+                                    yx_origin=yx_origin)
+    giant_image, bg_image_names = render_background(display_res_list, yx_origin)
+    save_image_file(file_name, giant_image)
+    return bg_image_names
+
+
+def save_image_file(file_name, image):
+    """Save the RGB ndimage image to the file file_name, in the format given
+    by its suffix.  The array is handed to PIL as a buffer rather than being
+    converted to an image first (as sp.misc.imsave does), so it is not copied
+    unless it is non-contiguous or PIL must repack it.  Raises IOError if the
+    file cannot be written."""
+    image = np.ascontiguousarray(image)
+    im = Image.frombuffer("RGB", (image.shape[1], image.shape[0]), image,
+                          "raw", "RGB", 0, 1)
+    im.save(file_name)
+
+
+def create_bmp_file(file_name, yx_size):
+    """Create the file file_name as an uncompressed 24-bit BMP file of (y, x)
+    size yx_size, with all the pixels zero.  Returns a 3-tuple of the file,
+    open for writing, the offset of the pixel data in the file, and the number
+    of bytes in each row (which are padded to a multiple of four)."""
+    row_stride = (yx_size[1] * 3 + 3) & ~3
+    pixel_offset = 14 + 40
+    file_size = pixel_offset + row_stride * yx_size[0]
+    bmp_file = open(file_name, "w+b")
+    try:
+        bmp_file.write(struct.pack("<2sIHHI", b"BM", file_size, 0, 0, pixel_offset))
+        bmp_file.write(struct.pack("<IiiHHIIiiII", 40, yx_size[1], yx_size[0],
+                                   1, 24, 0, row_stride * yx_size[0],
+                                   2835, 2835, 0, 0))
+        bmp_file.truncate(file_size)
+    except (IOError, OSError):
+        bmp_file.close()
+        raise
+    return bmp_file, pixel_offset, row_stride
+
+
+def write_memmap_bmp_image(file_name, image_names, disp_res_list, yx_origin=None):
+    """Write the combined image for the image files in image_names on the
+    displays in disp_res_list, with the Windows correction for the origin
+    yx_origin if it is set, to the BMP file file_name by composing it
+    directly in a memory map of the file, so the giant image is never held
+    in memory and there is no encoding step.  BMP rows are stored bottom-up
+    in BGR order, so the giant image is a view of the map with the rows and
+    the colors reversed.  The image is composed in a temporary file which
+    then replaces file_name, so the current background is never seen half
+    drawn and a failure leaves the old file as it was.  Returns the list of
+    the image filenames actually used.  Raises IOError if the file cannot be
+    written."""
+    max_y, max_x = get_bounding_box(disp_res_list)
+    tmp_file_name = temp_file_name(file_name)
+    bmp_file, pixel_offset, row_stride = create_bmp_file(tmp_file_name, (max_y, max_x))
+    bmp_file.close()
+    if args.verbose:
+        print("Composing a large image of size", (max_y, max_x),
+              "\ndirectly in a temporary file next to the output file.")
+    try:
+        try:
+            pixel_map = np.memmap(tmp_file_name, np.uint8, "r+", offset=pixel_offset,
+                                  shape=(max_y, row_stride))
+        except (ValueError, OSError) as e: # such as a failed mmap
+            raise IOError(str(e))
+        try:
+            # Only the last axis of the sliced map is split by the reshape, and
+            # its stride is one byte, so the reshape always gives a view.  A
+            # copy would be composed and then thrown away, leaving a black
+            # file, so that is checked (a copy would not overlap the map).
+            giant_image = pixel_map[::-1, :max_x*3].reshape(max_y, max_x, 3)[:, :, ::-1]
+            if not np.may_share_memory(giant_image, pixel_map):
+                raise IOError("The memory map of the BMP file was copied.")
+            image_names = create_giant_image(image_names, disp_res_list,
+                                             giant_image, yx_origin=yx_origin)[1]
+            pixel_map.flush()
+        finally:
+            giant_image = None
+            del pixel_map # closes the map, which Windows requires before the rename
+        replace_file(tmp_file_name, file_name)
+    except BaseException:
+        try:
+            os.remove(tmp_file_name)
+        except OSError:
+            pass
+        raise
+    return image_names
+
+
+class PngRowWriter(object):
+    """Write an RGB PNG file from bands of rows, which must be given in order
+    from the top.  Each row is encoded with the "Up" filter and the bands are
+    compressed as they come, each giving an IDAT chunk."""
+
+    def __init__(self, file_name, yx_size):
+        self.yx_size = yx_size
+        self.png_file = open(file_name, "wb")
+        self.png_file.write(b"\x89PNG\r\n\x1a\n")
+        self.write_chunk(b"IHDR", struct.pack(">IIBBBBB", yx_size[1], yx_size[0],
+                                              8, 2, 0, 0, 0))
+        self.compressor = zlib.compressobj(6)
+        self.prev_row = np.zeros((yx_size[1] * 3,), np.uint8)
+        self.next_y = 0
+
+    def write_chunk(self, chunk_type, data):
+        self.png_file.write(struct.pack(">I", len(data)) + chunk_type + data +
+                            struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff))
+
+    def write_rows(self, y_start, rows):
+        """Write the RGB ndimage rows as the rows starting at y_start."""
+        if y_start != self.next_y:
+            raise ValueError("PNG rows must be written in order.")
+        flat_rows = rows.reshape(rows.shape[0], -1)
+        filtered = np.empty((rows.shape[0], flat_rows.shape[1] + 1), np.uint8)
+        filtered[:, 0] = 2 # the Up filter, the difference from the row above
+        filtered[0, 1:] = flat_rows[0] - self.prev_row # uint8 arithmetic wraps
+        filtered[1:, 1:] = flat_rows[1:] - flat_rows[:-1]
+        data = self.compressor.compress(filtered.tobytes())
+        if data:
+            self.write_chunk(b"IDAT", data)
+        self.prev_row = flat_rows[-1].copy()
+        self.next_y += rows.shape[0]
+
+    def close(self):
+        try:
+            if self.next_y == self.yx_size[0]:
+                self.write_chunk(b"IDAT", self.compressor.flush())
+                self.write_chunk(b"IEND", b"")
+        finally:
+            self.png_file.close()
+
+
+row_writers = {".png": PngRowWriter} # BMP files are written with a memory map
+
+
+def write_streamed_image(file_name, row_writer_class, image_names, disp_res_list,
+                         band_rows=256, yx_origin=None):
+    """Write the combined image for the image files in image_names on the
+    displays in disp_res_list to the file file_name, with a writer of the
+    class row_writer_class, without ever making the whole giant image.  The
+    scaled images (tiles) for the displays are made first, and then each band
+    of band_rows rows of the giant image is composed from them and written.
+    The Windows correction for the origin yx_origin, if it is set, is done by
+    writing the bands in a rotated order, with their columns rotated.  The
+    image is written to a temporary file which then replaces file_name, as in
+    write_memmap_bmp_image.  Returns the list of the image filenames actually
+    used.  Raises IOError if the file cannot be written."""
+    image_names = list(image_names)
+    max_y, max_x = get_bounding_box(disp_res_list)
+    if args.verbose:
+        print("Writing a large image of size", (max_y, max_x), "in bands of",
+              band_rows, "rows.")
+
+    # Get the tiles for all the displays.  These are copied to the bands in
+    # the display order, so overlapping displays come out as usual.
+    counts = list(range(len(image_names) if args.oneimage else len(disp_res_list)))
+    def get_tiles(count):
+        return image_tiles(image_names[count], disp_res_list, count)
+    tiles = sum(for_each_image(get_tiles, image_names, disp_res_list, counts), [])
+
+    # The fill colors, as in create_giant_image.  Every pixel of a band is
+    # written, so the gaps are black if there is no fill color.
+    rgb_bytes = background_fill_color(gaps=True) or [np.uint8(0)] * 3
+    fit_bytes = background_fill_color()
+
+    # The Windows correction maps row y and column x of the giant image to
+    # (y - y0) and (x - x0) modulo the size, so the rows are written starting
+    # with row y0 and each band is rotated left by x0 columns.
+    y0, x0 = 0, 0
+    if yx_origin is not None:
+        y0, x0 = yx_origin
+    band_starts = (list(range(y0, max_y, band_rows)) +
+                   list(range(0, y0, band_rows)))
+
+    tmp_file_name = temp_file_name(file_name)
+    try:
+        row_writer = row_writer_class(tmp_file_name, (max_y, max_x))
+        try:
+            for band_start in band_starts:
+                band_end = min(band_start + band_rows, max_y if band_start >= y0 else y0)
+                band = np.empty((band_end - band_start, max_x, 3), np.uint8)
+                band[:, :] = rgb_bytes
+                if args.oneimage and args.fitimage:
+                    for disp_res in disp_res_list:
+                        top = max(disp_res[2], band_start)
+                        bottom = min(disp_res[2] + disp_res[0], band_end)
+                        if top < bottom:
+                            band[top-band_start:bottom-band_start,
+                                 disp_res[3]:disp_res[3]+disp_res[1]] = fit_bytes
+                for tile, yx_to_start in tiles:
+                    top = max(yx_to_start[0], band_start)
+                    bottom = min(yx_to_start[0] + tile.shape[0], band_end)
+                    if top < bottom:
+                        copy_subimage((bottom - top, tile.shape[1]), tile,
+                                      (top - yx_to_start[0], 0), band,
+                                      (top - band_start, yx_to_start[1]))
+                if x0:
+                    band = np.concatenate((band[:, x0:], band[:, :x0]), axis=1)
+                row_writer.write_rows((band_start - y0) % max_y, band)
+        finally:
+            row_writer.close()
+        replace_file(tmp_file_name, file_name)
+    except BaseException:
+        try:
+            os.remove(tmp_file_name)
+        except OSError:
+            pass
+        raise
+    return image_names
+
+
+def file_stat(file_name):
+    """Return a tuple of the modification time and size of the file file_name,
+    or None if it does not exist."""
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
 
-    # plt.imshow(giant_image)
-    # plt.show() # for debugging
-    return giant_image
+
+def temp_file_name(file_name):
+    """Return the name to write the file file_name under before renaming it.
+    The name is unique to this process and thread, since the cache directory
+    can be shared by several programs at once (see the '--serve' option)."""
+    return "{0}.{1}-{2}.tmp".format(file_name, os.getpid(),
+                                    threading.current_thread().ident)
+
+
+def replace_file(from_file_name, to_file_name):
+    """Rename the file from_file_name to to_file_name, replacing any existing
+    file by that name (atomically, where the OS allows it)."""
+    try:
+        os.replace(from_file_name, to_file_name)
+    except AttributeError: # no os.replace in Python 2
+        if system_os == "Windows" and os.path.exists(to_file_name):
+            os.remove(to_file_name)
+        os.rename(from_file_name, to_file_name)
+
+
+def lower_thread_priority(increment=10):
+    """Raise the niceness of the current thread by increment, if the OS
+    allows setting it per thread (Linux does).  Otherwise do nothing."""
+    try:
+        thread_id = threading.get_native_id()
+        niceness = os.getpriority(os.PRIO_PROCESS, thread_id)
+        os.setpriority(os.PRIO_PROCESS, thread_id, min(19, niceness + increment))
+    except (AttributeError, OSError):
+        pass
+
+
+class BackgroundPrefetcher(object):
+    """Render the next combined image while sleeping in '--timedelay' mode, so
+    that it only has to be swapped in when the time comes.  The last
+    max_layouts display layouts seen are remembered (only the current one by
+    default, more with the '--layouts' option), and an image is kept ready
+    for each of them, so the image for a known layout is ready as soon as the
+    displays change to it.  The rendering is done in a single background
+    thread at a lowered priority, and each image is written to a temporary
+    file next to the output file.  The image for a layout which is forgotten
+    is thrown away, and its image files are put back into the image list,
+    so that they are not skipped."""
+    def __init__(self, save_file_name, max_layouts=1):
+        self.save_file_name = save_file_name
+        self.max_layouts = max_layouts
+        self.layouts = [] # the remembered layouts, the most recent first
+        self.ready = {} # layout -> (image filenames, library) of its ready image
+        self.thread = None
+        self.stop_requested = False
+        self.library_watcher = None # applies image directory changes before drawing
+
+    def layout_key(self, display_res_list, yx_origin=None):
+        """Return the layout of the displays in display_res_list.  This
+        includes the origin yx_origin of the Windows correction, since the
+        image also depends on it."""
+        return (tuple(tuple(d) for d in display_res_list), yx_origin)
+
+    def prefetch_file_name(self, layout):
+        """Return the name of the temporary file for the image for layout."""
+        root, ext = os.path.splitext(self.save_file_name)
+        layout_hash = hashlib.sha1(repr(layout).encode("utf-8")).hexdigest()
+        return root + ".prefetch-" + layout_hash[:12] + ext
+
+    def remember(self, display_res_list, yx_origin=None):
+        """Make the layout display_res_list (with the Windows origin
+        yx_origin) the most recent one, forgetting the oldest layout if there
+        are too many."""
+        layout = self.layout_key(display_res_list, yx_origin)
+        if layout in self.layouts:
+            self.layouts.remove(layout)
+        self.layouts.insert(0, layout)
+        for old_layout in self.layouts[self.max_layouts:]:
+            if args.verbose:
+                print("\nForgetting the display layout", old_layout[0])
+            self.discard(old_layout)
+        del self.layouts[self.max_layouts:]
+
+    def discard(self, layout):
+        """Throw away the image made for layout, if there is one, and put its
+        image files back into the image list they were drawn from."""
+        ready = self.ready.pop(layout, None)
+        if ready:
+            put_back_library_files(*ready)
+        try:
+            os.remove(self.prefetch_file_name(layout))
+        except OSError:
+            pass
+
+    def discard_all(self):
+        """Stop rendering and throw away all the images made ahead."""
+        self.wait()
+        for layout in self.layouts:
+            self.discard(layout)
+
+    def start(self, display_res_list, yx_origin=None, library_watcher=None):
+        """Remember the current display layout display_res_list (with the
+        Windows origin yx_origin) and start rendering images for the
+        remembered layouts which have none ready, the current one first, in
+        the background thread.  If library_watcher is set, any changes it has
+        seen are applied to the image list before the images for each layout
+        are selected."""
+        self.remember(display_res_list, yx_origin)
+        self.library_watcher = library_watcher
+        self.stop_requested = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """Render the images; this is run by the background thread."""
+        lower_thread_priority()
+        # Do all the work in this one thread, rather than on the worker pool
+        # at normal priority.
+        worker_state.in_worker = True
+        for layout in self.layouts:
+            if self.stop_requested:
+                break
+            if layout in self.ready:
+                continue
+            display_res_list, yx_origin = layout
+            try:
+                if self.library_watcher:
+                    self.library_watcher.update()
+                bg_image_names = write_background(self.prefetch_file_name(layout),
+                                                  display_res_list, yx_origin)
+                self.ready[layout] = (bg_image_names, current_library())
+            except (Exception, SystemExit) as e:
+                if args.verbose:
+                    print("\nPrefetching an image failed, it will be made when"
+                          "\nit is needed.  The reported error was:\n", e)
+        close_thread_pools()
+
+    def wait(self):
+        """Wait for the image being rendered, if any, to be finished, and
+        stop rendering the images after it."""
+        if self.thread:
+            self.stop_requested = True
+            self.thread.join()
+            self.thread = None
+
+    def take(self, display_res_list, yx_origin=None):
+        """Move the image made for the layout display_res_list (with the
+        Windows origin yx_origin) into place as the output file, if there is
+        one.  Returns the list of the image filenames used, or None if there
+        is no image for the layout or it cannot be moved into place."""
+        self.wait()
+        layout = self.layout_key(display_res_list, yx_origin)
+        if layout not in self.ready:
+            if args.verbose and self.layouts and layout != self.layouts[0]:
+                print("\nNo image is ready for the new display layout.")
+            return None
+        try:
+            replace_file(self.prefetch_file_name(layout), self.save_file_name)
+        except OSError as e:
+            print("\nWarning from makeSpanningBackground: Could not save to file"
+                  "\n   " + self.save_file_name, "\nThe reported error was:\n", e,
+                  file=sys.stderr)
+            self.discard(layout) # its image files are put back, to be drawn again
+            return None
+        bg_image_names = self.ready.pop(layout)[0]
+        if args.verbose:
+            print("\nUsing the image made ahead for this display layout, written"
+                  " to the file\n   " + self.save_file_name)
+        return bg_image_names
 
 
 def set_image_as_current_wallpaper(image_file_name):
@@ -1053,7 +4015,7 @@ def set_image_as_current_wallpaper(image_file_name):
         if args.verbose:
             print("\nSetting background on Linux OS.")
 
-        current_env = os.environ.copy()
+        current_env = dict(command_environment())
         current_env["DISPLAY"] = ":0" # in case run from where DISPLAY isn't set
 
         # Find out what window manager is currently in use.
@@ -1067,7 +4029,7 @@ def set_image_as_current_wallpaper(image_file_name):
             # --wallpaper-mode=MODE      MODE=(color|stretch|fit|center|tile)
             try:
                 subprocess.call(["pcmanfm", "--set-wallpaper", image_file_name,
-                                 "--wallpaper-mode=fit"])
+                                 "--wallpaper-mode=fit"], env=current_env)
             except OSError as e:
                 print("\nError attempting to run 'pcmanfm'.  Be sure the program"
                       "\nis installed on your system.  The image was apparently"
@@ -1195,15 +4157,935 @@ def set_image_as_current_wallpaper(image_file_name):
               "\nthe current background wallpaper.", file=sys.stderr)
 
 
+monotonic_time = getattr(time, "monotonic", time.time) # monotonic is in Python 3.3+
+
+
+class BackgroundDaemon(object):
+    """Run the iterations of the program: collect the display information,
+    make the combined image, and set it as the background.  Without
+    '--timedelay' there is just one iteration.  With it the iterations start
+    at a fixed rate, on deadlines which are one interval apart regardless of
+    how long each image takes to make.  Between them this thread waits in a
+    select loop for the next deadline, a change of the display layout, or a
+    command on the control socket (the '--control' option).  Each image is
+    made on a separate render thread, so that commands are still handled
+    while an image is being made; an image which is asked for in the meantime
+    is made right after it.  If keep_warm is set (in the resident program)
+    then the library watcher and the prefetcher are started even after a
+    single iteration, so that they are ready if run is called again."""
+
+    def __init__(self, save_file_name, keep_warm=False):
+        self.save_file_name = save_file_name
+        self.keep_warm = keep_warm
+        self.display_monitor = make_display_monitor() # keeps the current display layout
+        self.library_watcher = None # watches the image dirs, after the first iteration
+        self.prefetcher = None # renders the next images while sleeping, with '--prefetch'
+        self.rotating_canvas = None # keeps the image between iterations, with '--rotate'
+        self.saved_file_stat = None # the file_stat of the output file when last written
+        # With '--rotate' a BMP output file is patched in a spare copy of the
+        # version written before it, which differs from it in spare_rects.
+        root, ext = os.path.splitext(save_file_name)
+        self.spare_file_name = root + ".spare" + ext
+        self.spare_file_stat = None # the file_stat of the spare file when kept
+        self.spare_rects = None
+        if args.rotate and args.timedelay:
+            self.rotating_canvas = RotatingCanvas(args.rotate[0])
+        self.interval = args.timedelay[0] * 60.0 if args.timedelay else None
+        self.deadline = None # the monotonic time of the next timed iteration
+        self.last_start_time = None # the monotonic time the last iteration started
+        self.render_reason = "first" # the reason for the next image, if one is due
+        self.render_thread = None
+        self.render_done = False # set by the render thread when it is done
+        self.render_error = None # any exception raised in the render thread
+        self.paused = False
+        self.reload_requested = False
+        self.quitting = False
+        # The render thread writes to this pipe when it finishes, to wake the
+        # select loop.  On Windows select only works with sockets, so there
+        # the render thread is simply joined instead.
+        self.wake_fd = self.wake_write_fd = None
+        if system_os != "Windows":
+            self.wake_fd, self.wake_write_fd = os.pipe()
+        self.control_socket = None
+        self.control_socket_path = None
+        if args.control and args.timedelay:
+            self.open_control_socket(process_path(args.control[0]))
+
+    def open_control_socket(self, socket_path):
+        """Listen for commands on a Unix-domain socket at socket_path.  A
+        leftover socket file from a program which is no longer running is
+        removed first."""
+        if not hasattr(socket, "AF_UNIX"):
+            print("\nWarning from makeSpanningBackground: Unix-domain sockets are"
+                  "\nnot available on this system, ignoring the '--control' option.",
+                  file=sys.stderr)
+            return
+        if os.path.exists(socket_path):
+            if send_control_command(socket_path, "status") is not None:
+                path_error_exit(socket_path, "Another running program is already"
+                                " listening on the control socket.")
+            try:
+                os.remove(socket_path)
+            except OSError:
+                path_error_exit(socket_path, "Could not remove the old control socket.")
+        control_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177) # only this user can connect, from the start
+        try:
+            control_socket.bind(socket_path)
+            control_socket.listen(5)
+        except (socket.error, OSError):
+            control_socket.close()
+            path_error_exit(socket_path, "Could not create the control socket.")
+        finally:
+            os.umask(old_umask)
+        self.control_socket = control_socket
+        self.control_socket_path = socket_path
+        if args.verbose:
+            print("\nListening for commands on the control socket\n   " + socket_path)
+
+    def run(self):
+        """Run the iterations until the program is stopped (with the 'quit'
+        command) or, without '--timedelay', until the first one is done."""
+        while not self.quitting:
+            if self.render_thread is None:
+                if (self.render_reason is None and self.deadline is not None
+                        and not self.paused and monotonic_time() >= self.deadline):
+                    self.render_reason = "timer"
+                if self.render_reason is not None:
+                    self.start_render()
+            timeout = None
+            if self.render_thread is None and not self.paused:
+                timeout = max(0.0, self.deadline - monotonic_time())
+            self.wait_for_events(timeout)
+            if self.render_thread and self.render_done:
+                self.finish_render()
+
+    def start_again(self):
+        """Make the next call of run do another iteration, after an earlier
+        call has returned without '--timedelay'."""
+        self.quitting = False
+        self.render_reason = "first"
+
+    def start_render(self):
+        """Collect the display information and start making and setting the
+        image for it on the render thread.  Also sets the next deadline."""
+        display_res_list = self.display_monitor.current_layout()
+        yx_origin = windows_origin() # set along with the display information
+        num_displays = len(display_res_list)
+        if num_displays == 0:
+            print("\nError in makeSpanningBackground: No displays detected."
+                  "\nMaybe try explicitly setting the resolutions with the"
+                  "\n'--reslist' option.\n")
+            sys.exit(1)
+        if args.verbose:
+            print("\nDetected", num_displays, "displays:\n   ", display_res_list,
+                  "\n")
+
+        # The deadlines stay on a fixed grid, so the time to make the images
+        # does not add up.  Any deadlines missed while making an image are
+        # skipped.  A new image asked for with the 'next' command restarts the
+        # grid, while one for a layout change leaves it as it was.
+        start_time = monotonic_time()
+        if self.interval is not None:
+            if self.render_reason in ("first", "next"):
+                self.deadline = start_time + self.interval
+            elif self.render_reason == "timer":
+                while self.deadline <= start_time:
+                    self.deadline += self.interval
+        self.last_start_time = start_time
+        self.render_reason = None
+
+        self.render_done = False
+        self.render_error = None
+        self.render_thread = threading.Thread(target=self.render_in_thread,
+                                              args=(display_res_list, yx_origin))
+        self.render_thread.daemon = True
+        self.render_thread.start()
+
+    def render_in_thread(self, display_res_list, yx_origin):
+        """Run render, saving any exception for the main thread; this is run
+        by the render thread."""
+        try:
+            self.render(display_res_list, yx_origin)
+        except BaseException as e:
+            self.render_error = e
+        finally:
+            self.render_done = True
+            if self.wake_write_fd is not None:
+                os.write(self.wake_write_fd, b"x")
+
+    def finish_render(self):
+        """Wait for the render thread to finish, raising any exception it
+        raised."""
+        self.render_thread.join()
+        self.render_thread = None
+        if self.render_error is not None:
+            render_error, self.render_error = self.render_error, None
+            raise render_error
+        if not args.timedelay:
+            self.quitting = True
+        elif args.verbose and not self.quitting:
+            if self.paused:
+                print("\n"+"-"*10, "Paused, waiting for a command.", "-"*30)
+            else:
+                minutes = max(0.0, self.deadline - monotonic_time()) / 60.0
+                print("\n"+"-"*10, "Sleeping for", round(minutes, 2), "minutes.",
+                      "-"*30)
+
+    def wait_for_events(self, timeout):
+        """Wait up to timeout seconds (or with no limit if timeout is None)
+        for the render thread to finish, the display layout to change, a
+        change in the image directories (with inotify), or a control command,
+        and handle whichever of them happens."""
+        # The library watcher is only used here between renders, since the
+        # render thread may replace it.
+        library_watcher = None if self.render_thread else self.library_watcher
+        library_fd = library_watcher.fileno() if library_watcher else None
+        read_fds = [fd for fd in [self.wake_fd, self.display_monitor.fileno(),
+                                  library_fd] if fd is not None]
+        if self.control_socket:
+            read_fds.append(self.control_socket)
+        if not read_fds: # Windows, with nothing to select on
+            if self.render_thread:
+                self.render_thread.join(timeout)
+            else:
+                time.sleep(timeout)
+            return
+        try:
+            readable = select.select(read_fds, [], [], timeout)[0]
+        except (select.error, OSError) as e: # select.error in Python 2
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        if self.wake_fd in readable:
+            os.read(self.wake_fd, 4096)
+        if self.display_monitor.fileno() in readable:
+            if self.display_monitor.update():
+                if args.verbose:
+                    print("\nThe display layout changed, making a new image now.")
+                if self.render_reason is None:
+                    self.render_reason = "layout"
+        if library_fd is not None and library_fd in readable:
+            library_watcher.update() # so a prefetch sees the changes
+        if self.control_socket in readable:
+            self.handle_control_connection()
+
+    def handle_control_connection(self):
+        """Accept a connection on the control socket, read a command line
+        from it, and send back the reply line."""
+        try:
+            connection = self.control_socket.accept()[0]
+        except (socket.error, OSError):
+            return
+        try:
+            connection.settimeout(5.0)
+            request = b""
+            while b"\n" not in request and len(request) < 4096:
+                data = connection.recv(4096)
+                if not data:
+                    break
+                request += data
+            reply = self.do_command(request.decode("utf-8", "replace").strip())
+            connection.sendall((reply + "\n").encode("utf-8"))
+        except (socket.error, OSError) as e:
+            if args.verbose:
+                print("\nError on the control socket:", e)
+        finally:
+            connection.close()
+
+    def do_command(self, command):
+        """Carry out the control command string command and return the reply
+        string."""
+        if args.verbose:
+            print("\nReceived the control command:", repr(command))
+        words = command.split()
+        if not words:
+            return "error empty command"
+        if words[0] == "next" and len(words) == 1:
+            self.render_reason = "next"
+        elif words[0] == "pause" and len(words) == 1:
+            self.paused = True
+        elif words[0] == "resume" and len(words) == 1:
+            self.paused = False
+        elif words[0] == "reload" and len(words) == 1:
+            self.reload_requested = True
+        elif words[0] == "interval" and len(words) == 2:
+            try:
+                minutes = float(words[1])
+            except ValueError:
+                minutes = 0.0
+            if not minutes > 0.0:
+                return "error the interval must be a positive number of minutes"
+            self.interval = minutes * 60.0
+            self.deadline = self.last_start_time + self.interval
+        elif words[0] == "status" and len(words) == 1:
+            minutes = max(0.0, self.deadline - monotonic_time()) / 60.0
+            return ("ok interval {0:g} next {1:.2f} paused {2} rendering {3}".format(
+                    self.interval / 60.0, minutes, int(self.paused),
+                    int(self.render_thread is not None)))
+        elif words[0] == "quit" and len(words) == 1:
+            self.quitting = True
+        else:
+            return "error unknown command"
+        return "ok"
+
+    def render(self, display_res_list, yx_origin=None):
+        """Make the image for the displays in display_res_list, with the
+        Windows correction for the origin yx_origin if it is set, and set it
+        as the background; this is run by the render thread."""
+        # Any prefetch must be done before the library is changed.  It is
+        # waited for here rather than on the main thread, so that commands and
+        # display changes are still handled in the meantime.
+        if self.prefetcher:
+            self.prefetcher.wait()
+
+        # Apply any changes to the image directories since the last iteration,
+        # or reload the whole list of images if that was asked for.
+        if self.reload_requested:
+            self.reload_requested = False
+            if args.verbose:
+                print("\nReloading the list of image files.")
+            reload_library()
+            if self.library_watcher:
+                self.library_watcher.close()
+                self.library_watcher = None
+        if self.library_watcher:
+            self.library_watcher.update()
+
+        # Use the image prefetched while sleeping, if there is one for the
+        # current layout.  Otherwise make the large, combined image now.
+        save_file_name = self.save_file_name
+        bg_image_names = None
+        if self.prefetcher:
+            bg_image_names = self.prefetcher.take(display_res_list, yx_origin)
+        if bg_image_names is None:
+            changed_rects = None
+            giant_image = None
+            if self.rotating_canvas:
+                giant_image, bg_image_names, changed_rects = \
+                    self.rotating_canvas.render(display_res_list, yx_origin)
+
+            # Write out the giant image to a file.  If only some displays
+            # changed and the file is still the one last written, then with
+            # the BMP format only the changed rectangles are rewritten.
+            try:
+                if giant_image is None:
+                    if args.verbose:
+                        print("\nWriting the combined image to the file\n   "
+                              + save_file_name)
+                    bg_image_names = write_background(save_file_name,
+                                                      display_res_list, yx_origin)
+                elif (changed_rects is not None and self.saved_file_stat is not None
+                        and file_stat(save_file_name) == self.saved_file_stat
+                        and patch_bmp_file(save_file_name, giant_image,
+                                           changed_rects, self.spare_file_name,
+                                           self.current_spare_rects())):
+                    if args.verbose:
+                        print("\nRewrote the changed displays in the file\n   "
+                              + save_file_name)
+                    self.spare_file_stat = file_stat(self.spare_file_name)
+                    self.spare_rects = changed_rects
+                else:
+                    if args.verbose:
+                        print("\nWriting the combined image to the file\n   "
+                              + save_file_name)
+                    save_image_file(save_file_name, giant_image)
+                    self.spare_rects = None
+                self.saved_file_stat = file_stat(save_file_name)
+            except IOError as e:
+                self.saved_file_stat = None
+                self.spare_rects = None
+                print("\nWarning from makeSpanningBackground: Could not save to file"
+                      "\n   " + save_file_name, "\nThe reported error was:\n", e,
+                      file=sys.stderr)
+            giant_image = None # free the memory before sleeping
+        else:
+            self.saved_file_stat = None
+
+        if args.logcurrent:
+            expanded_log_name = process_path(args.logcurrent[0]) # tilde expand
+            # TODO make sure this is not a directory first
+            current_images_log = open(expanded_log_name, "w")
+            for count, img in enumerate(bg_image_names):
+                print("Image on display", count, "is\n   ", img, "\n",
+                      file=current_images_log)
+            current_images_log.close()
+
+        if not args.dontapply:
+            if args.verbose:
+                print("\nSetting the new image as the current background wallpaper.")
+                if system_os == "Windows":
+                    print("(Be sure to set wallpaper mode to 'tiled' in Windows.)")
+            set_image_as_current_wallpaper(save_file_name)
+
+        image_index.save()
+        close_thread_pools() # any prefetch makes new ones in its thread
+
+        if not args.timedelay and not self.keep_warm:
+            return
+
+        # Start watching the image directories, now that the image list has
+        # been loaded.  New images will be used without waiting for a reload.
+        if not self.library_watcher:
+            self.library_watcher = make_library_watcher()
+        if ((args.prefetch or args.layouts or self.keep_warm)
+                and not self.rotating_canvas):
+            if not self.prefetcher:
+                self.prefetcher = BackgroundPrefetcher(save_file_name,
+                                                       args.layouts[0] if args.layouts else 1)
+            self.prefetcher.start(display_res_list, yx_origin, self.library_watcher)
+
+    def current_spare_rects(self):
+        """Return the rectangles in which the spare file for patching the
+        output file differs from it, or None if that file is not the one kept
+        by the last patch (so it cannot be used)."""
+        if self.spare_rects is None or self.spare_file_stat is None:
+            return None
+        if file_stat(self.spare_file_name) != self.spare_file_stat:
+            return None
+        return self.spare_rects
+
+    def close(self):
+        """Wait for any work in progress and release the resources."""
+        if self.render_thread:
+            self.render_thread.join()
+            self.render_thread = None
+        if self.prefetcher:
+            self.prefetcher.discard_all()
+        if self.rotating_canvas:
+            try:
+                os.remove(self.spare_file_name)
+            except OSError:
+                pass
+        if self.library_watcher:
+            self.library_watcher.close()
+        self.display_monitor.close()
+        if self.control_socket:
+            self.control_socket.close()
+            self.control_socket = None
+            try:
+                os.remove(self.control_socket_path)
+            except OSError:
+                pass
+        if self.wake_fd is not None:
+            os.close(self.wake_fd)
+            os.close(self.wake_write_fd)
+            self.wake_fd = self.wake_write_fd = None
+
+
+def send_control_command(socket_path, command, timeout=5.0):
+    """Send the command string command to a running program listening on the
+    control socket at socket_path, and return its reply string.  Returns None
+    if no program is listening there."""
+    client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client_socket.settimeout(timeout)
+        client_socket.connect(socket_path)
+        client_socket.sendall((command + "\n").encode("utf-8"))
+        reply = b""
+        while b"\n" not in reply:
+            data = client_socket.recv(4096)
+            if not data:
+                break
+            reply += data
+        return reply.decode("utf-8", "replace").strip()
+    except (socket.error, OSError):
+        return None
+    finally:
+        client_socket.close()
+
+
+def listen_on_user_socket(socket_path):
+    """Return a socket listening on the Unix-domain socket socket_path, which
+    only this user can connect to, or None if another program is already
+    listening on it.  A leftover socket file from a program which was killed
+    is removed first.  If the file was already removed by another program
+    starting at the same time, the bind is just tried again."""
+    if os.path.exists(socket_path):
+        probe_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe_socket.connect(socket_path)
+            return None
+        except (socket.error, OSError):
+            try:
+                os.remove(socket_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        finally:
+            probe_socket.close()
+    server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177) # only this user can connect
+    try:
+        server_socket.bind(socket_path)
+    except (socket.error, OSError): # another one was started at the same time
+        server_socket.close()
+        return None
+    finally:
+        os.umask(old_umask)
+    server_socket.listen(16)
+    return server_socket
+
+
+def read_request(connection):
+    """Read a request line from the socket connection and return it decoded
+    from JSON, or None if it is not a valid request."""
+    request = b""
+    while b"\n" not in request:
+        data = connection.recv(65536)
+        if not data:
+            break
+        request += data
+    try:
+        request = json.loads(request.decode("utf-8"))
+    except ValueError:
+        return None
+    if not isinstance(request, dict) or not isinstance(request.get("argv"), list):
+        return None
+    return request
+
+
+def run_captured(function, *function_args):
+    """Call function with the arguments function_args and return the reply
+    dict for the client, with the exit status and the output of the call.
+    Any exit or exception is caught and reported in the reply."""
+    try:
+        from StringIO import StringIO # Python 2, which needs str rather than unicode
+    except ImportError:
+        from io import StringIO
+    import traceback
+    old_stdout, old_stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = StringIO(), StringIO()
+    output_streams = (sys.stdout, sys.stderr)
+    status = 0
+    try:
+        function(*function_args)
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            status = e.code
+        elif e.code is not None:
+            print(e.code, file=sys.stderr)
+            status = 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdout, sys.stderr = old_stdout, old_stderr
+    return {"status": status, "stdout": output_streams[0].getvalue(),
+            "stderr": output_streams[1].getvalue()}
+
+
+class ResidentServer(object):
+    """The resident program for the '--resident' option.  It listens on the
+    per-user socket socket_path and runs the commands handed over by the thin
+    clients, one at a time, until it is told to stop (with '--stopresident')
+    or killed.  Each command is run just as
+    it would be by the client, but in this one long-running process, so the
+    imports, the worker threads, the image list and index, the caches, and
+    the display monitor are all kept warm between commands.  The daemon for
+    the last command is kept as well, and it renders the next image for that
+    command ahead of time, so when the same command is run again the image
+    only has to be moved into place."""
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.server_socket = None
+        self.daemon = None # the daemon for the last command
+        self.daemon_key = None # the arguments and directory of the last command
+        self.library_key = None # the arguments which determine the image list
+
+    def listen(self):
+        """Listen on the socket.  Returns False if another resident program is
+        already listening on it."""
+        self.server_socket = listen_on_user_socket(self.socket_path)
+        return self.server_socket is not None
+
+    def run(self):
+        """Accept and run the commands, one at a time, until a stop request."""
+        try:
+            while True:
+                connection = self.server_socket.accept()[0]
+                try:
+                    connection.settimeout(5.0) # so a stuck client cannot block the server
+                    request = read_request(connection)
+                    if request is None:
+                        continue
+                    if request["argv"] == ["--stopresident"]:
+                        connection.sendall(json.dumps(
+                            {"status": 0, "stdout": "", "stderr": ""}).encode("utf-8"))
+                        return
+                    reply = self.handle_request(request)
+                    connection.sendall(json.dumps(reply).encode("utf-8"))
+                except (socket.error, OSError):
+                    pass # the client went away
+                finally:
+                    connection.close()
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop listening, removing the socket, and close the daemon for the
+        last command, which throws away the image made ahead for it."""
+        if self.daemon:
+            self.daemon.close()
+            self.daemon = None
+        if self.server_socket:
+            self.server_socket.close()
+            self.server_socket = None
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+
+    def handle_request(self, request):
+        """Run the command in the dict request, in its directory and with its
+        environment, and return the reply dict with the exit status and the
+        output of the command."""
+        # The prefetch for the last command reads the globals which are set
+        # up again for this one, and it prints to sys.stdout, so it must be
+        # finished first.  The image it is making is kept.
+        if self.daemon and self.daemon.prefetcher:
+            self.daemon.prefetcher.wait()
+        def run_request():
+            # The directory and the command environment are left as they are,
+            # since the prefetch for the command runs on after it.  The
+            # environment of this process is not changed, since its threads
+            # share it; the client's environment is only given to the programs
+            # run for the command.
+            global command_env
+            os.chdir(request["cwd"])
+            command_env = dict(request["env"])
+            self.run_command(request["argv"], request["cwd"])
+        return run_captured(run_request)
+
+    def run_command(self, argv, cwd):
+        """Run the command with the command-line arguments argv, from the
+        directory cwd.  Raises SystemExit if the program would exit early."""
+        global background_bag, aspect_buckets
+        daemon_key = (tuple(argv), cwd)
+        if self.daemon and daemon_key != self.daemon_key:
+            self.daemon.close()
+            self.daemon = None
+        save_file_name = setup_program(argv)
+        if args.timedelay:
+            print("\nError in makeSpanningBackground: The '--timedelay' option"
+                  "\ncannot be used with the '--resident' option.\n", file=sys.stderr)
+            sys.exit(1)
+
+        # Start over with a new image list if the images are not the same as
+        # for the last command.
+        library_key = (tuple(args.image_files_and_dirs), args.recursive,
+                       args.sequential, bool(args.percenterror), cwd)
+        if library_key != self.library_key:
+            if self.daemon:
+                self.daemon.close()
+                self.daemon = None
+            background_bag = ShuffleBag()
+            aspect_buckets = AspectBuckets([])
+            self.library_key = library_key
+
+        if self.daemon:
+            self.daemon.start_again()
+        else:
+            self.daemon = BackgroundDaemon(save_file_name, keep_warm=True)
+            self.daemon_key = daemon_key
+        try:
+            self.daemon.run()
+        except BaseException:
+            self.daemon.close()
+            self.daemon = None
+            raise
+        if args.verbose:
+            print("\nFinished execution of makeSpanningBackground.")
+
+
+class FairQueue(object):
+    """The waiting jobs of the render service, in a queue for each tenant.
+    The jobs are taken from the tenants in turn (round-robin), so a tenant
+    with many jobs waiting cannot hold up the jobs of the others, and the
+    jobs of each tenant are taken in the order they were put."""
+
+    def __init__(self):
+        self.queues = {} # tenant -> deque of its waiting jobs
+        self.turns = collections.deque() # the tenants with waiting jobs, in turn
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def __contains__(self, tenant):
+        """Return True if tenant has jobs waiting."""
+        return tenant in self.queues
+
+    def put(self, tenant, job):
+        """Add job to the end of the queue of tenant."""
+        if tenant not in self.queues:
+            self.queues[tenant] = collections.deque()
+            self.turns.append(tenant)
+        self.queues[tenant].append(job)
+
+    def get(self, is_ready=None):
+        """Remove and return the next job, or None if there are none.  If the
+        function is_ready is set then only the tenants for which
+        is_ready(tenant) is true are considered, and the others keep their
+        turns."""
+        for tenant in self.turns:
+            if is_ready is None or is_ready(tenant):
+                break
+        else:
+            return None
+        self.turns.remove(tenant)
+        queue = self.queues[tenant]
+        job = queue.popleft()
+        if queue:
+            self.turns.append(tenant)
+        else:
+            del self.queues[tenant]
+        return job
+
+
+class RenderService(object):
+    """The render service for the '--serve' option.  It listens on the socket
+    socket_path for the commands sent with the '--service' option, queues
+    them in a FairQueue by tenant, and runs them on num_processes worker
+    processes, until it is killed.  Each tenant is assigned to one process
+    when it is first seen (the one with the fewest tenants), and all of its
+    commands are run there, so its image list stays in that process.  Since
+    the tenant names come from the clients, only the most recently seen
+    tenants are remembered, as many as the processes keep image lists for,
+    and the others are assigned again when they come back.  Each
+    process runs one command at a time, and the next command for it is taken
+    in the fair order of the queue.  The arguments in the list default_argv
+    are put before the arguments of each command (so the command can
+    override them).  The reply to each command is sent when it is finished,
+    or an error reply if the command or its process failed."""
+
+    def __init__(self, socket_path, num_processes, default_argv, verbose=False):
+        self.socket_path = socket_path
+        self.num_processes = num_processes
+        self.default_argv = default_argv
+        self.verbose = verbose
+        self.server_socket = None
+        self.executors = [None] * num_processes # a one-process pool for each process
+        self.running = [None] * num_processes # the tenant each process is running for
+        self.tenant_processes = collections.OrderedDict() # tenant -> index of its process
+        self.max_tenants = max_service_libraries * num_processes
+        self.num_tenants = [0] * num_processes # the number of tenants of each process
+        self.queue = FairQueue()
+        self.finished = [] # the (index, connection, tenant, reply, broken) of finished jobs
+        self.finished_lock = threading.Lock()
+        # The pools' threads write to this pipe when a job finishes, to wake
+        # the select loop.
+        self.wake_fd, self.wake_write_fd = os.pipe()
+
+    def listen(self):
+        """Listen on the socket.  Returns False if another program is already
+        listening on it."""
+        self.server_socket = listen_on_user_socket(self.socket_path)
+        return self.server_socket is not None
+
+    def run(self):
+        """Accept the commands and run them on the processes."""
+        if self.verbose:
+            print("\nRender service listening on the socket\n   " + self.socket_path
+                  + "\nwith", self.num_processes, "worker processes.")
+        try:
+            while True:
+                try:
+                    readable = select.select([self.server_socket, self.wake_fd],
+                                             [], [])[0]
+                except (select.error, OSError) as e: # select.error in Python 2
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if self.wake_fd in readable:
+                    os.read(self.wake_fd, 4096)
+                    self.send_replies()
+                if self.server_socket in readable:
+                    self.accept_request()
+                self.start_jobs()
+        finally:
+            for executor in self.executors:
+                if executor:
+                    executor.shutdown(wait=False)
+
+    def accept_request(self):
+        """Accept a connection and queue the command read from it.  The
+        connection is kept open for the reply."""
+        try:
+            connection = self.server_socket.accept()[0]
+        except (socket.error, OSError):
+            return
+        try:
+            connection.settimeout(5.0)
+            request = read_request(connection)
+        except (socket.error, OSError):
+            request = None
+        if request is None:
+            connection.close()
+            return
+        connection.settimeout(None)
+        tenant = request.get("tenant") or "default"
+        self.queue.put(tenant, (connection, tenant, request["argv"],
+                                request.get("cwd", "/")))
+        if self.verbose:
+            print("\nQueued a command for the tenant", repr(tenant) + ",",
+                  len(self.queue), "waiting.")
+
+    def process_index(self, tenant):
+        """Return the index of the process of tenant, assigning it one if it
+        has none yet.  The least recently seen tenants with no commands
+        waiting or running are then forgotten, if there are too many."""
+        if tenant in self.tenant_processes:
+            return self.tenant_processes[tenant]
+        index = self.num_tenants.index(min(self.num_tenants))
+        self.tenant_processes[tenant] = index
+        self.num_tenants[index] += 1
+        if len(self.tenant_processes) > self.max_tenants:
+            for old_tenant in list(self.tenant_processes):
+                if len(self.tenant_processes) <= self.max_tenants:
+                    break
+                if old_tenant in self.queue or old_tenant in self.running:
+                    continue
+                self.num_tenants[self.tenant_processes.pop(old_tenant)] -= 1
+        return index
+
+    def start_jobs(self):
+        """Start the next waiting commands on the processes which are free."""
+        from concurrent import futures # Python 3.2 and higher
+        while True:
+            job = self.queue.get(
+                lambda tenant: self.running[self.process_index(tenant)] is None)
+            if job is None:
+                return
+            connection, tenant, argv, cwd = job
+            index = self.process_index(tenant)
+            if self.executors[index] is None:
+                # The process is started from a fork server, so that it does
+                # not inherit the open connections of the clients (which
+                # would then never see the end of their replies).
+                self.executors[index] = futures.ProcessPoolExecutor(
+                    max_workers=1, mp_context=multiprocessing.get_context("forkserver"))
+            self.running[index] = tenant
+            def job_finished(future, index=index, connection=connection,
+                             tenant=tenant):
+                broken = False
+                try:
+                    reply = future.result()
+                except BaseException as e: # the pool could not run the job
+                    broken = isinstance(e, futures.process.BrokenProcessPool)
+                    reply = {"status": 1, "stdout": "", "stderr": "\nError in"
+                             " makeSpanningBackground: The render service could"
+                             "\nnot run the command.  The reported error was:\n "
+                             + repr(e) + "\n"}
+                with self.finished_lock:
+                    self.finished.append((index, connection, tenant, reply, broken))
+                os.write(self.wake_write_fd, b"x")
+            try:
+                future = self.executors[index].submit(
+                    run_service_job, tenant, self.default_argv + argv, cwd)
+            except RuntimeError as e: # the pool is broken or shut down
+                future = futures.Future()
+                future.set_exception(e)
+            future.add_done_callback(job_finished)
+
+    def send_replies(self):
+        """Send the replies of the finished commands, and replace any process
+        which died."""
+        with self.finished_lock:
+            finished, self.finished = self.finished, []
+        for index, connection, tenant, reply, broken in finished:
+            self.running[index] = None
+            if tenant in self.tenant_processes: # make it the most recently seen
+                self.tenant_processes[tenant] = self.tenant_processes.pop(tenant)
+            if broken:
+                if self.verbose:
+                    print("\nThe worker process of the tenant", repr(tenant),
+                          "died, starting a new one.")
+                self.executors[index].shutdown(wait=False)
+                self.executors[index] = None
+            if self.verbose:
+                print("\nFinished a command for the tenant", repr(tenant),
+                      "with exit status", str(reply["status"]) + ".")
+            try:
+                connection.sendall(json.dumps(reply).encode("utf-8"))
+            except (socket.error, OSError):
+                pass # the client went away
+            finally:
+                connection.close()
+
+
+# The image lists of the render service's worker processes, for each tenant
+# and set of image sources, as (background_bag, aspect_buckets) pairs.  The
+# tenant names come from the clients, so only the most recently used ones are
+# kept (the least recently used first).
+service_libraries = collections.OrderedDict()
+max_service_libraries = 64
+
+
+def run_service_job(tenant, argv, cwd):
+    """Run a command of the render service for the tenant tenant, with the
+    command-line arguments argv, from the directory cwd.  This is run in a
+    worker process of the service.  Returns the reply dict for the client."""
+    return run_captured(render_service_command, tenant, argv, cwd)
+
+
+def render_service_command(tenant, argv, cwd):
+    """Make the image for a command of the render service; this is run by
+    run_service_job.  Raises SystemExit if the program would exit early."""
+    global background_bag, aspect_buckets, num_workers
+    os.chdir(cwd)
+    save_file_name = setup_program(argv)
+    if args.timedelay or args.control or args.resident:
+        print("\nError in makeSpanningBackground: The '--timedelay', '--control',"
+              "\nand '--resident' options cannot be used with the '--service'"
+              "\noption.\n", file=sys.stderr)
+        sys.exit(1)
+    if not args.reslist:
+        print("\nError in makeSpanningBackground: The '--service' option requires"
+              "\nthe '--reslist' option, to give the display layout.\n",
+              file=sys.stderr)
+        sys.exit(1)
+    args.dontapply = True # the image is for the tenant, not for this display
+    if not args.workers:
+        num_workers = 1 # the processes already run the commands in parallel
+
+    # Use the image list of the tenant for these images, so that sampling is
+    # without replacement for each tenant.
+    library_key = (tenant, tuple(args.image_files_and_dirs), args.recursive,
+                   args.sequential, bool(args.percenterror), cwd)
+    background_bag, aspect_buckets = service_libraries.pop(
+        library_key, (ShuffleBag(), AspectBuckets([])))
+    daemon = BackgroundDaemon(save_file_name)
+    try:
+        daemon.run()
+    finally:
+        daemon.close()
+        close_thread_pools()
+        service_libraries[library_key] = (background_bag, aspect_buckets)
+        while len(service_libraries) > max_service_libraries:
+            service_libraries.popitem(last=False)
+    if args.verbose:
+        print("\nFinished execution of makeSpanningBackground.")
+
+
 #
 # The main code.
 #
 
 
-if __name__ == "__main__":
+def setup_program(argv=None):
+    """Parse the command-line arguments argv (by default those of the program)
+    into the global args, check them, and set up the other globals which
+    depend on them.  Returns the absolute pathname of the output file.  This
+    is called again for each command handed to a resident program (see the
+    '--resident' option), and anything already set up for the same arguments
+    is kept, so it stays warm."""
+    global args, zoom_spline, image_index, image_pyramids, tile_cache
+    global num_workers, resampler_name
 
     # Parse the command-line arguments.
-    args = parse_command_line_arguments(parser, help_string_replacement_pairs)
+    args = parse_command_line_arguments(parser, help_string_replacement_pairs,
+                                        argv=argv)
 
     # Set up the output file.
     save_file_name = process_path(args.outfile[0]) # make absolute, expand tilde
@@ -1236,6 +5118,90 @@ if __name__ == "__main__":
                   + str(zoom_spline) + " is not in the range 0-5.\n")
             sys.exit(1)
 
+    # Set up the cache directory and load any persistent image index from it.
+    if args.cachedir:
+        cache_dir = process_path(args.cachedir[0])
+        if not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                path_error_exit(cache_dir, "Could not create the cache directory.")
+        if not os.path.isdir(cache_dir):
+            path_error_exit(cache_dir, "The specified cache directory exists but"
+                          " is not a directory.")
+        index_path = os.path.join(cache_dir, "imageIndex.json")
+        if image_index.index_path != index_path:
+            image_index = ImageIndex(index_path)
+    elif image_index.index_path is not None:
+        image_index = ImageIndex()
+
+    # Set up the pyramid levels of the images, and make them if the
+    # --makepyramids option is set.
+    if args.makepyramids and not args.cachedir:
+        print("\nError in makeSpanningBackground: The '--makepyramids' option"
+              "\nrequires the '--cachedir' option.\n")
+        sys.exit(1)
+    image_pyramids = None
+    if args.cachedir:
+        pyramid_dir = os.path.join(cache_dir, "pyramids")
+        try:
+            image_pyramids = ImagePyramids(pyramid_dir)
+        except OSError:
+            path_error_exit(pyramid_dir, "Could not create the pyramid directory.")
+
+    # Set up the cache of scaled images.
+    if args.tilecache:
+        if not args.cachedir:
+            print("\nError in makeSpanningBackground: The '--tilecache' option"
+                  "\nrequires the '--cachedir' option.\n")
+            sys.exit(1)
+        tile_cache_dir = os.path.join(cache_dir, "tiles")
+        max_bytes = int(args.tilecache[0] * 2**20)
+        if (tile_cache is None or tile_cache.cache_dir != tile_cache_dir
+                or tile_cache.max_bytes != max_bytes):
+            try:
+                tile_cache = TileCache(tile_cache_dir, max_bytes)
+            except OSError:
+                path_error_exit(tile_cache_dir, "Could not create the tile cache directory.")
+    else:
+        tile_cache = None
+
+    # Handle the --workers option and its default value.
+    try:
+        num_workers = multiprocessing.cpu_count()
+    except NotImplementedError:
+        num_workers = 1
+    if args.workers:
+        num_workers = args.workers[0]
+        if num_workers < 1:
+            print("\nError in makeSpanningBackground: The number of worker threads"
+                  "\nmust be at least one.\n")
+            sys.exit(1)
+
+    # Check the --layouts option.
+    if args.layouts and args.layouts[0] < 1:
+        print("\nError in makeSpanningBackground: The number of display layouts"
+              "\nto remember must be at least one.\n")
+        sys.exit(1)
+
+    # Check the --rotate option.
+    if args.rotate and args.rotate[0] < 1:
+        print("\nError in makeSpanningBackground: The number of displays to"
+              "\nrotate must be at least one.\n")
+        sys.exit(1)
+
+    # Handle the --resampler option and its default value.
+    resampler_name = "spline"
+    if args.resampler:
+        resampler_name = args.resampler[0]
+
+    # With the --makepyramids option just make the pyramid levels and exit.
+    if args.makepyramids:
+        make_all_pyramids()
+        close_thread_pools()
+        image_index.save()
+        sys.exit(0)
+
     # Print a welcome message if the verbose option was chosen.
     if args.verbose:
         if system_os == "Windows":
@@ -1247,75 +5213,69 @@ if __name__ == "__main__":
         else:
             print("\nRunning makeSpanningBackground on an unknown OS...")
 
-    # Now begin looping if the '--timedelay' option was set; if it was not
-    # the loop will break after one execution.
-    first_loop_completed = False
-    while True:
+    return save_file_name
 
-        # Get the current display information.
-        display_res_list = get_display_info()
-        num_displays = len(display_res_list)
-        if num_displays == 0:
-            print("\nError in makeSpanningBackground: No displays detected."
-                  "\nMaybe try explicitly setting the resolutions with the"
-                  "\n'--reslist' option.\n")
-            sys.exit(1)
-        if args.verbose:
-            print("\nDetected", num_displays, "displays:\n   ", display_res_list,
-                  "\n")
-
-        # Select an image for each display.
-        bg_images = []
-        bg_image_names = []
-        # TODO use enumerate
-        for disp_res, count in zip(display_res_list, range(len(display_res_list))):
-            image = get_next_background_image(disp_res, display_res_list)
-            if not image:
-                print("\nError in makeSpanningBackground: No suitable image files"
-                      "\nfound for display", str(count)+".\n", file=sys.stderr)
-                sys.exit(1)
-            if args.verbose:
-                print("Image selected for display", count, "is\n   ", image[0], "\n")
-            bg_image_names.append(image[0])
-            bg_images.append(image[1])
-            if args.oneimage:
-                break
 
-        if args.logcurrent:
-            expanded_log_name = process_path(args.logcurrent[0]) # tilde expand
-            # TODO make sure this is not a directory first
-            current_images_log = open(expanded_log_name, "w")
-            for count, img in enumerate(bg_image_names):
-                print("Image on display", count, "is\n   ", img, "\n",
-                      file=current_images_log)
-            current_images_log.close()
+if __name__ == "__main__":
 
-        # Make the large, combined image.
-        giant_image = create_giant_image(bg_images, display_res_list)
+    # The resident program for the '--resident' option is started by a thin
+    # client with only this argument.
+    if sys.argv[1:] == ["--residentserver"]:
+        resident_server = ResidentServer(resident_socket_path())
+        if resident_server.listen():
+            resident_server.run()
+        sys.exit(0)
 
-        # Write out the giant image to a file.
+    # The render service for the '--service' option is started with '--serve'
+    # as the first argument.
+    if sys.argv[1:2] == ["--serve"]:
+        serve_args = parse_command_line_arguments(
+            serve_parser, help_string_replacement_pairs, argv=sys.argv[2:])
+        if not hasattr(socket, "AF_UNIX"):
+            print("\nError in makeSpanningBackground: Unix-domain sockets are not"
+                  "\navailable on this system, so the render service cannot be"
+                  " run.\n", file=sys.stderr)
+            sys.exit(1)
+        if sys.version_info < (3, 7): # the worker pools need the forkserver context
+            print("\nError in makeSpanningBackground: The render service requires"
+                  "\nPython 3.7 or higher.\n", file=sys.stderr)
+            sys.exit(1)
+        num_processes = serve_args.processes[0] if serve_args.processes else None
+        if num_processes is None:
+            try:
+                num_processes = multiprocessing.cpu_count()
+            except NotImplementedError:
+                num_processes = 1
+        if num_processes < 1:
+            print("\nError in makeSpanningBackground: The number of worker"
+                  "\nprocesses must be at least one.\n", file=sys.stderr)
+            sys.exit(1)
+        default_argv = []
+        if serve_args.cachedir:
+            default_argv += ["--cachedir", process_path(serve_args.cachedir[0])]
+        if serve_args.tilecache:
+            default_argv += ["--tilecache", str(serve_args.tilecache[0])]
+        socket_path = process_path(serve_args.socket_path)
+        render_service = RenderService(socket_path, num_processes, default_argv,
+                                       serve_args.verbose)
+        if not render_service.listen():
+            path_error_exit(socket_path, "Another running program is already"
+                            " listening on the socket.")
         try:
-            if args.verbose:
-                print("\nWriting the combined image to the file\n   "+save_file_name)
-            sp.misc.imsave(save_file_name, giant_image)
-        except IOError as e:
-            print("\nWarning from makeSpanningBackground: Could not save to file"
-                  "\n   " + save_file_name, "\nThe reported error was:\n", e,
-                  file=sys.stderr)
+            render_service.run()
+        finally:
+            os.remove(socket_path)
 
-        if not args.dontapply:
-            if args.verbose:
-                print("\nSetting the new image as the current background wallpaper.")
-                if system_os == "Windows":
-                    print("(Be sure to set wallpaper mode to 'tiled' in Windows.)")
-            set_image_as_current_wallpaper(save_file_name)
+    save_file_name = setup_program()
 
-        first_loop_completed = True
-        if not args.timedelay:
-            break
-        if args.verbose:
-            print("\n"+"-"*10, "Sleeping for", args.timedelay[0], "minutes.", "-"*30)
-        time.sleep(args.timedelay[0]*60.0)
+    # Run the iterations.  With the '--timedelay' option this continues until
+    # the program is stopped; otherwise it is done after the first.
+    daemon = BackgroundDaemon(save_file_name)
+    try:
+        daemon.run()
+    finally:
+        daemon.close()
+        close_thread_pools()
 
     if args.verbose:
         print("\nFinished execution of makeSpanningBackground.")
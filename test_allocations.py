@@ -0,0 +1,70 @@
+"""Tests that composing the combined image scales each image straight into
+the giant image, rather than allocating a scaled copy and then copying it.
+Run with 'python -m unittest test_allocations' (or with pytest)."""
+
+from __future__ import division, print_function
+import os
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+
+import numpy as np
+from PIL import Image
+
+import makeSpanningBackground as msb
+
+
+class TestCompositionAllocations(unittest.TestCase):
+
+    reslist = ["1920x1080+0+0", "1280x1024+1920+0"]
+    image_sizes = [(300, 400), (350, 320)] # (y, x), far smaller than the displays
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image_dir = os.path.join(self.tmp_dir, "images")
+        os.mkdir(self.image_dir)
+        random_state = np.random.RandomState(0)
+        for count, (y, x) in enumerate(self.image_sizes):
+            pixels = random_state.randint(0, 256, (y, x, 3)).astype(np.uint8)
+            Image.fromarray(pixels).save(os.path.join(self.image_dir,
+                                                      "img%d.png" % count))
+        self.image_names = sorted(os.path.join(self.image_dir, f)
+                                  for f in os.listdir(self.image_dir))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def peak_allocated_bytes(self, options):
+        """Set up the program with options and return the peak number of bytes
+        allocated while creating the giant image, along with its size."""
+        msb.setup_program(["-d", "-s", "--workers", "1"] + options + ["-o",
+                          os.path.join(self.tmp_dir, "out.png"), self.image_dir,
+                          "-r"] + self.reslist)
+        disp_res_list = msb.get_display_info()
+        # Warm up any lazily created state, so it is not counted.
+        msb.create_giant_image(self.image_names, disp_res_list)
+        tracemalloc.start()
+        try:
+            giant_image = msb.create_giant_image(self.image_names, disp_res_list)[0]
+            return tracemalloc.get_traced_memory()[1], giant_image.nbytes
+        finally:
+            tracemalloc.stop()
+
+    def test_linear_spline_allocates_one_canvas(self):
+        peak, canvas_bytes = self.peak_allocated_bytes(["-z", "1"])
+        # Apart from the giant image only the decoded images are allocated, and
+        # no scaled copy of a display (1280x1024 RGB for the smaller one).
+        self.assertGreaterEqual(peak, canvas_bytes)
+        self.assertLess(peak, canvas_bytes + 1280 * 1024 * 3 // 2)
+
+    def test_cubic_spline_allocates_one_canvas_and_coefficients(self):
+        peak, canvas_bytes = self.peak_allocated_bytes([])
+        # The float64 spline coefficients of an image are also needed.
+        coeffs_bytes = max(y * x * 3 * 8 for y, x in self.image_sizes)
+        self.assertGreaterEqual(peak, canvas_bytes + coeffs_bytes)
+        self.assertLess(peak, canvas_bytes + coeffs_bytes + 1280 * 1024 * 3 // 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
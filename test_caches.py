@@ -0,0 +1,161 @@
+"""Tests of the on-disk caches in the '--cachedir' directory: the tile cache
+and the pyramid levels, and the choice of the level which is read.  Run with 'python -m unittest test_caches' (or with
+pytest)."""
+
+from __future__ import division, print_function
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+from PIL import Image
+
+import makeSpanningBackground as msb
+
+
+class TestTileCacheKey(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        image_dir = os.path.join(self.tmp_dir, "images")
+        os.mkdir(image_dir)
+        self.image_file = os.path.join(image_dir, "img.png")
+        Image.new("RGB", (640, 480)).save(self.image_file)
+        msb.setup_program(["-d", "--cachedir", os.path.join(self.tmp_dir, "cache"),
+                           "--tilecache", "10", "-o",
+                           os.path.join(self.tmp_dir, "out.png"), image_dir,
+                           "-r", "64x48+0+0"])
+        self.disp_res_list = msb.get_display_info()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_key_changes_when_pyramid_levels_are_made(self):
+        key = msb.tile_cache.make_key(self.image_file, self.disp_res_list)
+        self.assertEqual(key, msb.tile_cache.make_key(self.image_file,
+                                                      self.disp_res_list))
+        self.assertGreater(msb.image_pyramids.make_levels(self.image_file), 0)
+        self.assertNotEqual(key, msb.tile_cache.make_key(self.image_file,
+                                                         self.disp_res_list))
+
+    def test_key_depends_on_reduced_decoding(self):
+        key = msb.tile_cache.make_key(self.image_file, self.disp_res_list)
+        has_reduce = msb.pillow_has_reduce
+        msb.pillow_has_reduce = not has_reduce
+        try:
+            self.assertNotEqual(key, msb.tile_cache.make_key(self.image_file,
+                                                             self.disp_res_list))
+        finally:
+            msb.pillow_has_reduce = has_reduce
+
+
+class TestPyramidLevels(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        image_dir = os.path.join(self.tmp_dir, "images")
+        os.mkdir(image_dir)
+        self.image_file = os.path.join(image_dir, "img.png")
+        random_state = np.random.RandomState(0)
+        self.pixels = random_state.randint(0, 256, (768, 1024, 3)).astype(np.uint8)
+        Image.fromarray(self.pixels).save(self.image_file)
+        msb.setup_program(["-d", "--cachedir", os.path.join(self.tmp_dir, "cache"),
+                           "-o", os.path.join(self.tmp_dir, "out.png"), image_dir,
+                           "-r", "64x48+0+0"])
+        # Levels of 384x512, 192x256 and 96x128.
+        self.assertEqual(msb.image_pyramids.make_levels(self.image_file), 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_smallest_large_enough_level_is_read(self):
+        for disp_size, level_shape in [((48, 64), (96, 128)), ((96, 128), (96, 128)),
+                                       ((97, 128), (192, 256)), ((150, 300), (384, 512)),
+                                       ((384, 512), (384, 512)), ((385, 512), None),
+                                       ((1000, 2000), None)]:
+            disp_res = disp_size + (0, 0)
+            image = msb.read_image_file(self.image_file, disp_res)
+            yx_new = msb.calculate_scaling(self.pixels.shape, disp_res, [disp_res])[1]
+            for dim in [0, 1]: # never smaller than the scaled size
+                self.assertGreaterEqual(image.shape[dim], min(yx_new[dim],
+                                                              self.pixels.shape[dim]))
+            if level_shape is None: # the file is decoded instead
+                self.assertEqual(image.shape[:2], (768, 1024))
+                self.assertTrue(np.array_equal(image, self.pixels))
+            else:
+                self.assertEqual(image.shape[:2], level_shape, disp_size)
+                level = self.pixels # each level is half the size of the last
+                while level.shape[:2] != level_shape:
+                    level = msb.box_shrink(level, (2, 2))
+                self.assertTrue(np.array_equal(image, level))
+
+    def test_levels_of_a_changed_image_are_not_used(self):
+        Image.fromarray(self.pixels[:, ::-1]).save(self.image_file)
+        os.utime(self.image_file, (0, os.stat(self.image_file).st_mtime + 10))
+        self.assertEqual(msb.image_pyramids.existing_levels(self.image_file), [])
+        image = msb.read_image_file(self.image_file, (48, 64, 0, 0))
+        self.assertTrue(np.array_equal(image, np.asarray(
+            Image.fromarray(self.pixels[:, ::-1]).reduce(16))))
+
+
+class TestTileCacheEviction(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, "tiles")
+        msb.setup_program(["-d", "-o", os.path.join(self.tmp_dir, "out.png"),
+                           self.tmp_dir, "-r", "64x48+0+0"])
+        self.tiles = [(np.zeros((10, 10, 3), np.uint8), (0, 0))]
+        # Room for a little more than two entries of these tiles.
+        self.cache = msb.TileCache(self.cache_dir, 10**6)
+        self.cache.put("size.npz", self.tiles)
+        self.entry_size = os.path.getsize(os.path.join(self.cache_dir, "size.npz"))
+        self.cache.max_bytes = 2 * self.entry_size + self.entry_size // 2
+        self.cache.remove("size.npz")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def cached_files(self):
+        return sorted(os.listdir(self.cache_dir))
+
+    def test_least_recently_used_entries_are_deleted(self):
+        self.cache.put("a.npz", self.tiles)
+        self.cache.put("b.npz", self.tiles)
+        self.assertIsNotNone(self.cache.get("a.npz"))
+        self.cache.put("c.npz", self.tiles)
+        self.assertEqual(list(self.cache.entries), ["a.npz", "c.npz"])
+        self.assertEqual(self.cached_files(), ["a.npz", "c.npz"])
+        self.assertEqual(self.cache.total_bytes, 2 * self.entry_size)
+
+    def test_order_is_kept_across_runs(self):
+        for key in ["a.npz", "b.npz"]:
+            self.cache.put(key, self.tiles)
+        os.utime(os.path.join(self.cache_dir, "a.npz"), (0, time.time() - 100))
+        os.utime(os.path.join(self.cache_dir, "b.npz"), (0, time.time() - 200))
+        cache = msb.TileCache(self.cache_dir, self.cache.max_bytes)
+        self.assertEqual(list(cache.entries), ["b.npz", "a.npz"])
+
+    def test_entries_of_other_programs(self):
+        other_cache = msb.TileCache(self.cache_dir, self.cache.max_bytes)
+        for key in ["a.npz", "b.npz"]:
+            self.cache.put(key, self.tiles)
+        other_cache.put("c.npz", self.tiles)
+        # An entry found on disk is counted, and the cache is kept in budget.
+        self.assertIsNotNone(self.cache.get("c.npz"))
+        self.assertEqual(self.cached_files(), ["b.npz", "c.npz"])
+        self.assertEqual(self.cache.total_bytes, 2 * self.entry_size)
+        # Entries deleted by the other program are not counted.
+        other_cache.remove("b.npz")
+        other_cache.remove("c.npz")
+        self.cache.put("d.npz", self.tiles)
+        self.assertEqual(list(self.cache.entries), ["d.npz"])
+        self.assertEqual(self.cache.total_bytes, self.entry_size)
+        self.cache.put("e.npz", self.tiles)
+        self.assertEqual(self.cached_files(), ["d.npz", "e.npz"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,511 @@
+"""Tests of the timed loop in '--timedelay' mode: the prefetcher of the next
+images for each remembered display layout, the handling of display layout
+changes, the '--rotate' canvas, and the control commands.
+Run with 'python -m unittest test_daemon' (or with pytest)."""
+
+from __future__ import division, print_function
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+from PIL import Image
+
+import makeSpanningBackground as msb
+
+
+class DaemonTestCase(unittest.TestCase):
+    """Creates a temporary directory of images, with the program set up to use
+    it for the display layout reslist."""
+
+    options = []
+    reslist = ["64x48+0+0", "64x48+64+0"]
+    num_images = 6
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image_dir = os.path.join(self.tmp_dir, "images")
+        os.mkdir(self.image_dir)
+        self.image_files = []
+        for count in range(self.num_images):
+            path = os.path.join(self.image_dir, "img%d.png" % count)
+            Image.new("RGB", (80, 60), (40 * count, 0, 0)).save(path)
+            self.image_files.append(path)
+        self.save_file_name = msb.setup_program(
+            ["-d", "-o", os.path.join(self.tmp_dir, "out.png")] + self.options
+            + [self.image_dir, "-r"] + self.reslist)
+        self.disp_res_list = msb.get_display_info()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestPrefetcherDiscards(DaemonTestCase):
+
+    options = ["-s", "-p", "50"]
+
+    def check_discard_puts_back(self):
+        msb.reload_library()
+        library = msb.current_library()
+        prefetcher = msb.BackgroundPrefetcher(self.save_file_name)
+        prefetcher.start(self.disp_res_list)
+        prefetcher.wait()
+        self.assertEqual(len(library), self.num_images - 2)
+        # A new layout makes the prefetcher forget the old one.
+        prefetcher.remember([self.disp_res_list[0]])
+        self.assertEqual(len(library), self.num_images)
+        self.assertFalse(os.path.exists(prefetcher.prefetch_file_name(
+            prefetcher.layout_key(self.disp_res_list))))
+        # The images go back to their places in the sequential order.
+        self.assertEqual(msb.get_next_background_image(
+            self.disp_res_list[0], self.disp_res_list), self.image_files[0])
+
+    def test_discard_puts_back_into_buckets(self):
+        self.check_discard_puts_back()
+
+    def test_discard_puts_back_into_bag(self):
+        msb.args.percenterror = None
+        self.check_discard_puts_back()
+
+    def test_discard_all_on_close(self):
+        msb.reload_library()
+        library = msb.current_library()
+        prefetcher = msb.BackgroundPrefetcher(self.save_file_name)
+        prefetcher.start(self.disp_res_list)
+        prefetcher.discard_all()
+        self.assertEqual(len(library), self.num_images)
+
+    def test_deleted_files_are_not_put_back(self):
+        msb.reload_library()
+        library = msb.current_library()
+        prefetcher = msb.BackgroundPrefetcher(self.save_file_name)
+        prefetcher.start(self.disp_res_list)
+        prefetcher.wait()
+        os.remove(self.image_files[0])
+        msb.remove_library_file(self.image_files[0])
+        prefetcher.discard_all()
+        self.assertEqual(len(library), self.num_images - 1)
+        self.assertNotIn(self.image_files[0], library)
+
+
+
+class TestPrefetcherLayouts(DaemonTestCase):
+
+    options = ["-s", "-p", "50"]
+
+    def setUp(self):
+        super(TestPrefetcherLayouts, self).setUp()
+        msb.reload_library()
+        self.prefetcher = msb.BackgroundPrefetcher(self.save_file_name, 3)
+        # Four layouts, the last with the Windows origin correction.
+        disp0, disp1 = self.disp_res_list
+        self.layouts = [[disp0], [disp1], list(self.disp_res_list), [disp0]]
+        self.origins = [None, None, None, (0, 20)]
+
+    def tearDown(self):
+        self.prefetcher.discard_all()
+        super(TestPrefetcherLayouts, self).tearDown()
+
+    def key(self, index):
+        return self.prefetcher.layout_key(self.layouts[index], self.origins[index])
+
+    def test_current_layout_is_rendered_first(self):
+        # In sequential order the first image rendered gets the first file.
+        self.prefetcher.remember(self.layouts[0])
+        self.prefetcher.remember(self.layouts[1])
+        self.prefetcher.start(self.layouts[2])
+        self.prefetcher.thread.join()
+        self.assertEqual(self.prefetcher.ready[self.key(2)][0], self.image_files[:2])
+        self.assertEqual(self.prefetcher.ready[self.key(1)][0], [self.image_files[2]])
+        self.assertEqual(self.prefetcher.ready[self.key(0)][0], [self.image_files[3]])
+
+    def test_at_most_max_layouts_are_kept(self):
+        library = msb.current_library()
+        for index in range(3):
+            self.prefetcher.start(self.layouts[index], self.origins[index])
+            self.prefetcher.thread.join()
+        self.assertEqual(len(self.prefetcher.ready), 3)
+        self.assertEqual(len(library), self.num_images - 4)
+        oldest_file = self.prefetcher.prefetch_file_name(self.key(0))
+        self.assertTrue(os.path.exists(oldest_file))
+        # The layout with the Windows origin is a new one, and the oldest
+        # layout is forgotten.
+        self.prefetcher.start(self.layouts[3], self.origins[3])
+        self.prefetcher.thread.join()
+        self.assertEqual(self.prefetcher.layouts, [self.key(3), self.key(2), self.key(1)])
+        self.assertEqual(sorted(self.prefetcher.ready),
+                         sorted([self.key(3), self.key(2), self.key(1)]))
+        self.assertFalse(os.path.exists(oldest_file))
+        # Its image file is put back, and drawn again for the new layout.
+        self.assertEqual(len(library), self.num_images - 4)
+        self.assertEqual(self.prefetcher.ready[self.key(3)][0], [self.image_files[0]])
+
+    def test_take_remembered_layout(self):
+        for index in range(3):
+            self.prefetcher.start(self.layouts[index], self.origins[index])
+            self.prefetcher.thread.join()
+        # The displays change back to a remembered layout.
+        prefetch_file = self.prefetcher.prefetch_file_name(self.key(0))
+        with open(prefetch_file, "rb") as f:
+            prefetched = f.read()
+        self.assertEqual(self.prefetcher.take(self.layouts[0]), [self.image_files[0]])
+        self.assertFalse(os.path.exists(prefetch_file))
+        with open(self.save_file_name, "rb") as f:
+            self.assertEqual(f.read(), prefetched)
+        self.assertNotIn(self.key(0), self.prefetcher.ready)
+        self.assertIn(self.key(1), self.prefetcher.ready)
+        # Nothing is ready for an unknown layout, or the known one with
+        # another origin.
+        self.assertIsNone(self.prefetcher.take(self.layouts[2], (0, 20)))
+        self.assertIsNone(self.prefetcher.take(self.layouts[0]))
+
+    def test_take_fails_to_move_the_image(self):
+        library = msb.current_library()
+        self.prefetcher.start(self.layouts[0])
+        self.prefetcher.thread.join()
+        self.assertEqual(len(library), self.num_images - 1)
+        def fail_to_replace(from_path, to_path):
+            raise OSError(13, "Permission denied")
+        real_replace_file = msb.replace_file
+        msb.replace_file = fail_to_replace
+        old_stderr, msb.sys.stderr = msb.sys.stderr, open(os.devnull, "w")
+        try:
+            self.assertIsNone(self.prefetcher.take(self.layouts[0]))
+        finally:
+            msb.replace_file = real_replace_file
+            msb.sys.stderr.close()
+            msb.sys.stderr = old_stderr
+        self.assertFalse(os.path.exists(self.save_file_name))
+        self.assertNotIn(self.key(0), self.prefetcher.ready)
+        self.assertFalse(os.path.exists(self.prefetcher.prefetch_file_name(self.key(0))))
+        # Its image file is put back, to be drawn for the image made instead.
+        self.assertEqual(len(library), self.num_images)
+        self.assertEqual(msb.get_next_background_image(
+            self.layouts[0][0], self.layouts[0]), self.image_files[0])
+
+class TestDisplayHotplug(DaemonTestCase):
+
+    options = ["-t", "60"]
+
+    def setUp(self):
+        super(TestDisplayHotplug, self).setUp()
+        self.daemon = msb.BackgroundDaemon(self.save_file_name)
+        self.daemon.display_monitor.close()
+        self.monitor = msb.FakeDisplayMonitor(self.disp_res_list)
+        self.daemon.display_monitor = self.monitor
+
+    def tearDown(self):
+        self.daemon.close()
+        super(TestDisplayHotplug, self).tearDown()
+
+    def render_once(self):
+        """Make the image for the current layout, as the run loop does."""
+        self.daemon.start_render()
+        while not self.daemon.render_done:
+            self.daemon.wait_for_events(10.0)
+        self.daemon.finish_render()
+
+    def saved_image_size(self):
+        return Image.open(self.save_file_name).size
+
+    def test_layout_change_makes_a_new_image(self):
+        self.render_once()
+        self.assertEqual(self.saved_image_size(), (128, 48))
+        deadline = self.daemon.deadline
+        self.daemon.wait_for_events(0.0)
+        self.assertIsNone(self.daemon.render_reason) # no event, no change
+        self.monitor.post_layout([(48, 64, 0, 0)]) # unplug the second display
+        self.daemon.wait_for_events(1.0)
+        self.assertEqual(self.daemon.render_reason, "layout")
+        self.render_once()
+        self.assertEqual(self.saved_image_size(), (64, 48))
+        self.assertEqual(self.daemon.deadline, deadline) # the timer is unchanged
+
+    def test_event_with_the_same_layout_is_ignored(self):
+        self.render_once()
+        self.monitor.post_layout(self.disp_res_list)
+        self.daemon.wait_for_events(1.0)
+        self.assertIsNone(self.daemon.render_reason)
+
+    def test_library_changes_are_applied_while_sleeping(self):
+        self.render_once()
+        if self.daemon.library_watcher.fileno() is None:
+            self.skipTest("inotify is not available")
+        new_file = os.path.join(self.image_dir, "new.png")
+        Image.new("RGB", (80, 60)).save(new_file)
+        os.remove(self.image_files[0])
+        self.daemon.wait_for_events(1.0)
+        self.assertIn(new_file, msb.background_bag)
+        self.assertNotIn(self.image_files[0], msb.background_bag)
+        self.assertIsNone(self.daemon.render_reason)
+
+
+class TestPrefetchInProgress(TestDisplayHotplug):
+
+    options = ["-t", "60", "--prefetch"]
+
+    def test_events_are_handled_while_waiting_for_the_prefetch(self):
+        self.render_once()
+        self.daemon.prefetcher.wait()
+        # A prefetch which does not finish until it is allowed to.
+        may_finish = threading.Event()
+        self.daemon.prefetcher.thread = threading.Thread(target=may_finish.wait)
+        self.daemon.prefetcher.thread.start()
+        try:
+            self.daemon.start_render() # returns without waiting for the prefetch
+            self.monitor.post_layout([(48, 64, 0, 0)])
+            self.daemon.wait_for_events(1.0)
+            self.assertEqual(self.daemon.render_reason, "layout")
+            self.assertFalse(self.daemon.render_done)
+        finally:
+            may_finish.set()
+        while not self.daemon.render_done:
+            self.daemon.wait_for_events(10.0)
+        self.daemon.finish_render()
+        self.assertEqual(self.saved_image_size(), (128, 48))
+
+
+class TestRotatingCanvas(DaemonTestCase):
+
+    options = ["-s", "-t", "60", "--rotate", "2"]
+    reslist = ["64x48+0+0", "64x48+64+0", "64x48+128+0"]
+
+    def setUp(self):
+        super(TestRotatingCanvas, self).setUp()
+        msb.reload_library()
+
+    def image_color(self, image_name):
+        return [40 * self.image_files.index(image_name), 0, 0]
+
+    def check_canvas(self, giant_image, image_names, x_offset=0):
+        """Check that each display shows the color of its image."""
+        for count, image_name in enumerate(image_names):
+            x = (64 * count + 32 - x_offset) % 192
+            self.assertEqual(list(giant_image[24, x]), self.image_color(image_name))
+
+    def test_displays_are_redrawn_in_turn(self):
+        canvas = msb.RotatingCanvas(2)
+        giant_image, image_names, changed_rects = canvas.render(self.disp_res_list)
+        self.assertIsNone(changed_rects)
+        self.assertEqual(image_names, self.image_files[:3])
+        expected_names = list(image_names)
+        for new_names, counts in [(self.image_files[3:5], [0, 1]),
+                                  (self.image_files[5:6] + self.image_files[:1], [2, 0])]:
+            giant_image, image_names, changed_rects = canvas.render(self.disp_res_list)
+            for count, image_name in zip(counts, new_names):
+                expected_names[count] = image_name
+            self.assertEqual(image_names, expected_names)
+            self.assertEqual(changed_rects, [(0, 64 * count, 48, 64) for count in counts])
+            self.check_canvas(giant_image, image_names)
+
+    def test_changed_rects_are_split_at_the_windows_seam(self):
+        yx_origin = (0, 100) # the seam is inside the second display
+        canvas = msb.RotatingCanvas(1)
+        canvas.render(self.disp_res_list, yx_origin)
+        canvas.render(self.disp_res_list, yx_origin)
+        giant_image, image_names, changed_rects = canvas.render(self.disp_res_list,
+                                                                yx_origin)
+        self.assertEqual(changed_rects, [(0, 156, 48, 36), (0, 0, 48, 28)])
+        self.check_canvas(giant_image, image_names, x_offset=100)
+
+    def test_new_layout_makes_a_complete_image(self):
+        canvas = msb.RotatingCanvas(1)
+        canvas.render(self.disp_res_list)
+        canvas.render(self.disp_res_list)
+        giant_image, image_names, changed_rects = canvas.render(self.disp_res_list[:2])
+        self.assertIsNone(changed_rects)
+        self.assertEqual(giant_image.shape, (48, 128, 3))
+        self.assertEqual(len(image_names), 2)
+        self.assertEqual(canvas.next_display, 0)
+        self.assertEqual(canvas.render(self.disp_res_list[:2])[2], [(0, 0, 48, 64)])
+
+    def test_bmp_file_is_patched(self):
+        self.save_file_name = msb.setup_program(
+            ["-d", "-s", "-t", "60", "--rotate", "1", "-o",
+             os.path.join(self.tmp_dir, "out.bmp"), self.image_dir, "-r"]
+            + self.reslist)
+        daemon = msb.BackgroundDaemon(self.save_file_name)
+        daemon.display_monitor.close()
+        daemon.display_monitor = msb.FakeDisplayMonitor(self.disp_res_list)
+        real_patch_bmp_file = msb.patch_bmp_file
+        patched = []
+        def patch_bmp_file(*args):
+            patched.append(real_patch_bmp_file(*args))
+            return patched[-1]
+        real_copyfile = msb.shutil.copyfile
+        copied = []
+        def copyfile(*args):
+            copied.append(args)
+            return real_copyfile(*args)
+        msb.patch_bmp_file = patch_bmp_file
+        msb.shutil.copyfile = copyfile
+        try:
+            for count in range(4):
+                daemon.render(self.disp_res_list)
+                written = np.asarray(Image.open(self.save_file_name).convert("RGB"))
+                self.assertTrue(np.array_equal(written,
+                                               daemon.rotating_canvas.giant_image))
+        finally:
+            msb.patch_bmp_file = real_patch_bmp_file
+            msb.shutil.copyfile = real_copyfile
+            daemon.close()
+        self.assertEqual(patched, [True, True, True])
+        # Only the first patch copies the file; the later ones patch the spare.
+        self.assertEqual(len(copied), 1)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ["images", "out.bmp"])
+
+
+class TestPatchBmpFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bmp_file = os.path.join(self.tmp_dir, "out.bmp")
+        random_state = np.random.RandomState(0)
+        # Rows of 7 pixels are padded in the file.
+        self.old_image = random_state.randint(0, 256, (5, 7, 3)).astype(np.uint8)
+        self.new_image = random_state.randint(0, 256, (5, 7, 3)).astype(np.uint8)
+        Image.fromarray(self.old_image).save(self.bmp_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_file(self):
+        return np.asarray(Image.open(self.bmp_file).convert("RGB"))
+
+    def test_rects_are_rewritten(self):
+        rects = [(1, 2, 3, 4), (0, 6, 5, 1)]
+        self.assertTrue(msb.patch_bmp_file(self.bmp_file, self.new_image, rects))
+        expected = self.old_image.copy()
+        for y, x, y_size, x_size in rects:
+            expected[y:y+y_size, x:x+x_size] = self.new_image[y:y+y_size, x:x+x_size]
+        self.assertTrue(np.array_equal(self.read_file(), expected))
+        self.assertEqual(os.listdir(self.tmp_dir), ["out.bmp"])
+
+    def test_spare_file_is_patched_in_place(self):
+        spare_file = os.path.join(self.tmp_dir, "out.spare.bmp")
+        first_rects = [(1, 2, 3, 4)]
+        self.assertTrue(msb.patch_bmp_file(self.bmp_file, self.new_image,
+                                           first_rects, spare_file))
+        first_image = self.read_file()
+        self.assertTrue(np.array_equal(
+            np.asarray(Image.open(spare_file).convert("RGB")), self.old_image))
+        # The spare file holds the old image, which differs from the current
+        # one in first_rects, and is patched and renamed into place.
+        third_image = np.zeros_like(self.new_image)
+        second_rects = [(0, 6, 5, 1)]
+        spare_inode = os.stat(spare_file).st_ino
+        self.assertTrue(msb.patch_bmp_file(self.bmp_file, third_image,
+                                           second_rects, spare_file, first_rects))
+        self.assertEqual(os.stat(self.bmp_file).st_ino, spare_inode)
+        expected = first_image.copy()
+        expected[0:5, 6:7] = 0
+        expected[1:4, 2:6] = 0
+        self.assertTrue(np.array_equal(self.read_file(), expected))
+        self.assertTrue(np.array_equal(
+            np.asarray(Image.open(spare_file).convert("RGB")), first_image))
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ["out.bmp", "out.spare.bmp"])
+
+    def test_other_files_are_not_changed(self):
+        self.assertFalse(msb.patch_bmp_file(self.bmp_file, self.new_image[:4],
+                                            [(0, 0, 1, 1)]))
+        png_file = os.path.join(self.tmp_dir, "out.png")
+        Image.fromarray(self.old_image).save(png_file, "PNG")
+        self.assertFalse(msb.patch_bmp_file(png_file, self.new_image, [(0, 0, 1, 1)]))
+        self.assertTrue(np.array_equal(self.read_file(), self.old_image))
+
+    def test_failure_leaves_the_old_file(self):
+        real_replace_file = msb.replace_file
+        def fail(from_file_name, to_file_name):
+            raise IOError("disk full")
+        msb.replace_file = fail
+        try:
+            self.assertRaises(IOError, msb.patch_bmp_file, self.bmp_file,
+                              self.new_image, [(0, 0, 5, 7)])
+        finally:
+            msb.replace_file = real_replace_file
+        self.assertTrue(np.array_equal(self.read_file(), self.old_image))
+        self.assertEqual(os.listdir(self.tmp_dir), ["out.bmp"])
+
+
+class TestControlCommands(DaemonTestCase):
+
+    def setUp(self):
+        super(TestControlCommands, self).setUp()
+        self.socket_path = os.path.join(self.tmp_dir, "control.sock")
+        self.save_file_name = msb.setup_program(
+            ["-d", "-t", "10", "--control", self.socket_path, "-o",
+             os.path.join(self.tmp_dir, "out.png"), self.image_dir, "-r"]
+            + self.reslist)
+        self.daemon = msb.BackgroundDaemon(self.save_file_name)
+        self.daemon.last_start_time = msb.monotonic_time()
+        self.daemon.deadline = self.daemon.last_start_time + self.daemon.interval
+
+    def tearDown(self):
+        self.daemon.close()
+        super(TestControlCommands, self).tearDown()
+
+    def send(self, command):
+        """Send command on the control socket while the daemon waits for it,
+        and return the reply."""
+        replies = []
+        client = threading.Thread(target=lambda: replies.append(
+            msb.send_control_command(self.socket_path, command)))
+        client.start()
+        while client.is_alive():
+            self.daemon.wait_for_events(0.1)
+        return replies[0]
+
+    def test_commands(self):
+        self.assertRegex(self.send("status"),
+                         r"^ok interval 10 next (10\.00|9\.99) paused 0 rendering 0$")
+        self.assertEqual(self.send("pause"), "ok")
+        self.assertTrue(self.daemon.paused)
+        self.assertEqual(self.send("interval 2.5"), "ok")
+        self.assertRegex(self.send("status"),
+                         r"^ok interval 2\.5 next (2\.50|2\.49) paused 1 rendering 0$")
+        self.assertEqual(self.send("resume"), "ok")
+        self.assertFalse(self.daemon.paused)
+        self.assertEqual(self.send("next"), "ok")
+        self.assertEqual(self.daemon.render_reason, "next")
+        self.assertEqual(self.send("reload"), "ok")
+        self.assertTrue(self.daemon.reload_requested)
+        self.assertEqual(self.send("quit"), "ok")
+        self.assertTrue(self.daemon.quitting)
+
+    def test_bad_commands(self):
+        self.assertEqual(self.send("interval -1"),
+                         "error the interval must be a positive number of minutes")
+        self.assertEqual(self.send("interval"), "error unknown command")
+        self.assertEqual(self.send("bogus"), "error unknown command")
+        self.assertEqual(self.send(""), "error empty command")
+
+    def test_socket_is_removed_on_close(self):
+        self.daemon.close()
+        self.assertFalse(os.path.exists(self.socket_path))
+        self.assertIsNone(msb.send_control_command(self.socket_path, "status"))
+
+
+class TestThreadPoolsClosed(DaemonTestCase):
+
+    options = ["--workers", "2", "--prefetch", "-t", "60"]
+
+    def test_pools_are_closed_when_idle(self):
+        os.mkdir(os.path.join(self.image_dir, "subdir"))
+        msb.args.recursive = True # so the scanning pool is used
+        daemon = msb.BackgroundDaemon(self.save_file_name)
+        try:
+            daemon.start_render()
+            daemon.render_thread.join()
+            daemon.finish_render()
+            self.assertIsNotNone(daemon.prefetcher)
+            daemon.prefetcher.wait()
+            self.assertIsNone(msb.worker_pool)
+            self.assertIsNone(msb.scan_pool)
+        finally:
+            daemon.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,363 @@
+"""Tests of the image library: the shuffle bag, the aspect-ratio buckets, the
+image index, and the library watchers.  Run with 'python -m unittest
+test_library' (or with pytest)."""
+
+from __future__ import division, print_function
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+import makeSpanningBackground as msb
+
+
+class LibraryTestCase(unittest.TestCase):
+    """Creates a temporary image directory, with the program set up to use it
+    for one 64x48 display."""
+
+    options = []
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image_dir = os.path.join(self.tmp_dir, "images")
+        os.mkdir(self.image_dir)
+        msb.setup_program(["-d", "-o", os.path.join(self.tmp_dir, "out.png")]
+                          + self.options + [self.image_dir, "-r", "64x48+0+0"])
+        self.disp_res = msb.get_display_info()[0]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_image(self, name, x, y):
+        """Write an x by y image called name, and return its path."""
+        path = os.path.join(self.image_dir, name)
+        Image.new("RGB", (x, y)).save(path)
+        return path
+
+
+class TestShuffleBag(unittest.TestCase):
+
+    def test_draws_each_item_once(self):
+        items = ["a", "b", "c", "b", "d"]
+        bag = msb.ShuffleBag(items)
+        drawn = [bag.draw() for count in range(len(items))]
+        self.assertEqual(sorted(drawn), sorted(items))
+        self.assertEqual(len(bag), 0)
+        self.assertNotIn("b", bag)
+
+    def test_sequential_draws_in_order(self):
+        bag = msb.ShuffleBag(["a", "b", "c"], sequential=True)
+        self.assertEqual(bag.draw(), "a")
+        bag.add("d")
+        self.assertEqual([bag.draw() for count in range(3)], ["b", "c", "d"])
+
+    def test_removal_while_iterating(self):
+        for sequential in [False, True]:
+            bag = msb.ShuffleBag(range(10), sequential=sequential)
+            seen = []
+            for item in bag:
+                seen.append(item)
+                bag.remove(item)
+                if item == 3 and sequential:
+                    bag.remove(4) # a later item, not yet reached
+            if sequential:
+                self.assertEqual(seen, [0, 1, 2, 3, 5, 6, 7, 8, 9])
+            else:
+                self.assertEqual(sorted(seen), list(range(10)))
+            self.assertEqual(len(bag), 0)
+            self.assertEqual(list(bag), [])
+
+    def test_remove_one_instance(self):
+        bag = msb.ShuffleBag(["a", "b", "a"])
+        bag.remove("a")
+        self.assertIn("a", bag)
+        self.assertEqual(sorted(bag), ["a", "b"])
+        bag.remove("a")
+        bag.remove("missing")
+        self.assertEqual(list(bag), ["b"])
+
+    def test_put_back_keeps_sequential_order(self):
+        bag = msb.ShuffleBag(["a", "b", "c"], sequential=True)
+        first, second = bag.draw(), bag.draw()
+        bag.put_back(second)
+        bag.put_back(first)
+        self.assertEqual(len(bag), 3)
+        self.assertEqual([bag.draw() for count in range(3)], ["a", "b", "c"])
+
+
+class TestImageIndex(LibraryTestCase):
+
+    def setUp(self):
+        super(TestImageIndex, self).setUp()
+        self.index_path = os.path.join(self.tmp_dir, "index.json")
+        self.image_file = self.make_image("img.png", 80, 60)
+
+    def test_unchanged_directory_is_not_listed_again(self):
+        index = msb.ImageIndex()
+        filenames, dirnames, changed = index.list_directory(self.image_dir)
+        self.assertEqual((filenames, dirnames, changed), (["img.png"], [], True))
+        self.assertFalse(index.list_directory(self.image_dir)[2])
+        self.make_image("new.png", 80, 60)
+        self.assertEqual(index.list_directory(self.image_dir)[0],
+                         ["img.png", "new.png"])
+
+    def test_change_within_the_mtime_resolution(self):
+        # The directory changes again just after it is listed, within the
+        # same tick of its modification time.
+        index = msb.ImageIndex()
+        dir_mtime = os.stat(self.image_dir).st_mtime
+        index.list_directory(self.image_dir)
+        self.make_image("new.png", 80, 60)
+        os.utime(self.image_dir, (dir_mtime, dir_mtime))
+        self.assertEqual(index.list_directory(self.image_dir),
+                         (["img.png", "new.png"], [], True))
+        # Once it was listed well after its last change it is not listed again.
+        old_mtime = dir_mtime - 10
+        os.utime(self.image_dir, (old_mtime, old_mtime))
+        index.list_directory(self.image_dir)
+        self.make_image("newer.png", 80, 60)
+        os.utime(self.image_dir, (old_mtime, old_mtime))
+        self.assertEqual(index.list_directory(self.image_dir),
+                         (["img.png", "new.png"], [], False))
+
+    def test_saved_and_loaded(self):
+        index = msb.ImageIndex(self.index_path)
+        index.list_directory(self.image_dir)
+        self.assertEqual(index.image_size(self.image_file), (60, 80))
+        index.save()
+        loaded_index = msb.ImageIndex(self.index_path)
+        self.assertEqual(loaded_index.files, index.files)
+        self.assertFalse(loaded_index.list_directory(self.image_dir)[2])
+
+    def test_shared_index_keeps_the_entries_of_others(self):
+        # Two worker processes of the render service sharing a cache directory.
+        first_index = msb.ImageIndex(self.index_path)
+        second_index = msb.ImageIndex(self.index_path)
+        other_file = self.make_image("other.png", 40, 30)
+        self.assertEqual(first_index.image_size(self.image_file), (60, 80))
+        self.assertEqual(second_index.image_size(other_file), (30, 40))
+        first_index.save()
+        second_index.save()
+        loaded_index = msb.ImageIndex(self.index_path)
+        self.assertEqual(sorted(loaded_index.files), sorted([self.image_file, other_file]))
+        self.assertEqual(second_index.files, loaded_index.files)
+
+    def test_corrupted_index_starts_over(self):
+        with open(self.index_path, "w") as index_file:
+            index_file.write("{not json")
+        old_stderr, msb.sys.stderr = msb.sys.stderr, open(os.devnull, "w")
+        try:
+            index = msb.ImageIndex(self.index_path)
+        finally:
+            msb.sys.stderr.close()
+            msb.sys.stderr = old_stderr
+        self.assertEqual((index.dirs, index.files), ({}, {}))
+
+    def test_unreadable_files(self):
+        index = msb.ImageIndex()
+        bad_file = os.path.join(self.image_dir, "bad.png")
+        with open(bad_file, "w") as bad:
+            bad.write("not an image")
+        self.assertRaises(IOError, index.image_size, bad_file)
+        self.assertTrue(index.is_unreadable(bad_file))
+        self.assertFalse(index.is_unreadable(self.image_file))
+        index.mark_unreadable(self.image_file)
+        self.assertTrue(index.is_unreadable(self.image_file))
+        # A file is tried again once it changes.
+        self.make_image("bad.png", 80, 61)
+        self.assertFalse(index.is_unreadable(bad_file))
+        self.assertEqual(index.image_size(bad_file), (61, 80))
+
+
+class TestAspectBuckets(LibraryTestCase):
+
+    def setUp(self):
+        super(TestAspectBuckets, self).setUp()
+        rand = random.Random(0)
+        self.image_files = [self.make_image("img%02d.png" % count,
+                                            rand.randint(20, 80), rand.randint(20, 80))
+                            for count in range(40)]
+        self.bad_file = os.path.join(self.image_dir, "bad.png")
+        with open(self.bad_file, "w") as bad_file:
+            bad_file.write("not an image")
+        msb.warned_unreadable_files.add(self.bad_file) # do not print the warning
+
+    def fitting_files(self, files, max_err_fraction):
+        """The files which fit the display, found by brute force."""
+        disp_res_list = [self.disp_res]
+        return [f for f in files if msb.calculate_scaling(
+                    msb.image_index.image_size(f), self.disp_res,
+                    disp_res_list)[3] <= max_err_fraction]
+
+    def check_selections(self, sequential):
+        buckets = msb.AspectBuckets(self.image_files[:3] + [self.bad_file]
+                                    + self.image_files[3:], sequential=sequential)
+        # The unreadable file is only found when it is drawn.
+        self.assertEqual(len(buckets), len(self.image_files) + 1)
+        available = list(self.image_files)
+        while True:
+            fitting = self.fitting_files(available, 0.1)
+            selected = buckets.select(self.disp_res, [self.disp_res], 0.1)
+            if selected is None:
+                self.assertEqual(fitting, [])
+                break
+            self.assertIn(selected[0], fitting)
+            if sequential:
+                self.assertEqual(selected[0], fitting[0])
+            available.remove(selected[0])
+        self.assertNotIn(self.bad_file, buckets)
+        self.assertEqual(len(buckets), len(available))
+
+    def test_random_selections_fit(self):
+        self.check_selections(sequential=False)
+
+    def test_sequential_selections_fit_in_order(self):
+        self.check_selections(sequential=True)
+
+    def test_headers_are_read_when_drawn(self):
+        probed = []
+        def probe_image_size(filename):
+            probed.append(filename)
+            return real_probe_image_size(filename)
+        real_probe_image_size, real_index = msb.probe_image_size, msb.image_index
+        msb.probe_image_size, msb.image_index = probe_image_size, msb.ImageIndex()
+        try:
+            buckets = msb.AspectBuckets(self.image_files, sequential=True)
+            self.assertEqual(probed, [])
+            selected = buckets.select(self.disp_res, [self.disp_res], 0.1)
+        finally:
+            msb.probe_image_size, msb.image_index = real_probe_image_size, real_index
+        # The headers are read in batches, in order, up to the selected file.
+        selected_index = self.image_files.index(selected[0])
+        batch_size = msb.AspectBuckets.probe_batch_size
+        num_batches = selected_index // batch_size + 1
+        self.assertEqual(sorted(probed), self.image_files[:num_batches * batch_size])
+        for position, filename in enumerate(buckets.filenames):
+            if filename in probed:
+                self.assertEqual(buckets.sizes[position],
+                                 msb.image_index.image_size(filename))
+            else:
+                self.assertIsNone(buckets.sizes[position])
+
+
+class TestLibraryWatcher(LibraryTestCase):
+
+    options = ["--recursive"]
+
+    def setUp(self):
+        super(TestLibraryWatcher, self).setUp()
+        self.first_file = self.make_image("first.png", 64, 48)
+        msb.reload_library()
+        self.watcher = msb.LibraryWatcher()
+
+    def tearDown(self):
+        self.watcher.close()
+        super(TestLibraryWatcher, self).tearDown()
+
+    def bag_files(self):
+        return sorted(msb.background_bag)
+
+    def test_additions_and_deletions(self):
+        new_file = self.make_image("new.png", 64, 48)
+        subdir = os.path.join(self.image_dir, "subdir")
+        os.mkdir(subdir)
+        sub_file = os.path.join(subdir, "sub.png")
+        Image.new("RGB", (64, 48)).save(sub_file)
+        self.watcher.update()
+        self.assertEqual(self.bag_files(), sorted([self.first_file, new_file, sub_file]))
+        os.remove(self.first_file)
+        shutil.rmtree(subdir)
+        self.watcher.update()
+        self.assertEqual(self.bag_files(), [new_file])
+
+    def test_changes_seen_after_another_listing(self):
+        # Reloading the file list lists the changed directory first, through
+        # the same image index.
+        new_file = self.make_image("new.png", 64, 48)
+        msb.reload_background_files()
+        self.watcher.update()
+        self.assertEqual(self.bag_files(), sorted([self.first_file, new_file]))
+        os.remove(self.first_file)
+        msb.reload_background_files()
+        self.watcher.update()
+        self.assertEqual(self.bag_files(), [new_file])
+
+    def test_change_within_the_mtime_resolution(self):
+        dir_mtime = self.watcher.dir_mtimes[self.image_dir][0]
+        new_file = self.make_image("new.png", 64, 48)
+        os.utime(self.image_dir, (dir_mtime, dir_mtime))
+        self.watcher.update()
+        self.assertEqual(self.bag_files(), sorted([self.first_file, new_file]))
+
+
+class TestInotifyLibraryWatcher(LibraryTestCase):
+
+    options = ["--recursive"]
+
+    def setUp(self):
+        super(TestInotifyLibraryWatcher, self).setUp()
+        self.first_file = self.make_image("first.png", 64, 48)
+        msb.reload_library()
+        try:
+            self.watcher = msb.InotifyLibraryWatcher()
+        except (OSError, AttributeError) as e:
+            super(TestInotifyLibraryWatcher, self).tearDown()
+            self.skipTest("inotify is not available: {0}".format(e))
+
+    def tearDown(self):
+        self.watcher.close()
+        super(TestInotifyLibraryWatcher, self).tearDown()
+
+    def bag_files(self):
+        return sorted(msb.background_bag)
+
+    def test_events_are_read(self):
+        self.make_image("new.png", 64, 48)
+        os.remove(self.first_file)
+        events = self.watcher.read_events()
+        image_dir_wd = self.watcher.dir_to_wd[self.image_dir]
+        self.assertIn((image_dir_wd, self.watcher.IN_CLOSE_WRITE, "new.png"), events)
+        self.assertIn((image_dir_wd, self.watcher.IN_DELETE, "first.png"), events)
+        self.assertEqual(self.watcher.read_events(), [])
+
+    def test_additions_and_deletions(self):
+        new_file = self.make_image("new.png", 64, 48)
+        subdir = os.path.join(self.image_dir, "subdir")
+        os.mkdir(subdir)
+        self.watcher.update()
+        sub_file = os.path.join(subdir, "sub.png")
+        Image.new("RGB", (64, 48)).save(sub_file)
+        self.watcher.update()
+        self.assertEqual(self.bag_files(), sorted([self.first_file, new_file, sub_file]))
+        os.remove(self.first_file)
+        self.watcher.update()
+        self.assertEqual(self.bag_files(), sorted([new_file, sub_file]))
+
+    def test_watch_of_removed_directory_is_ignored(self):
+        subdir = os.path.join(self.image_dir, "subdir")
+        os.mkdir(subdir)
+        self.watcher.update()
+        subdir_wd = self.watcher.dir_to_wd[subdir]
+        Image.new("RGB", (64, 48)).save(os.path.join(subdir, "sub.png"))
+        shutil.rmtree(subdir)
+        self.watcher.update()
+        # The kernel removes the watch, and its IN_IGNORED event drops it.
+        self.assertNotIn(subdir, self.watcher.dir_files)
+        self.assertNotIn(subdir, self.watcher.dir_to_wd)
+        self.assertNotIn(subdir_wd, self.watcher.wd_to_dir)
+        self.assertEqual(self.bag_files(), [self.first_file])
+
+    def test_queue_overflow_checks_all_directories(self):
+        new_file = self.make_image("new.png", 64, 48)
+        os.remove(self.first_file)
+        self.watcher.read_events() # the events are lost, as in an overflow
+        self.watcher.read_events = lambda: [(-1, self.watcher.IN_Q_OVERFLOW, "")]
+        self.watcher.update()
+        self.assertEqual(self.bag_files(), [new_file])
+
+
+if __name__ == "__main__":
+    unittest.main()
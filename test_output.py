@@ -0,0 +1,251 @@
+"""Tests of composing and writing the combined image: the '--streamed'
+option, the memory-mapped BMP output, the displays and gaps with
+'--oneimage', and the Windows origin correction on each of the output
+paths.  Run with 'python -m unittest test_output' (or with pytest)."""
+
+from __future__ import division, print_function
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import scipy as sp
+import scipy.ndimage
+from PIL import Image
+
+import makeSpanningBackground as msb
+
+
+class TestStreamedOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        image_dir = os.path.join(self.tmp_dir, "images")
+        os.mkdir(image_dir)
+        for count in range(2):
+            Image.new("RGB", (80, 60), (100 * count, 50, 0)).save(
+                os.path.join(image_dir, "img%d.png" % count))
+        self.out_file = os.path.join(self.tmp_dir, "out.png")
+        msb.setup_program(["-d", "-s", "--streamed", "-o", self.out_file,
+                           image_dir, "-r", "64x48+0+0", "64x48+64+0"])
+        self.disp_res_list = msb.get_display_info()
+        self.old_image = np.full((48, 128, 3), 7, np.uint8)
+        Image.fromarray(self.old_image).save(self.out_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_image_replaces_the_file(self):
+        msb.write_background(self.out_file, self.disp_res_list)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ["images", "out.png"])
+        written = np.asarray(Image.open(self.out_file).convert("RGB"))
+        self.assertEqual(written.shape, (48, 128, 3))
+        self.assertFalse((written == self.old_image).all())
+
+    def test_failure_leaves_the_old_file(self):
+        real_write_rows = msb.PngRowWriter.write_rows
+        def fail_after_first_band(row_writer, y_start, rows):
+            if y_start:
+                raise IOError("disk full")
+            real_write_rows(row_writer, y_start, rows)
+        msb.PngRowWriter.write_rows = fail_after_first_band
+        try:
+            self.assertRaises(IOError, msb.write_streamed_image, self.out_file,
+                              msb.PngRowWriter,
+                              msb.select_background_images(self.disp_res_list),
+                              self.disp_res_list, band_rows=16)
+        finally:
+            msb.PngRowWriter.write_rows = real_write_rows
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ["images", "out.png"])
+        written = np.asarray(Image.open(self.out_file).convert("RGB"))
+        self.assertTrue((written == self.old_image).all())
+
+
+class TestMemmapBmpOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image_dir = os.path.join(self.tmp_dir, "images")
+        os.mkdir(self.image_dir)
+        random_state = np.random.RandomState(0)
+        pixels = random_state.randint(0, 256, (60, 80, 3)).astype(np.uint8)
+        self.image_name = os.path.join(self.image_dir, "img.png")
+        Image.fromarray(pixels).save(self.image_name)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_same_as_pil_output(self):
+        # Rows of these widths are padded in the file, except for 4 and 20.
+        for reslist in [["13x9+0+0"], ["1x5+0+0"], ["2x3+0+0"], ["4x3+0+0"],
+                        ["13x9+0+0", "10x7+13+1"], ["7x9+0+0", "13x4+7+2"]]:
+            msb.setup_program(["-d", "-c", "1", "2", "3", "-o",
+                               os.path.join(self.tmp_dir, "out.bmp"),
+                               self.image_dir, "-r"] + reslist)
+            disp_res_list = msb.get_display_info()
+            image_names = [self.image_name] * len(disp_res_list)
+            memmap_file = os.path.join(self.tmp_dir, "memmap.bmp")
+            pil_file = os.path.join(self.tmp_dir, "pil.bmp")
+            msb.write_memmap_bmp_image(memmap_file, image_names, disp_res_list)
+            msb.save_image_file(pil_file, msb.create_giant_image(image_names,
+                                                                 disp_res_list)[0])
+            memmap_image = Image.open(memmap_file)
+            pil_image = Image.open(pil_file)
+            self.assertEqual(memmap_image.mode, "RGB")
+            self.assertTrue(np.array_equal(np.asarray(memmap_image),
+                                           np.asarray(pil_image)), reslist)
+            self.assertEqual(os.path.getsize(memmap_file), os.path.getsize(pil_file))
+
+
+class TestOneImage(unittest.TestCase):
+
+    reslist = ["64x48+0+0", "50x40+64+5", "30x20+20+48"] # with gaps between
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image_dir = os.path.join(self.tmp_dir, "images")
+        os.mkdir(self.image_dir)
+        random_state = np.random.RandomState(0)
+        self.image = random_state.randint(0, 256, (60, 80, 3)).astype(np.uint8)
+        self.image_name = os.path.join(self.image_dir, "img.png")
+        Image.fromarray(self.image).save(self.image_name)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def expected_image(self, disp_res_list, gap_color, fit_color):
+        """Scale the image to the whole bounding box, as was done before only
+        the displays were rendered, and then crop it to the displays."""
+        max_y, max_x = msb.get_bounding_box(disp_res_list)
+        yx_curr, yx_new, fitimage_offsets, err = msb.calculate_scaling(
+                                    self.image.shape, (max_y, max_x, 0, 0), disp_res_list)
+        zoom = [(yx_new[dim] + 1E-5) / yx_curr[dim] for dim in [0, 1]]
+        scaled = sp.ndimage.zoom(self.image, (zoom[0], zoom[1], 1), order=3)
+        y_start = int(round(max(0.0, (yx_new[0] - max_y) / 2)))
+        x_start = int(round(max(0.0, (yx_new[1] - max_x) / 2)))
+        scaled = scaled[y_start:y_start+max_y, x_start:x_start+max_x]
+        full_image = np.empty((max_y, max_x, 3), np.uint8)
+        if fit_color: # otherwise the scaled image covers it all
+            full_image[:, :] = fit_color
+        full_image[fitimage_offsets[0]:fitimage_offsets[0]+scaled.shape[0],
+                   fitimage_offsets[1]:fitimage_offsets[1]+scaled.shape[1]] = scaled
+        expected = np.empty((max_y, max_x, 3), np.uint8)
+        expected[:, :] = gap_color
+        for y_size, x_size, y, x in disp_res_list:
+            expected[y:y+y_size, x:x+x_size] = full_image[y:y+y_size, x:x+x_size]
+        return expected
+
+    def check_displays(self, options, gap_color, fit_color=None):
+        msb.setup_program(["-d", "--oneimage", "-o",
+                           os.path.join(self.tmp_dir, "out.png")] + options
+                          + [self.image_dir, "-r"] + self.reslist)
+        disp_res_list = msb.get_display_info()
+        expected = self.expected_image(disp_res_list, gap_color, fit_color)
+        composed = msb.create_giant_image([self.image_name], disp_res_list)[0]
+        self.assertTrue(np.array_equal(composed, expected), options)
+        png_file = os.path.join(self.tmp_dir, "out.png")
+        msb.write_streamed_image(png_file, msb.PngRowWriter, [self.image_name],
+                                 disp_res_list, band_rows=16)
+        written = np.asarray(Image.open(png_file).convert("RGB"))
+        self.assertTrue(np.array_equal(written, expected), options)
+
+    def test_gaps_are_black(self):
+        self.check_displays([], [0, 0, 0])
+
+    def test_gaps_get_the_colorfill(self):
+        self.check_displays(["-c", "200", "100", "0"], [200, 100, 0])
+
+    def test_fitimage(self):
+        self.check_displays(["-f", "10", "20", "30"], [0, 0, 0], [10, 20, 30])
+        self.check_displays(["-f", "10", "20", "30", "-c", "4", "5", "6"],
+                            [4, 5, 6], [10, 20, 30])
+
+
+def correct_windows_origin(image, yx_origin):
+    """The Windows correction as it was done before it was applied while
+    composing: a second copy of the whole image, with the four pieces around
+    the origin yx_origin swapped."""
+    im_high_y = image.shape[0]
+    im_high_x = image.shape[1]
+    y0, x0 = yx_origin
+    new_image = np.empty_like(image)
+    new_image[im_high_y-y0:im_high_y, im_high_x-x0:im_high_x] = image[0:y0, 0:x0]
+    new_image[0:im_high_y-y0, 0:im_high_x-x0] = image[y0:im_high_y, x0:im_high_x]
+    new_image[0:im_high_y - y0, im_high_x-x0:im_high_x] = image[y0:im_high_y, 0:x0]
+    new_image[im_high_y-y0:im_high_y, 0:im_high_x-x0] = image[0:y0, x0:im_high_x]
+    return new_image
+
+
+class TestWindowsOrigin(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image_dir = os.path.join(self.tmp_dir, "images")
+        os.mkdir(self.image_dir)
+        random_state = np.random.RandomState(0)
+        self.image_names = []
+        for count, (y, x) in enumerate([(60, 80), (70, 40)]):
+            pixels = random_state.randint(0, 256, (y, x, 3)).astype(np.uint8)
+            image_name = os.path.join(self.image_dir, "img%d.png" % count)
+            Image.fromarray(pixels).save(image_name)
+            self.image_names.append(image_name)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_image(self, file_name):
+        return np.asarray(Image.open(file_name).convert("RGB"))
+
+    def check_paths(self, options, reslist, xy_origin):
+        """Check that each output path gives the old correction of the image
+        composed without it."""
+        msb.setup_program(["-d", "-w", str(xy_origin[0]), str(xy_origin[1]), "-o",
+                           os.path.join(self.tmp_dir, "out.png")] + options
+                          + [self.image_dir, "-r"] + reslist)
+        disp_res_list = msb.get_display_info()
+        image_names = self.image_names[:1] if msb.args.oneimage else self.image_names
+        yx_origin = msb.windows_origin()
+        self.assertEqual(yx_origin, xy_origin[::-1])
+        uncorrected = msb.create_giant_image(image_names, disp_res_list)[0]
+        expected = correct_windows_origin(uncorrected, yx_origin)
+        description = (options, reslist, xy_origin)
+
+        composed = msb.create_giant_image(image_names, disp_res_list,
+                                          yx_origin=yx_origin)[0]
+        self.assertTrue(np.array_equal(composed, expected), description)
+
+        bmp_file = os.path.join(self.tmp_dir, "out.bmp")
+        msb.write_memmap_bmp_image(bmp_file, image_names, disp_res_list, yx_origin)
+        self.assertTrue(np.array_equal(self.read_image(bmp_file), expected),
+                        description)
+
+        png_file = os.path.join(self.tmp_dir, "out.png")
+        for band_rows in [7, 256]:
+            msb.write_streamed_image(png_file, msb.PngRowWriter, image_names,
+                                     disp_res_list, band_rows, yx_origin)
+            self.assertTrue(np.array_equal(self.read_image(png_file), expected),
+                            description + (band_rows,))
+
+    def test_seam_inside_displays(self):
+        self.check_paths([], ["64x48+0+0", "50x48+64+0"], (30, 20))
+        self.check_paths([], ["64x48+0+0", "50x48+64+0"], (64, 0))
+
+    def test_gaps_with_colorfill(self):
+        self.check_paths(["-c", "200", "100", "0"],
+                         ["64x48+0+0", "50x40+64+5"], (100, 30))
+
+    def test_fitimage(self):
+        self.check_paths(["-f", "10", "20", "30"], ["64x48+0+0", "50x48+64+0"],
+                         (70, 47))
+        self.check_paths(["-f", "10", "20", "30", "-c", "4", "5", "6"],
+                         ["64x48+0+0", "50x40+64+5"], (3, 44))
+
+    def test_oneimage(self):
+        self.check_paths(["--oneimage"], ["64x48+0+0", "50x40+64+5"], (70, 10))
+        self.check_paths(["--oneimage", "-f", "1", "2", "3", "-c", "4", "5", "6"],
+                         ["64x48+0+0", "50x40+64+5"], (20, 45))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+"""Tests of the resident program for the '--resident' option.  Run with
+'python -m unittest test_resident' (or with pytest)."""
+
+from __future__ import division, print_function
+import errno
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from PIL import Image
+
+import makeSpanningBackground as msb
+
+
+class TestResidentServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmp_dir, "resident.sock")
+        self.old_cwd = os.getcwd() # the server changes to the client's directory
+
+    def tearDown(self):
+        msb.command_env = None
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_stale_socket_removed_by_another_program(self):
+        stale_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale_socket.bind(self.socket_path)
+        stale_socket.close() # leaves the socket file, with nothing listening
+        real_remove = os.remove
+        def remove_first(path):
+            real_remove(path) # another program removes it first
+            raise OSError(errno.ENOENT, "No such file or directory")
+        msb.os.remove = remove_first
+        try:
+            server_socket = msb.listen_on_user_socket(self.socket_path)
+        finally:
+            msb.os.remove = real_remove
+        self.assertIsNotNone(server_socket)
+        server_socket.close()
+
+    def test_client_environment_is_not_set_in_the_server(self):
+        image_dir = os.path.join(self.tmp_dir, "images")
+        os.mkdir(image_dir)
+        Image.new("RGB", (80, 60)).save(os.path.join(image_dir, "img.png"))
+        out_file = os.path.join(self.tmp_dir, "out.png")
+        client_env = {"DISPLAY": ":7", "MSB_TEST_CLIENT": "1"}
+        server = msb.ResidentServer(self.socket_path)
+        server_env = dict(os.environ)
+        try:
+            reply = server.handle_request({
+                "argv": ["-d", "-o", out_file, image_dir, "-r", "64x48+0+0"],
+                "cwd": self.tmp_dir, "env": client_env})
+        finally:
+            if server.daemon:
+                server.daemon.close()
+        self.assertEqual(reply["status"], 0, reply["stderr"])
+        self.assertTrue(os.path.exists(out_file))
+        self.assertEqual(dict(os.environ), server_env)
+        self.assertEqual(msb.command_environment(), client_env)
+
+    def test_stop_request(self):
+        # Run as setBackground.bash runs it for '--killall'.
+        env = dict(os.environ, XDG_RUNTIME_DIR=self.tmp_dir)
+        socket_path = os.path.join(self.tmp_dir, "makeSpanningBackground.sock")
+        server = subprocess.Popen([sys.executable, msb.__file__, "--residentserver"],
+                                  env=env)
+        try:
+            give_up_time = time.time() + 30
+            while not os.path.exists(socket_path) and time.time() < give_up_time:
+                time.sleep(0.05)
+            self.assertTrue(os.path.exists(socket_path))
+            self.assertEqual(subprocess.call(
+                [sys.executable, msb.__file__, "--stopresident"], env=env), 0)
+            give_up_time = time.time() + 30
+            while server.poll() is None and time.time() < give_up_time:
+                time.sleep(0.05)
+            self.assertEqual(server.poll(), 0)
+            self.assertFalse(os.path.exists(socket_path))
+        finally:
+            if server.poll() is None:
+                server.kill()
+                server.wait()
+        # With no resident program it does nothing.
+        self.assertEqual(subprocess.call(
+            [sys.executable, msb.__file__, "--stopresident"], env=env), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
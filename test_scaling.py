@@ -0,0 +1,205 @@
+"""Tests of decoding and scaling the images: decoding at a reduced size, and
+the spline resampler, computed in bands on the worker threads, and the memory
+maps of uncompressed BMP and PPM files.  Run with
+'python -m unittest test_scaling' (or with pytest)."""
+
+from __future__ import division, print_function
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import scipy as sp
+import scipy.ndimage
+from PIL import Image
+
+import makeSpanningBackground as msb
+
+
+class ScalingTestCase(unittest.TestCase):
+    """Creates a temporary image directory, with the program set up to use it
+    with the options."""
+
+    options = []
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image_dir = os.path.join(self.tmp_dir, "images")
+        os.mkdir(self.image_dir)
+        Image.new("RGB", (80, 60)).save(os.path.join(self.image_dir, "img.png"))
+        msb.setup_program(["-d", "-o", os.path.join(self.tmp_dir, "out.png")]
+                          + self.options + [self.image_dir, "-r", "64x48+0+0"])
+
+    def tearDown(self):
+        msb.close_thread_pools()
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestSplineBands(ScalingTestCase):
+
+    options = ["--workers", "4"]
+
+    def setUp(self):
+        super(TestSplineBands, self).setUp()
+        random_state = np.random.RandomState(0)
+        self.image = random_state.randint(0, 256, (300, 260, 3)).astype(np.uint8)
+
+    def zoomed(self, yx_new, order):
+        """The image scaled with a single call of sp.ndimage.zoom."""
+        zoom = [(yx_new[dim] + 1E-5) / self.image.shape[dim] for dim in [0, 1]]
+        return sp.ndimage.zoom(self.image, (zoom[0], zoom[1], 1), order=order)
+
+    def test_bands_are_split(self):
+        # Both the prefilter and the resampling of each window are split.
+        self.assertGreater(len(msb.band_slices(self.image.shape[0])), 1)
+        self.assertGreater(len(msb.band_slices(self.image.shape[1])), 1)
+        self.assertGreater(len(msb.band_slices(130)), 1)
+
+    def test_identical_to_zoom(self):
+        windows = [((0, 0), (1000, 1000)), ((17, 33), (90, 70)), ((5, 0), (128, 1))]
+        for yx_new in [(130, 170), (410, 350)]:
+            for order in range(6):
+                for num_workers in [1, 4]:
+                    msb.num_workers = num_workers
+                    expected = self.zoomed(yx_new, order)
+                    self.assertEqual(expected.shape[:2], yx_new)
+                    scaled = msb.scale_image_windows(self.image, yx_new, order,
+                                                     windows)
+                    for (yx_start, yx_extents), window in zip(windows, scaled):
+                        self.assertTrue(np.array_equal(
+                            window, expected[yx_start[0]:yx_start[0]+yx_extents[0],
+                                             yx_start[1]:yx_start[1]+yx_extents[1]]),
+                            (yx_new, order, num_workers, yx_start))
+
+    def test_identical_when_scaled_into_outputs(self):
+        yx_new = (410, 350)
+        expected = self.zoomed(yx_new, 3)
+        outputs = [np.zeros((200, 350, 3), np.uint8), np.zeros((100, 60, 3), np.uint8)]
+        msb.scale_image_windows(self.image, yx_new, 3,
+                                [((0, 0), (200, 350)), ((300, 290), (100, 60))],
+                                outputs)
+        self.assertTrue(np.array_equal(outputs[0], expected[:200]))
+        self.assertTrue(np.array_equal(outputs[1], expected[300:400, 290:]))
+
+
+class TestReducedDecoding(ScalingTestCase):
+
+    # (y, x) display sizes, from far smaller than the images to larger.
+    display_sizes = [(150, 100), (97, 131), (200, 300), (300, 200), (700, 1000),
+                     (1000, 1400)]
+
+    def setUp(self):
+        super(TestReducedDecoding, self).setUp()
+        random_state = np.random.RandomState(0)
+        pixels = random_state.randint(0, 256, (700, 1000, 3)).astype(np.uint8)
+        self.image_files = []
+        for suffix in [".jpg", ".png"]:
+            image_file = os.path.join(self.image_dir, "big" + suffix)
+            Image.fromarray(pixels).save(image_file)
+            self.image_files.append(image_file)
+
+    def num_reduced(self, image_file, options):
+        """Check that the image in image_file is never decoded smaller than its
+        scaled size for any of the display sizes, and return the number of
+        them for which it is decoded at a reduced size."""
+        msb.setup_program(["-d", "-o", os.path.join(self.tmp_dir, "out.png")]
+                          + options + [self.image_dir, "-r", "64x48+0+0"])
+        num_reduced = 0
+        for disp_size in self.display_sizes:
+            disp_res = disp_size + (0, 0)
+            image = msb.read_image_file(image_file, disp_res)
+            yx_new = msb.calculate_scaling((700, 1000), disp_res, [disp_res])[1]
+            description = (image_file, options, disp_size, image.shape)
+            for dim in [0, 1]: # an image which is scaled up is decoded in full
+                self.assertGreaterEqual(image.shape[dim],
+                                        min(yx_new[dim], (700, 1000)[dim]), description)
+            if image.shape[:2] != (700, 1000):
+                num_reduced += 1
+                # Less than twice as large, apart from rounding.
+                self.assertLess(image.shape[0], 2 * yx_new[0] + 2, description)
+        self.assertEqual(msb.read_image_file(image_file).shape, (700, 1000, 3))
+        return num_reduced
+
+    def test_filled_displays(self):
+        for image_file in self.image_files:
+            self.assertEqual(self.num_reduced(image_file, []), 4)
+
+    def test_fitted_displays(self):
+        for image_file in self.image_files:
+            self.assertEqual(self.num_reduced(image_file, ["-f", "0", "0", "0"]), 4)
+
+    def test_without_reduce(self):
+        # Only the JPEG file is decoded at a reduced size then.
+        has_reduce = msb.pillow_has_reduce
+        msb.pillow_has_reduce = False
+        try:
+            self.assertEqual(self.num_reduced(self.image_files[0], []), 4)
+            self.assertEqual(self.num_reduced(self.image_files[1], []), 0)
+        finally:
+            msb.pillow_has_reduce = has_reduce
+
+    def test_extreme_aspect_ratios(self):
+        # Fitted to the display these are scaled to less than a pixel across.
+        msb.setup_program(["-d", "-o", os.path.join(self.tmp_dir, "out.png"),
+                           "-f", "0", "0", "0", self.image_dir, "-r", "64x48+0+0"])
+        for width, height in [(3000, 2), (2, 3000)]:
+            image_file = os.path.join(self.image_dir, "thin.png")
+            Image.new("RGB", (width, height)).save(image_file)
+            image = msb.read_image_file(image_file, (48, 64, 0, 0))
+            self.assertGreaterEqual(min(image.shape[:2]), 1)
+            self.assertLessEqual(max(image.shape[:2]), 3000)
+
+def is_memmapped(array):
+    """Whether array is a view of an np.memmap."""
+    while array is not None:
+        if isinstance(array, np.memmap):
+            return True
+        array = getattr(array, "base", None)
+    return False
+
+
+class TestMemmappedDecoding(ScalingTestCase):
+
+    def setUp(self):
+        super(TestMemmappedDecoding, self).setUp()
+        self.random_state = np.random.RandomState(0)
+
+    def saved_image(self, suffix, yx_size, mode="RGB"):
+        """Save random pixels of size yx_size in a file of the type suffix and
+        return its name and the pixels as decoded by PIL."""
+        pixels = self.random_state.randint(0, 256, yx_size + (3,)).astype(np.uint8)
+        image_file = os.path.join(self.image_dir, "random" + suffix)
+        Image.fromarray(pixels).convert(mode).save(image_file)
+        return image_file, np.asarray(Image.open(image_file).convert("RGB"))
+
+    def test_raw_files_are_memmapped(self):
+        # BMP rows are padded to four bytes, except when the width is a
+        # multiple of four, and stored bottom-up.  PPM rows are not padded.
+        for suffix in [".bmp", ".ppm"]:
+            for yx_size in [(5, 7), (6, 8), (9, 1), (130, 201)]:
+                image_file, expected = self.saved_image(suffix, yx_size)
+                for target_res in [None, (400, 600, 0, 0)]: # not reduced
+                    image = msb.read_image_file(image_file, target_res)
+                    self.assertTrue(is_memmapped(image), (suffix, yx_size))
+                    self.assertTrue(np.array_equal(image, expected), (suffix, yx_size))
+
+    def test_other_files_are_decoded(self):
+        for suffix, mode in [(".png", "RGB"), (".bmp", "P"), (".jpg", "RGB")]:
+            image_file, expected = self.saved_image(suffix, (130, 201), mode)
+            image = msb.read_image_file(image_file)
+            self.assertFalse(is_memmapped(image), suffix)
+            self.assertTrue(np.array_equal(image, expected), suffix)
+
+    def test_reduced_files_are_decoded(self):
+        # A raw file which is reduced is decoded, and is then not a memory map.
+        image_file, expected = self.saved_image(".bmp", (130, 201))
+        image = msb.read_image_file(image_file, (30, 40, 0, 0))
+        self.assertFalse(is_memmapped(image))
+        if msb.pillow_has_reduce:
+            # Scaled to (30, 46) to fill the display, so reduced by 130 // 30.
+            self.assertTrue(np.array_equal(image, np.asarray(
+                Image.fromarray(expected).reduce(4))))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+"""Tests of the render service for the '--serve' and '--service' options.  Run
+with 'python -m unittest test_service' (or with pytest)."""
+
+from __future__ import division, print_function
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import unittest
+
+from PIL import Image
+
+import makeSpanningBackground as msb
+
+
+class ServiceTestCase(unittest.TestCase):
+    """Creates a temporary directory with an image directory in it."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image_dir = os.path.join(self.tmp_dir, "images")
+        os.mkdir(self.image_dir)
+        for count in range(3):
+            Image.new("RGB", (80, 60)).save(
+                os.path.join(self.image_dir, "img%d.png" % count))
+        self.old_cwd = os.getcwd() # the commands change to their directories
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def command_argv(self, out_name):
+        return ["-o", os.path.join(self.tmp_dir, out_name), self.image_dir,
+                "-r", "64x48+0+0"]
+
+
+class TestServiceLibraries(ServiceTestCase):
+
+    def setUp(self):
+        super(TestServiceLibraries, self).setUp()
+        self.old_max = msb.max_service_libraries
+        msb.max_service_libraries = 2
+        msb.service_libraries.clear()
+
+    def tearDown(self):
+        msb.max_service_libraries = self.old_max
+        msb.service_libraries.clear()
+        super(TestServiceLibraries, self).tearDown()
+
+    def test_least_recently_used_libraries_are_dropped(self):
+        for tenant in ["a", "b", "a", "c"]:
+            reply = msb.run_service_job(tenant, self.command_argv(tenant + ".png"),
+                                        self.tmp_dir)
+            self.assertEqual(reply["status"], 0, reply["stderr"])
+        self.assertEqual([key[0] for key in msb.service_libraries], ["a", "c"])
+
+    def test_tenant_processes_are_bounded(self):
+        service = msb.RenderService(os.path.join(self.tmp_dir, "service.sock"),
+                                    2, [])
+        for count in range(10):
+            service.process_index("tenant%d" % count)
+        self.assertEqual(len(service.tenant_processes), 4)
+        self.assertEqual(sum(service.num_tenants), 4)
+        self.assertEqual(list(service.tenant_processes),
+                         ["tenant6", "tenant7", "tenant8", "tenant9"])
+
+
+class TestFairQueue(unittest.TestCase):
+
+    def test_interleaved_tenants_alternate(self):
+        queue = msb.FairQueue()
+        for job in ["a1", "a2", "a3"]:
+            queue.put("a", job)
+        for job in ["b1", "b2"]:
+            queue.put("b", job)
+        self.assertEqual(len(queue), 5)
+        jobs = [queue.get() for count in range(6)]
+        self.assertEqual(jobs, ["a1", "b1", "a2", "b2", "a3", None])
+
+    def test_tenant_which_is_not_ready_keeps_its_turn(self):
+        queue = msb.FairQueue()
+        queue.put("a", "a1")
+        queue.put("b", "b1")
+        queue.put("b", "b2")
+        self.assertEqual(queue.get(lambda tenant: tenant != "a"), "b1")
+        self.assertIn("a", queue)
+        self.assertEqual(queue.get(), "a1")
+        self.assertEqual(queue.get(), "b2")
+        self.assertNotIn("b", queue)
+
+
+class TestRenderService(ServiceTestCase):
+
+    def setUp(self):
+        super(TestRenderService, self).setUp()
+        self.service = msb.RenderService(os.path.join(self.tmp_dir, "service.sock"),
+                                         2, ["-d"])
+        self.assertTrue(self.service.listen())
+        self.service_thread = threading.Thread(target=self.service.run)
+        self.service_thread.daemon = True
+        self.service_thread.start()
+
+    def tearDown(self):
+        for executor in self.service.executors:
+            if executor:
+                executor.shutdown()
+        super(TestRenderService, self).tearDown()
+
+    def send_commands(self, commands):
+        """Send the (tenant, argv) pairs in commands to the service at the same
+        time, and return the list of the replies."""
+        replies = [None] * len(commands)
+        def send(count, tenant, argv):
+            replies[count] = msb.send_command_request(self.service.socket_path,
+                                                      argv, tenant)
+        threads = [threading.Thread(target=send, args=(count, tenant, argv))
+                   for count, (tenant, argv) in enumerate(commands)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(60)
+        return replies
+
+    def worker_pid(self, tenant):
+        executor = self.service.executors[self.service.tenant_processes[tenant]]
+        return list(executor._processes)[0]
+
+    def test_each_tenant_has_its_own_process(self):
+        replies = self.send_commands([("a", self.command_argv("a.png")),
+                                      ("b", self.command_argv("b.png"))])
+        for reply in replies:
+            self.assertEqual(reply["status"], 0, reply["stderr"])
+        self.assertNotEqual(self.service.tenant_processes["a"],
+                            self.service.tenant_processes["b"])
+        self.assertNotEqual(self.worker_pid("a"), self.worker_pid("b"))
+
+    def test_failures_of_one_tenant_do_not_affect_another(self):
+        replies = self.send_commands([("a", self.command_argv("a.png")),
+                                      ("b", self.command_argv("b.png"))])
+        b_pid = self.worker_pid("b")
+        # A failing command, and then a worker process which dies.
+        replies = self.send_commands([("a", ["--no-such-option"]),
+                                      ("b", self.command_argv("b.png"))])
+        self.assertNotEqual(replies[0]["status"], 0)
+        self.assertEqual(replies[1]["status"], 0, replies[1]["stderr"])
+        os.kill(self.worker_pid("a"), signal.SIGKILL)
+        replies = self.send_commands([("a", self.command_argv("a.png")),
+                                      ("b", self.command_argv("b.png"))])
+        self.assertEqual(replies[1]["status"], 0, replies[1]["stderr"])
+        self.assertEqual(self.worker_pid("b"), b_pid)
+        # The process of the first tenant is replaced.
+        reply = self.send_commands([("a", self.command_argv("a.png"))])[0]
+        self.assertEqual(reply["status"], 0, reply["stderr"])
+
+
+if __name__ == "__main__":
+    unittest.main()